@@ -0,0 +1,6 @@
+"""
+Reproducible load tests of the application routes.
+
+Run with python -m benchmarks; see benchmarks/__main__.py for the options. Prompt
+compaction has its own benchmark, python -m benchmarks.compaction.
+"""
@@ -0,0 +1,88 @@
+import sys
+import time
+import argparse
+import platform
+
+from typing import Any, Dict, List, Optional
+from benchmarks.harness import compare, load_results, run_scenario, save_results
+from benchmarks.scenarios import DRIVERS, build_application, prepare, select
+"""
+Command line of the benchmark suite.
+
+	python -m benchmarks [--driver testclient --driver waitress] [--scenario login ...]
+		[--requests 200] [--concurrency 8] [--model-latency 0.05]
+		[--mongo-uri mongodb://localhost:27017] [--output benchmarks/results.json]
+		[--baseline benchmarks/baseline.json] [--tolerance 0.2] [--save-baseline]
+
+Prints one line per scenario, writes every result to --output and compares them
+with --baseline, exiting with status 1 when a scenario regressed beyond the
+tolerance. --save-baseline stores this run as the new baseline instead.
+"""
+
+def parse_arguments(arguments: Optional[List[str]] = None) -> argparse.Namespace:
+	parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Throughput and latency benchmarks of the application routes.")
+	parser.add_argument("--driver", action="append", choices=sorted(DRIVERS), help="Serving mode(s) to benchmark. Defaults to all.")
+	parser.add_argument("--scenario", action="append", help="Scenario(s) to run: register, login, submit, submit_cached, all, search. Defaults to all.")
+	parser.add_argument("--requests", type=int, default=200, help="Requests per scenario.")
+	parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients.")
+	parser.add_argument("--model-latency", type=float, default=0.05, help="Seconds the fake model takes per call.")
+	parser.add_argument("--hash-workers", type=int, help="Password hashing processes; 0 hashes on the request thread. Defaults to the application's.")
+	parser.add_argument("--hash-method", help="Werkzeug password hash method, e.g. pbkdf2:sha256:1000.")
+	parser.add_argument("--mongo-uri", help="Local mongod to use instead of mongomock.")
+	parser.add_argument("--mongo-database", default="FlaskBenchmark", help="Database dropped and used with --mongo-uri.")
+	parser.add_argument("--output", default="benchmarks/results.json", help="Where to write the results.")
+	parser.add_argument("--baseline", default="benchmarks/baseline.json", help="Results to compare against.")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression before failing.")
+	parser.add_argument("--save-baseline", action="store_true", help="Write this run to --baseline instead of comparing.")
+	return parser.parse_args(arguments)
+
+def run(options: argparse.Namespace) -> Dict[str, Any]:
+	settings = vars(options)
+	results: Dict[str, Any] = {
+		"meta": {
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+			"settings": { key: settings[key] for key in ("requests", "concurrency", "model_latency", "hash_workers", "hash_method", "mongo_uri") },
+		},
+		"results": {},
+	}
+
+	for driver in options.driver or sorted(DRIVERS):
+		application = build_application(settings)
+		label = f"{driver}-{int(time.time() * 1000)}"
+
+		with DRIVERS[driver](application, options.concurrency) as sessions:
+			prepare(sessions, label)
+			for name, operation in select(options.scenario, label).items():
+				result = run_scenario(name, operation, sessions, options.requests)
+				results["results"].setdefault(driver, {})[name] = result
+				latency = result["latency_ms"]
+				print(f"{driver:<10} {name:<14} {result['requests_per_second']:>9.1f} req/s  p50 {latency['p50']:>8.2f} ms  p95 {latency['p95']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms  errors {result['errors']}  rss {result['memory_mb']['after']:.1f} MB")
+
+	return results
+
+def main(arguments: Optional[List[str]] = None) -> int:
+	options = parse_arguments(arguments)
+	results = run(options)
+	save_results(results, options.output)
+
+	if options.save_baseline:
+		save_results(results, options.baseline)
+		print(f"Saved baseline to {options.baseline}")
+		return 0
+
+	baseline = load_results(options.baseline)
+	if baseline is None:
+		print(f"No baseline at {options.baseline}; run with --save-baseline to create one")
+		return 0
+
+	regressions = compare(results, baseline, options.tolerance)
+	for regression in regressions:
+		print(f"REGRESSION {regression}")
+	if not regressions:
+		print(f"No regressions beyond {options.tolerance:.0%} against {options.baseline}")
+	return 1 if regressions else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
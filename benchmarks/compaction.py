@@ -0,0 +1,93 @@
+import sys
+import glob
+import time
+import argparse
+import platform
+
+from typing import Any, Dict, List, Optional
+from flask import Flask
+from benchmarks.harness import run_scenario, save_results
+from benchmarks.scenarios import PASSWORD, build_application
+from server.compaction import compact
+"""
+Token reduction and end-to-end latency of prompt compaction.
+
+	python -m benchmarks.compaction [--corpus "server/*.py" ...] [--requests 40]
+		[--model-latency 0.05] [--token-latency 0.2] [--output benchmarks/compaction.json]
+
+Compacts every file of the corpus (this repository's own sources by default) and
+prints its estimated tokens before and after (the application sends a file verbatim
+whenever compaction saves less than the note explaining it costs). Then it submits the files through the
+application, bypassing the analysis cache, once with compaction and once without.
+The fake model waits --model-latency seconds per call plus --token-latency seconds
+per thousand prompt tokens, so the latencies show what the saved tokens are worth
+end to end.
+"""
+
+def parse_arguments(arguments: Optional[List[str]] = None) -> argparse.Namespace:
+	parser = argparse.ArgumentParser(prog="python -m benchmarks.compaction", description="Token reduction and latency of prompt compaction.")
+	parser.add_argument("--corpus", action="append", help="Glob(s) of the files to compact. Defaults to server/*.py.")
+	parser.add_argument("--requests", type=int, default=40, help="Submissions per mode.")
+	parser.add_argument("--model-latency", type=float, default=0.05, help="Seconds the fake model takes per call.")
+	parser.add_argument("--token-latency", type=float, default=0.2, help="Extra seconds the fake model takes per thousand prompt tokens.")
+	parser.add_argument("--output", default="benchmarks/compaction.json", help="Where to write the results.")
+	return parser.parse_args(arguments)
+
+def login(application: Flask) -> Any:
+	session = application.test_client()
+	session.post("/register", json={ "username": "compaction", "password": PASSWORD })
+	session.post("/login", json={ "username": "compaction", "password": PASSWORD })
+	return session
+
+def run(options: argparse.Namespace) -> Dict[str, Any]:
+	paths = sorted({ path for pattern in options.corpus or ["server/*.py"] for path in glob.glob(pattern) })
+	sources = { path: open(path, encoding="utf-8").read() for path in paths }
+	sources = { path: source for path, source in sources.items() if source.strip() }
+	if not sources:
+		raise SystemExit("The corpus is empty")
+
+	results: Dict[str, Any] = {
+		"meta": {
+			"python": platform.python_version(),
+			"started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+			"settings": { key: getattr(options, key) for key in ("requests", "model_latency", "token_latency") },
+		},
+		"files": {},
+		"latency": {},
+	}
+
+	for path, source in sources.items():
+		compaction = compact(source)
+		results["files"][path] = { **compaction.report(), "saved_ratio": round(1 - compaction.tokens / max(1, compaction.original_tokens), 3) }
+		print(f"{path:<32} {compaction.original_tokens:>7} -> {compaction.tokens:>7} tokens  ({results['files'][path]['saved_ratio']:.1%} saved)")
+
+	original = sum(file["original_tokens"] for file in results["files"].values())
+	compacted = sum(file["prompt_tokens"] for file in results["files"].values())
+	results["tokens"] = { "original": original, "compacted": compacted, "saved_ratio": round(1 - compacted / max(1, original), 3) }
+	print(f"{'total':<32} {original:>7} -> {compacted:>7} tokens  ({results['tokens']['saved_ratio']:.1%} saved)")
+
+	codes = list(sources.values())
+	for enabled in (False, True):
+		mode = "compacted" if enabled else "verbatim"
+		application = build_application({ "model_latency": options.model_latency, "token_latency": options.token_latency, "concurrency": 1 })
+		application.config["PROMPT_COMPACTION"] = enabled
+		session = login(application)
+
+		def submit(session: Any, worker: int, iteration: int) -> int:
+			return session.get("/code/submit?cache=0", json={ "code": codes[iteration % len(codes)] }).status_code
+
+		result = run_scenario(mode, submit, [session], options.requests)
+		results["latency"][mode] = result
+		latency = result["latency_ms"]
+		print(f"{mode:<10} p50 {latency['p50']:>8.2f} ms  p95 {latency['p95']:>8.2f} ms  errors {result['errors']}")
+
+	return results
+
+def main(arguments: Optional[List[str]] = None) -> int:
+	options = parse_arguments(arguments)
+	results = run(options)
+	save_results(results, options.output)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
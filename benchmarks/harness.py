@@ -0,0 +1,127 @@
+import os
+import math
+import time
+import json
+import resource
+import threading
+
+from typing import Any, Callable, Dict, List, Optional
+"""
+Load generation, statistics and baseline comparison for the benchmark suite.
+
+A scenario is a callable run as operation(session, worker, iteration) by
+concurrency worker threads, each with its own session (a Flask test client or a
+requests.Session aimed at a live server), until the requested number of operations
+has been made. It returns the HTTP status code of the request it made.
+
+Functions:
+	run_scenario(name, operation, sessions, requests) -> Dict:
+		Drives one scenario and summarizes its throughput, latency and memory.
+	percentile(samples, fraction) -> float:
+		Nearest-rank percentile of sorted samples.
+	compare(results, baseline, tolerance) -> List[str]:
+		Describes every scenario whose throughput or p95 latency regressed by more
+		than tolerance (a fraction) against a baseline.
+	load_results(path) / save_results(results, path):
+		Read and write result files.
+"""
+
+Operation = Callable[[Any, int, int], int]
+
+def memory_mb() -> float:
+	"""Resident set size of this process, or its peak where /proc is unavailable."""
+	try:
+		with open("/proc/self/statm") as statm:
+			return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+	except (OSError, ValueError, IndexError):
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def percentile(samples: List[float], fraction: float) -> float:
+	if not samples:
+		return 0.0
+	index = max(0, min(len(samples) - 1, math.ceil(fraction * len(samples)) - 1))
+	return samples[index]
+
+def run_scenario(name: str, operation: Operation, sessions: List[Any], requests: int) -> Dict[str, Any]:
+	latencies: List[float] = []
+	statuses: Dict[str, int] = {}
+	lock = threading.Lock()
+	counter = iter(range(requests))
+
+	def worker(index: int) -> None:
+		session = sessions[index]
+		while True:
+			with lock:
+				iteration = next(counter, None)
+			if iteration is None:
+				return
+
+			started = time.perf_counter()
+			try:
+				status = str(operation(session, index, iteration))
+			except Exception as e:
+				print(e)
+				status = "exception"
+			elapsed = time.perf_counter() - started
+
+			with lock:
+				latencies.append(elapsed)
+				statuses[status] = statuses.get(status, 0) + 1
+
+	memory_before = memory_mb()
+	started = time.perf_counter()
+	threads = [threading.Thread(target=worker, args=(index,)) for index in range(len(sessions))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	duration = time.perf_counter() - started
+
+	latencies.sort()
+	errors = sum(count for status, count in statuses.items() if not status.startswith(("2", "3")))
+	return {
+		"scenario": name,
+		"requests": len(latencies),
+		"concurrency": len(sessions),
+		"duration_seconds": round(duration, 4),
+		"requests_per_second": round(len(latencies) / duration, 2) if duration else 0.0,
+		"latency_ms": {
+			"p50": round(percentile(latencies, 0.50) * 1000, 3),
+			"p95": round(percentile(latencies, 0.95) * 1000, 3),
+			"p99": round(percentile(latencies, 0.99) * 1000, 3),
+			"max": round((latencies[-1] if latencies else 0.0) * 1000, 3),
+		},
+		"statuses": statuses,
+		"errors": errors,
+		"memory_mb": { "before": round(memory_before, 2), "after": round(memory_mb(), 2), "peak": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2) },
+	}
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[str]:
+	regressions: List[str] = []
+	for driver, scenarios in results.get("results", {}).items():
+		for name, current in scenarios.items():
+			previous = baseline.get("results", {}).get(driver, {}).get(name)
+			if previous is None:
+				continue
+
+			if current["requests_per_second"] < previous["requests_per_second"] * (1 - tolerance):
+				regressions.append(f"{driver}/{name}: {current['requests_per_second']} req/s, baseline {previous['requests_per_second']} req/s")
+			if current["latency_ms"]["p95"] > previous["latency_ms"]["p95"] * (1 + tolerance):
+				regressions.append(f"{driver}/{name}: p95 {current['latency_ms']['p95']} ms, baseline {previous['latency_ms']['p95']} ms")
+			if current["errors"] > previous["errors"]:
+				regressions.append(f"{driver}/{name}: {current['errors']} errors, baseline {previous['errors']}")
+	return regressions
+
+def load_results(path: str) -> Optional[Dict[str, Any]]:
+	if not os.path.exists(path):
+		return None
+	with open(path) as file:
+		return json.load(file)
+
+def save_results(results: Dict[str, Any], path: str) -> None:
+	directory = os.path.dirname(path)
+	if directory:
+		os.makedirs(directory, exist_ok=True)
+	with open(path, "w") as file:
+		json.dump(results, file, indent=2, sort_keys=True)
+		file.write("\n")
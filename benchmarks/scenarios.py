@@ -0,0 +1,145 @@
+import threading
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+from flask import Flask
+from server import create_application
+from benchmarks.harness import Operation
+"""
+Benchmark scenarios and the two ways of serving them.
+
+Every scenario runs against an application built by create_application() with the
+fake model backend (so results do not depend on the network) and mongomock, unless
+a local mongod is given. Drivers:
+	testclient: Flask test clients called in-process; measures the application alone.
+	waitress: A real waitress server on a free local port, driven over HTTP with
+		keep-alive sessions; adds the WSGI server and socket costs.
+"""
+
+PASSWORD = "benchmark-password"
+
+def build_application(options: Mapping[str, Any]) -> Flask:
+	configuration: Dict[str, Any] = {
+		"TESTING": True,
+		"MODEL_BACKEND": "fake",
+		"FAKE_MODEL_LATENCY": options["model_latency"],
+		"FAKE_MODEL_LATENCY_PER_1K_TOKENS": options.get("token_latency", 0.0),
+		"RATE_LIMIT_ENABLED": False,
+		"ANALYSIS_CACHE_STORE": False,
+		# Room for every client, so hashing load is measured rather than shed with 503
+		"PASSWORD_HASH_MAX_PENDING": options["concurrency"],
+	}
+	if options.get("hash_workers") is not None:
+		configuration["PASSWORD_HASH_WORKERS"] = options["hash_workers"]
+	if options.get("hash_method"):
+		configuration["PASSWORD_HASH_METHOD"] = options["hash_method"]
+
+	if options.get("mongo_uri"):
+		configuration["MONGO_URI"] = options["mongo_uri"]
+		configuration["MONGO_DATABASE"] = options["mongo_database"]
+	else:
+		import mongomock
+		configuration["MONGO_CLIENT"] = mongomock.MongoClient()
+		# mongomock has no $text support
+		configuration["CODES_SEARCH_BACKEND"] = "memory"
+
+	application = create_application(configuration)
+	application.secret_key = "benchmark"
+
+	if options.get("mongo_uri"):
+		from server.database import get_pool
+		pool = get_pool(application)
+		pool.client.drop_database(pool.database_name)
+	return application
+
+class HttpSession:
+	"""requests.Session with the test client's get/post(path, json=...) signature."""
+
+	def __init__(self, base_url: str) -> None:
+		import requests
+		self.base_url = base_url
+		self.session = requests.Session()
+
+	def get(self, path: str, **arguments: Any) -> Any:
+		return self.session.get(self.base_url + path, **arguments)
+
+	def post(self, path: str, **arguments: Any) -> Any:
+		return self.session.post(self.base_url + path, **arguments)
+
+	def close(self) -> None:
+		self.session.close()
+
+@contextmanager
+def testclient_sessions(application: Flask, concurrency: int) -> Iterator[List[Any]]:
+	yield [application.test_client() for _ in range(concurrency)]
+
+@contextmanager
+def waitress_sessions(application: Flask, concurrency: int) -> Iterator[List[Any]]:
+	from waitress.server import create_server
+
+	server = create_server(application, host="127.0.0.1", port=0, threads=concurrency + 2)
+	thread = threading.Thread(target=server.run, daemon=True)
+	thread.start()
+
+	sessions = [HttpSession(f"http://127.0.0.1:{server.effective_port}") for _ in range(concurrency)]
+	try:
+		yield sessions
+	finally:
+		for session in sessions:
+			session.close()
+		# Stop the request threads first (they wake the loop when done), then close
+		# every socket from the loop's own thread so it ends instead of selecting
+		# on descriptors closed under it
+		server.task_dispatcher.shutdown()
+		server.trigger.pull_trigger(lambda: server.asyncore.close_all(server._map))
+		thread.join(5)
+
+DRIVERS = {
+	"testclient": testclient_sessions,
+	"waitress": waitress_sessions,
+}
+
+def prepare(sessions: List[Any], run: str) -> None:
+	"""Register and log in one user per session, outside of the measured scenarios."""
+	for index, session in enumerate(sessions):
+		username = f"bench-{run}-{index}"
+		session.post("/register", json={ "username": username, "password": PASSWORD })
+		session.post("/login", json={ "username": username, "password": PASSWORD })
+		session.get("/code/submit", json={ "code": "shared_snippet = 1" })
+
+def scenarios(run: str) -> Dict[str, Operation]:
+	def register(session: Any, worker: int, iteration: int) -> int:
+		return session.post("/register", json={ "username": f"register-{run}-{worker}-{iteration}", "password": PASSWORD }).status_code
+
+	def login(session: Any, worker: int, iteration: int) -> int:
+		return session.post("/login", json={ "username": f"bench-{run}-{worker}", "password": PASSWORD }).status_code
+
+	def submit(session: Any, worker: int, iteration: int) -> int:
+		return session.get("/code/submit", json={ "code": f"value_{worker}_{iteration} = {iteration}" }).status_code
+
+	def submit_cached(session: Any, worker: int, iteration: int) -> int:
+		return session.get("/code/submit", json={ "code": "shared_snippet = 1" }).status_code
+
+	def all_codes(session: Any, worker: int, iteration: int) -> int:
+		return session.get("/code/all?limit=50").status_code
+
+	def search(session: Any, worker: int, iteration: int) -> int:
+		return session.get("/code/search?q=analysis&limit=20").status_code
+
+	return {
+		"register": register,
+		"login": login,
+		"submit": submit,
+		"submit_cached": submit_cached,
+		"all": all_codes,
+		"search": search,
+	}
+
+def select(names: Optional[List[str]], run: str) -> Dict[str, Operation]:
+	available = scenarios(run)
+	if not names:
+		return available
+	unknown = [name for name in names if name not in available]
+	if unknown:
+		raise ValueError(f"Unknown scenario(s): {', '.join(unknown)}")
+	return { name: available[name] for name in names }
@@ -11,20 +11,39 @@ def create_application(test_configuration: Optional[Mapping[str, Any]] = None) -
 	test_configuration : Optional[Mapping] or None
 		If provided, this mapping is loaded into the application's configuration
 		using Flask.config.from_mapping(), which is useful for tests to supply
-		deterministic settings. If None, the application will attempt to load
-		configuration from the instance file "config.py" via
-		Flask.config.from_pyfile("config.py", silent=True). Both loading paths use
-		silent=True so missing files or keys do not raise errors.
+		deterministic settings. If None, the configuration is loaded, each source
+		overriding the previous one, from the instance file "config.py" via
+		Flask.config.from_pyfile("config.py", silent=True), from the file named by
+		the SERVER_SETTINGS environment variable, if any, and from environment
+		variables prefixed with FLASK_ via Flask.config.from_prefixed_env() (e.g.
+		FLASK_MONGO_URI, or FLASK_CODES_PAGE_SIZE=100 with values parsed as JSON).
+		Missing files do not raise errors.
 	Returns
 	-------
 	Flask
 		A configured Flask application. The returned application has:
 		- instance_relative_config set to True,
 		- its instance folder created on disk (os.makedirs(..., exist_ok=True)),
-		- a simple test route registered at "/initial" that returns {"message": "hello world"}.
+		- a simple test route registered at "/initial" that returns {"message": "hello world"},
+		- request, MongoDB and model call metrics served on "/metrics" (see server.metrics),
+		- a shared MongoDB connection pool reachable through server.database.get_database(),
+		- an analysis cache reachable through server.cache.get_cache(),
+		- a codes writer, optionally write-behind, reachable through server.writer.get_writer(),
+		- a search backend for "/code/search" reachable through server.search.get_search(),
+		- a background job queue reachable through server.jobs.get_jobs(),
+		- a password hashing pool reachable through server.hashing.get_hasher(),
+		- a model backend reachable through server.model.get_model(),
+		- a latency-budgeted model router reachable through server.routing.get_router(),
+		- a call coalescer reachable through server.singleflight.get_flights(),
+		- a model call rate limiter reachable through server.ratelimit.get_limiter(),
+		- a "/ready" readiness route answering 503 until server.health.warmup() ran.
 	Side effects
 	------------
 	- Ensures the application's instance folder exists by creating it if necessary.
+	- Creates the process-wide MongoDB pool, pings the server once unless TESTING
+		(see MONGO_HEALTH_CHECK) and registers the pool to be closed at exit.
+	- Creates the declared MongoDB indexes unless TESTING (see MONGO_ENSURE_INDEXES)
+		and registers the "create-indexes" CLI command.
 	- Registers a lightweight "/initial" route useful for smoke tests.
 	Notes
 	-----
@@ -39,13 +58,44 @@ def create_application(test_configuration: Optional[Mapping[str, Any]] = None) -
 
 	if test_configuration is not None:
 		application.config.from_mapping(test_configuration, silent=True)
+	else:
+		application.config.from_pyfile("config.py", silent=True)
+		application.config.from_envvar("SERVER_SETTINGS", silent=True)
+		application.config.from_prefixed_env()
 	
 	# Ensure the instance folder exists
 	os.makedirs(application.instance_path, exist_ok=True)
 	
+	from .metrics import init_metrics
+	from .database import init_database
+	from .indexes import init_indexes
+	from .cache import init_cache
+	from .writer import init_writer
+	from .search import init_search
+	from .jobs import init_jobs
+	from .hashing import init_hashing
+	from .model import init_model
+	from .routing import init_routing
+	from .singleflight import init_singleflight
+	from .ratelimit import init_ratelimit
+	from .health import init_health
 	from .routes_auth import routes_blueprint
 	from .routes_code import code_blueprint
 
+	init_metrics(application)
+	init_database(application)
+	init_indexes(application)
+	init_cache(application)
+	init_writer(application)
+	init_search(application)
+	init_jobs(application)
+	init_hashing(application)
+	init_model(application)
+	init_routing(application)
+	init_singleflight(application)
+	init_ratelimit(application)
+	init_health(application)
+
 	application.register_blueprint(routes_blueprint, url_prefix="/")
 	application.register_blueprint(code_blueprint, url_prefix="/code")
 	
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+
+from typing import Any, Dict, List, Optional
+from flask import Flask
+from server import create_application
+from server.health import warmup
+from server.writer import get_writer
+"""
+Production entry point.
+
+	python -m server [--host 0.0.0.0] [--port 8080] [--threads 8] [--workers 4]
+		[--connection-limit 1000] [--backlog 2048] [--channel-timeout 120]
+
+Serves create_application() with waitress. Every option can also be given as an
+environment variable (SERVE_HOST, SERVE_PORT, SERVE_THREADS, SERVE_WORKERS,
+SERVE_CONNECTION_LIMIT, SERVE_BACKLOG, SERVE_CHANNEL_TIMEOUT); command line options
+win. The application configuration comes from instance/config.py, the file named by
+SERVER_SETTINGS and FLASK_-prefixed environment variables (see create_application()).
+
+With --workers above 1 the application is created and warmed up once in a parent
+process, which binds the socket and forks the workers (POSIX only). The workers
+share that socket, re-run the per-process part of the warmup (MongoDB and model
+clients are never shared across a fork) and are restarted if they die. The socket
+only starts listening when the first worker has warmed up and starts serving, so
+connections never queue while every worker is still cold. SIGTERM or SIGINT stops
+every worker.
+
+On SIGTERM or SIGINT a process stops serving and stores any codes records still
+waiting in its write-behind buffer (see server.writer) before exiting.
+
+A process only starts accepting connections once its warmup has finished, and
+/ready reports 503 until then.
+"""
+
+def option(name: str, default: Any, cast: type = int) -> Any:
+	value = os.getenv(f"SERVE_{name}")
+	return cast(value) if value is not None else default
+
+def parse_arguments(arguments: Optional[List[str]] = None) -> argparse.Namespace:
+	parser = argparse.ArgumentParser(prog="python -m server", description="Serve the application with waitress.")
+	parser.add_argument("--host", default=option("HOST", "0.0.0.0", str), help="Interface to listen on.")
+	parser.add_argument("--port", type=int, default=option("PORT", 8080), help="Port to listen on.")
+	parser.add_argument("--threads", type=int, default=option("THREADS", 8), help="Request threads per worker.")
+	parser.add_argument("--workers", type=int, default=option("WORKERS", 1), help="Worker processes forked after preloading.")
+	parser.add_argument("--connection-limit", type=int, default=option("CONNECTION_LIMIT", 1000), help="Open connections per worker before new ones wait.")
+	parser.add_argument("--backlog", type=int, default=option("BACKLOG", 2048), help="Listen backlog of the socket.")
+	parser.add_argument("--channel-timeout", type=int, default=option("CHANNEL_TIMEOUT", 120), help="Seconds an idle connection is kept open.")
+	return parser.parse_args(arguments)
+
+def serve_settings(options: argparse.Namespace) -> Dict[str, Any]:
+	return {
+		"threads": options.threads,
+		"connection_limit": options.connection_limit,
+		"backlog": options.backlog,
+		"channel_timeout": options.channel_timeout,
+		"ident": "server",
+	}
+
+def report(checks: Dict[str, Any]) -> None:
+	print(f"[{os.getpid()}] warmed up in {checks['seconds']}s: mongo={checks['mongo']} model={checks['model']} synthetic_request={checks['synthetic_request']}", flush=True)
+	for problem in checks["index_problems"]:
+		print(f"[{os.getpid()}] index problem: {problem}", flush=True)
+
+# Waitress returns from serve() on SystemExit, which leaves room to drain the buffers
+def exit_on_signal(signum: int, frame: Any) -> None:
+	raise SystemExit(0)
+
+def serve_single(application: Flask, options: argparse.Namespace) -> None:
+	from waitress import serve
+
+	report(warmup(application))
+	signal.signal(signal.SIGTERM, exit_on_signal)
+	try:
+		serve(application, host=options.host, port=options.port, **serve_settings(options))
+	finally:
+		get_writer(application).close()
+
+def serve_workers(application: Flask, options: argparse.Namespace) -> None:
+	from waitress import serve
+
+	# Preload: imports, configuration and caches are paid once and shared copy-on-write
+	report(warmup(application))
+
+	# Bound but not listening: waitress listens once a warm worker starts serving
+	listener = socket.socket(socket.AF_INET6 if ":" in options.host else socket.AF_INET, socket.SOCK_STREAM)
+	listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listener.bind((options.host, options.port))
+	listener.set_inheritable(True)
+	print(f"[{os.getpid()}] bound to {options.host}:{options.port} with {options.workers} workers", flush=True)
+
+	def spawn() -> int:
+		pid = os.fork()
+		if pid == 0:
+			code = 0
+			try:
+				signal.signal(signal.SIGTERM, exit_on_signal)
+				signal.signal(signal.SIGINT, exit_on_signal)
+				report(warmup(application))
+				serve(application, sockets=[listener], **serve_settings(options))
+			except SystemExit:
+				pass
+			except BaseException as e:
+				print(e, flush=True)
+				code = 1
+			finally:
+				# os._exit() skips atexit handlers
+				get_writer(application).close()
+				os._exit(code)
+		return pid
+
+	workers = { spawn() for _ in range(options.workers) }
+	stopping = False
+
+	def stop(signum: int, frame: Any) -> None:
+		nonlocal stopping
+		stopping = True
+		for pid in workers:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+
+	while workers:
+		try:
+			pid, status = os.wait()
+		except ChildProcessError:
+			break
+		except InterruptedError:
+			continue
+
+		workers.discard(pid)
+		if not stopping:
+			print(f"[{os.getpid()}] worker {pid} exited with status {status}, restarting", flush=True)
+			# Avoid a tight loop when workers die straight away
+			time.sleep(1)
+			workers.add(spawn())
+
+	listener.close()
+
+def main(arguments: Optional[List[str]] = None) -> int:
+	options = parse_arguments(arguments)
+	application = create_application()
+
+	if options.workers > 1 and hasattr(os, "fork"):
+		serve_workers(application, options)
+	else:
+		serve_single(application, options)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
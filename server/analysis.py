@@ -0,0 +1,423 @@
+import re
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from flask import current_app
+from server.cache import cache_key, get_cache
+from server.chunking import Chunk, estimate_tokens, split_code, split_units
+from server.compaction import COMPACTION_NOTE, COMPACTION_STEPS, COMPACTION_VERSION, Compaction, compact, compaction_settings
+from server.metrics import get_metrics, stage
+from server.model import get_model
+from server.ratelimit import get_limiter
+from server.routing import MODEL_NAME, Deadline, Routed, get_router, model_path
+from server.singleflight import FlightTimeout, get_async_flights, get_flights
+from server.static_analysis import static_answer
+"""
+Code analysis pipeline shared by the code routes.
+
+Submissions above CHUNK_THRESHOLD_TOKENS (default 4000 estimated tokens) are split
+into chunks of at most CHUNK_TOKEN_BUDGET (default 2000) tokens along top-level
+definitions, analyzed CHUNK_PARALLELISM (default 4) at a time and merged into one
+analysis with a "Lines a-b" heading per chunk. Smaller submissions take a single call.
+
+The code of every prompt is compacted first (see server.compaction) when that saves
+more tokens than the note explaining the compaction to the model costs; otherwise
+it is sent verbatim.
+
+Every prompt is routed to a model within the deadline of its submission (see
+server.routing). Analyses are cached under the least capable model that took part
+in them, so a fallback model's answer never passes for the primary model's.
+
+Functions:
+	build_prompt(code) -> str / build_chunk_prompt(chunk) -> str:
+		Build the prompt sent to the model for a snippet or for one chunk of a file.
+	compaction_report(code, chunks) -> Dict | None:
+		Token savings of the compacted prompts of a submission (or of the given
+		chunks of it), None when every prompt was sent verbatim.
+	generate_analysis(code, model, timeout) -> str | None:
+		Calls the model and returns the analysis text, or None when it returned nothing.
+	generate_chunk_analysis(chunk, model, timeout) -> str | None:
+		Same as generate_analysis for one chunk of a larger file.
+	stream_analysis(code, model) -> Iterator[str]:
+		Yields the analysis text piece by piece as the model generates it. Closing the
+		iterator closes the upstream stream.
+	lookup_cached(code, model) -> str | None / store_cached(code, text, model) -> None:
+		Read and write the analysis cache entry of a snippet, for the primary model
+		unless another one is given.
+	analyze_code(code, use_cache, deadline) -> Analysis:
+		Returns the analysis of a snippet, served from the analysis cache when possible
+		and shared with identical concurrent submissions (see server.singleflight).
+	analyze_incremental(code, previous_units, use_cache, deadline) -> Analysis:
+		Re-analyzes only the top-level units that changed since a previous submission.
+	analyze_code_async(code, use_cache, deadline) -> Analysis:
+		Coroutine version of analyze_code() for single-call submissions, used by the
+		async serving mode.
+	deadline_fallback(code, analysis, report, deadline, use_cache) -> Analysis:
+		Answers from the cache or the static report a submission the deadline left
+		without an analysis.
+	route_record(analysis, deadline) -> Dict:
+		The "route" field stored with a submission.
+"""
+
+# Bump whenever build_prompt changes so cached analyses of the old prompt are ignored
+PROMPT_VERSION = "1"
+# "line 12", "lines 3-5", "Lines 7, 9 and 11" in an analysis
+LINE_REFERENCE = re.compile(r"\b(lines?\s+)(\d+(?:\s*(?:-|–|,|and|to)\s*\d+)*)", re.IGNORECASE)
+NOTE_TOKENS = estimate_tokens(COMPACTION_NOTE + "\n\n")
+
+@dataclass
+class Analysis:
+	text: str | None
+	cached: bool = False
+	# One entry per chunk when the submission was split, with its line range
+	chunks: Optional[List[Dict[str, Any]]] = None
+	# Per-unit analyses to store for later incremental submissions
+	units: Optional[List[Dict[str, Any]]] = None
+	# Which units of an incremental submission were reused or analyzed afresh
+	reuse: Optional[Dict[str, List[str]]] = None
+	# True when the result was shared with a concurrent identical submission
+	coalesced: bool = False
+	# Token savings of prompt compaction, when the prompts were compacted
+	compaction: Optional[Dict[str, Any]] = None
+	# How the analysis was served (see server.routing) and the model calls behind it
+	path: Optional[str] = None
+	routed: List[Routed] = field(default_factory=list)
+
+	@property
+	def timed_out(self) -> bool:
+		return any(result.timed_out for result in self.routed)
+
+def prompt_version() -> str:
+	settings = compaction_settings(current_app.config)
+	if settings is None:
+		return PROMPT_VERSION
+	return f"{PROMPT_VERSION}+compact{COMPACTION_VERSION}:{','.join(settings['steps'])}:{settings['comment_length']}:{settings['dedupe_min_lines']}"
+
+def compact_code(code: str, first_line: int = 1) -> Optional[Compaction]:
+	"""Compaction of code for a prompt, or None when it is disabled or would not pay for its note."""
+	settings = compaction_settings(current_app.config)
+	if settings is None:
+		return None
+	compaction = compact(code, first_line, **settings)
+	return compaction if compaction.original_tokens - compaction.tokens > NOTE_TOKENS else None
+
+def prompt_code(code: str, first_line: int = 1) -> str:
+	compaction = compact_code(code, first_line)
+	return code if compaction is None else f"{COMPACTION_NOTE}\n\n{compaction.text}"
+
+def build_prompt(code: str) -> str:
+	return f"Analyze:\n\n{prompt_code(code)}"
+
+def build_chunk_prompt(chunk: Chunk) -> str:
+	return f"Analyze lines {chunk.start_line}-{chunk.end_line} of a larger file:\n\n{prompt_code(chunk.text, chunk.start_line)}"
+
+def compaction_report(code: str, chunks: Optional[List[Chunk]] = None) -> Optional[Dict[str, Any]]:
+	pieces = [(chunk.text, chunk.start_line) for chunk in chunks] if chunks is not None else [(code, 1)]
+	compactions = [compaction for compaction in (compact_code(text, first_line) for text, first_line in pieces) if compaction is not None]
+	if not compactions:
+		return None
+
+	original_tokens = sum(compaction.original_tokens for compaction in compactions)
+	prompt_tokens = sum(compaction.tokens + NOTE_TOKENS for compaction in compactions)
+	get_metrics().inc("prompt_compaction_saved_tokens_total", original_tokens - prompt_tokens)
+	return {
+		"original_tokens": original_tokens,
+		"prompt_tokens": prompt_tokens,
+		"saved_tokens": original_tokens - prompt_tokens,
+		"steps": [step for step in COMPACTION_STEPS if any(step in compaction.applied for compaction in compactions)],
+	}
+
+def remaining_timeout(timeout: Optional[float], requested: float) -> Optional[float]:
+	"""What is left of timeout after waiting for a model slot since requested."""
+	return None if timeout is None else max(0.001, timeout - (time.perf_counter() - requested))
+
+def call_model(model: str, prompt: str, timeout: Optional[float] = None) -> str | None:
+	metrics = get_metrics()
+	requested = time.perf_counter()
+	with get_limiter().model_slot(timeout):
+		started = time.perf_counter()
+		text, outcome = None, "error"
+		try:
+			text = get_model().generate(model, prompt, remaining_timeout(timeout, requested))
+			outcome = "ok" if text else "empty"
+			return text
+		finally:
+			metrics.record_model_call(model, time.perf_counter() - started, outcome, prompt, text or "")
+
+async def call_model_async(model: str, prompt: str, timeout: Optional[float] = None) -> str | None:
+	metrics = get_metrics()
+	backend = get_model()
+	requested = time.perf_counter()
+	async with get_limiter().model_slot_async(timeout):
+		started = time.perf_counter()
+		text, outcome = None, "error"
+		try:
+			if hasattr(backend, "agenerate"):
+				text = await backend.agenerate(model, prompt, remaining_timeout(timeout, requested))
+			else:
+				text = await asyncio.to_thread(backend.generate, model, prompt, remaining_timeout(timeout, requested))
+			outcome = "ok" if text else "empty"
+			return text
+		finally:
+			metrics.record_model_call(model, time.perf_counter() - started, outcome, prompt, text or "")
+
+def generate_analysis(code: str, model: str = MODEL_NAME, timeout: Optional[float] = None) -> str | None:
+	return call_model(model, build_prompt(code), timeout)
+
+def generate_chunk_analysis(chunk: Chunk, model: str = MODEL_NAME, timeout: Optional[float] = None) -> str | None:
+	return call_model(model, build_chunk_prompt(chunk), timeout)
+
+def stream_analysis(code: str, model: Optional[str] = None) -> Iterator[str]:
+	# Closing this generator abandons the HTTP response of the upstream generation
+	metrics = get_metrics()
+	model = model or get_router().primary
+	prompt = build_prompt(code)
+	with get_limiter().model_slot():
+		started = time.perf_counter()
+		pieces: List[str] = []
+		outcome = "error"
+		try:
+			for piece in get_model().generate_stream(model, prompt):
+				pieces.append(piece)
+				yield piece
+			outcome = "ok" if pieces else "empty"
+		except GeneratorExit:
+			outcome = "abandoned"
+			raise
+		finally:
+			metrics.record_model_call(model, time.perf_counter() - started, outcome, prompt, "".join(pieces))
+
+def lookup_cached(code: str, model: Optional[str] = None) -> str | None:
+	with stage("cache_lookup"):
+		return get_cache().get(cache_key(code, model or get_router().primary, prompt_version()))
+
+def store_cached(code: str, text: str, model: Optional[str] = None) -> None:
+	get_cache().set(cache_key(code, model or get_router().primary, prompt_version()), text)
+
+def weakest_model(routed: List[Routed]) -> Optional[str]:
+	"""The least capable model that answered any of the prompts."""
+	models = [result.model for result in routed if result.model]
+	return next((model for model in reversed(get_router().models) if model in models), None)
+
+def route_analysis(code: str, deadline: Deadline) -> Routed:
+	return get_router().run(estimate_tokens(build_prompt(code)), deadline, lambda model, timeout: generate_analysis(code, model, timeout))
+
+def plan_chunks(code: str) -> Optional[List[Chunk]]:
+	"""Return the chunks of a submission too large for one call, or None for the single-call path."""
+	configuration = current_app.config
+	if estimate_tokens(code) <= configuration.get("CHUNK_THRESHOLD_TOKENS", 4000):
+		return None
+
+	chunks = split_code(code, configuration.get("CHUNK_TOKEN_BUDGET", 2000))
+	return chunks if len(chunks) > 1 else None
+
+def analyze_chunk(chunk: Chunk, use_cache: bool, deadline: Deadline) -> Tuple[str | None, bool, Routed]:
+	"""Analyze one chunk, cached on its own prompt (which carries its line range)."""
+	router = get_router()
+	prompt = build_chunk_prompt(chunk)
+	if use_cache:
+		cached = get_cache().get(cache_key(prompt, router.primary, prompt_version()))
+		if cached is not None:
+			return cached, True, Routed()
+
+	try:
+		routed = router.run(estimate_tokens(prompt), deadline, lambda model, timeout: generate_chunk_analysis(chunk, model, timeout))
+	except Exception as e:
+		print(e)
+		return None, False, Routed()
+
+	if routed.text:
+		get_cache().set(cache_key(prompt, routed.model, prompt_version()), routed.text)
+	return routed.text, False, routed
+
+def analyze_concurrently(chunks: List[Chunk], use_cache: bool, deadline: Deadline) -> List[Tuple[str | None, bool, Routed]]:
+	application = current_app._get_current_object()
+
+	def analyze(chunk: Chunk) -> Tuple[str | None, bool, Routed]:
+		with application.app_context():
+			return analyze_chunk(chunk, use_cache, deadline)
+
+	parallelism = max(1, min(application.config.get("CHUNK_PARALLELISM", 4), len(chunks) or 1))
+	with ThreadPoolExecutor(max_workers=parallelism) as executor:
+		return list(executor.map(analyze, chunks))
+
+def merge_sections(chunks: List[Chunk], texts: List[str | None]) -> str:
+	return "\n\n".join(
+		f"### {chunk.label()}\n\n{text or 'Analysis unavailable for this part.'}"
+		for chunk, text in zip(chunks, texts)
+	)
+
+def generated_path(results: List[Tuple[str | None, bool, Routed]]) -> str:
+	return "cache" if all(cached for _, cached, _ in results) else model_path([routed for _, _, routed in results])
+
+def analyze_chunks(chunks: List[Chunk], use_cache: bool, deadline: Deadline) -> Analysis:
+	results = analyze_concurrently(chunks, use_cache, deadline)
+	routed = [result for _, _, result in results]
+
+	if not any(text for text, _, _ in results):
+		return Analysis(None, routed=routed)
+
+	details = [
+		{ "start_line": chunk.start_line, "end_line": chunk.end_line, "names": chunk.names, "cached": cached, "analyzed": bool(text), "model": result.model }
+		for chunk, (text, cached, result) in zip(chunks, results)
+	]
+	return Analysis(
+		merge_sections(chunks, [text for text, _, _ in results]),
+		cached=all(cached for _, cached, _ in results),
+		chunks=details,
+		path=generated_path(results),
+		routed=routed
+	)
+
+def shift_line_references(text: str, first_line: int, last_line: int, offset: int) -> str:
+	"""Move the line references of an analysis of lines first_line-last_line by offset; other lines are left alone."""
+	def shift(number: re.Match[str]) -> str:
+		line = int(number.group())
+		return str(line + offset) if first_line <= line <= last_line else number.group()
+
+	return LINE_REFERENCE.sub(lambda reference: reference.group(1) + re.sub(r"\d+", shift, reference.group(2)), text)
+
+def analyze_incremental(code: str, previous_units: List[Dict[str, Any]], use_cache: bool = True, deadline: Optional[Deadline] = None) -> Analysis:
+	"""
+	Analyze only the units that changed since a previous submission.
+
+	Units are matched by key; a unit whose digest is unchanged reuses the analysis
+	stored with the previous submission, with its line references moved along with
+	the unit, and every other unit goes to the model. Falls back to analyze_code()
+	for code that cannot be split into units.
+	"""
+	deadline = deadline or get_router().deadline()
+	units = split_units(code)
+	if not units:
+		return analyze_code(code, use_cache, deadline)
+
+	previous = { unit["key"]: unit for unit in previous_units if unit.get("analysis") }
+	texts: List[str | None] = []
+	fresh: List[int] = []
+	for index, unit in enumerate(units):
+		match = previous.get(unit.key)
+		if match is not None and match.get("digest") == unit.digest:
+			# The digest ignores position, so a unit that moved keeps its analysis but not its line numbers
+			offset = unit.code_start_line - match.get("code_start_line", match.get("start_line", unit.start_line))
+			texts.append(shift_line_references(match["analysis"], match.get("start_line", 1), match.get("end_line", unit.end_line), offset) if offset else match["analysis"])
+		else:
+			texts.append(None)
+			fresh.append(index)
+
+	results = analyze_concurrently([units[index] for index in fresh], use_cache, deadline)
+	for index, (text, _, _) in zip(fresh, results):
+		texts[index] = text
+	routed = [result for _, _, result in results]
+
+	if not any(texts):
+		return Analysis(None, routed=routed)
+
+	current_keys = { unit.key for unit in units }
+	reanalyzed = set(fresh)
+	return Analysis(
+		merge_sections(units, texts),
+		cached=not fresh,
+		compaction=compaction_report(code, [units[index] for index in fresh]),
+		path=generated_path(results),
+		routed=routed,
+		units=[
+			{ "key": unit.key, "digest": unit.digest, "start_line": unit.start_line, "end_line": unit.end_line, "code_start_line": unit.code_start_line, "analysis": text }
+			for unit, text in zip(units, texts)
+		],
+		reuse={
+			"reused": [unit.key for index, unit in enumerate(units) if index not in reanalyzed],
+			"analyzed": [units[index].key for index in fresh if texts[index]],
+			"failed": [units[index].key for index in fresh if not texts[index]],
+			"removed": [key for key in previous if key not in current_keys]
+		}
+	)
+
+def analyze_code(code: str, use_cache: bool = True, deadline: Optional[Deadline] = None) -> Analysis:
+	router = get_router()
+	deadline = deadline or router.deadline()
+	if use_cache:
+		cached = lookup_cached(code)
+		if cached is not None:
+			return Analysis(cached, cached=True, path="cache")
+
+	def generate() -> Analysis:
+		chunks = plan_chunks(code)
+		if chunks is None:
+			routed = route_analysis(code, deadline)
+			analysis = Analysis(routed.text, compaction=compaction_report(code), path=model_path([routed]), routed=[routed])
+		else:
+			analysis = replace(analyze_chunks(chunks, use_cache, deadline), compaction=compaction_report(code, chunks))
+
+		# A merged analysis missing some chunks is not worth replaying
+		if analysis.text and all(chunk["analyzed"] for chunk in analysis.chunks or []):
+			store_cached(code, analysis.text, weakest_model(analysis.routed))
+
+		return analysis
+
+	# Another process holding the lease publishes its text with the lease, whichever
+	# model answered and even with no shared cache tier, and caches it when it can
+	def lookup() -> Optional[Analysis]:
+		store = get_cache().store
+		text = store.get(key) if store is not None else None
+		return Analysis(text, cached=True, path="cache") if text else None
+
+	def restore(text: str) -> Analysis:
+		return Analysis(text, cached=True, path="cache")
+
+	# Identical concurrent submissions share a single generation, waited for until the
+	# deadline leaves only the time its fallbacks need
+	key = cache_key(code, router.primary, prompt_version())
+	try:
+		analysis, shared = get_flights().do(key, generate, lookup, deadline.remaining() - router.reserve, lambda analysis: analysis.text, restore)
+	except FlightTimeout:
+		return Analysis(None, coalesced=True, routed=[Routed(timed_out=True)])
+	return replace(analysis, coalesced=True) if shared else analysis
+
+async def analyze_code_async(code: str, use_cache: bool = True, deadline: Optional[Deadline] = None) -> Analysis:
+	"""analyze_code() for the async serving mode, for submissions that fit a single call."""
+	router = get_router()
+	deadline = deadline or router.deadline()
+	# Cache tiers may reach MongoDB through the blocking driver, so they run on a thread
+	if use_cache:
+		cached = await asyncio.to_thread(lookup_cached, code)
+		if cached is not None:
+			return Analysis(cached, cached=True, path="cache")
+
+	async def generate() -> Analysis:
+		prompt = build_prompt(code)
+		routed = await router.arun(estimate_tokens(prompt), deadline, lambda model, timeout: call_model_async(model, prompt, timeout))
+		if routed.text:
+			await asyncio.to_thread(store_cached, code, routed.text, routed.model)
+		return Analysis(routed.text, compaction=compaction_report(code), path=model_path([routed]), routed=[routed])
+
+	try:
+		analysis, shared = await get_async_flights().do(cache_key(code, router.primary, prompt_version()), generate, deadline.remaining() - router.reserve)
+	except FlightTimeout:
+		return Analysis(None, coalesced=True, routed=[Routed(timed_out=True)])
+	return replace(analysis, coalesced=True) if shared else analysis
+
+def deadline_fallback(code: str, analysis: Analysis, report: Dict[str, Any], deadline: Deadline, use_cache: bool = True) -> Analysis:
+	"""Answer a submission the deadline left without an analysis from the cache or its static report."""
+	router = get_router()
+	if analysis.text or not analysis.timed_out:
+		return analysis
+
+	# An analysis by any routed model beats none, unless the client refused cached answers
+	if use_cache and router.fallback_cached:
+		for model in router.models:
+			cached = lookup_cached(code, model)
+			if cached is not None:
+				return replace(analysis, text=cached, cached=True, path="fallback_cache")
+
+	answer = static_answer(report) if router.fallback_static else None
+	if answer is not None:
+		return replace(analysis, text=answer, path="fallback_static")
+
+	router.exceeded()
+	return analysis
+
+def route_record(analysis: Analysis, deadline: Deadline) -> Dict[str, Any]:
+	return get_router().record(analysis.path or model_path(analysis.routed), deadline, analysis.routed)
@@ -0,0 +1,330 @@
+import io
+import sys
+import asyncio
+import threading
+
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+from flask import Flask, Response, current_app, request, session
+from pymongo import DESCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from server import create_application
+from server.analysis import Analysis, analyze_code_async, deadline_fallback, plan_chunks, route_record
+from server.database import get_async_pool, init_async_database
+from server.hashing import HashingBusy, get_hasher
+from server.indexes import get_async_collection
+from server.metrics import stage
+from server.routes_code import analysis_payload, flag, listing_query, page_limit, page_payload, use_cache
+from server.routing import get_router
+from server.static_analysis import analyze_static, local_answer
+from server.writer import get_writer
+"""
+Async serving mode.
+
+create_asgi_application() builds the usual application with create_application()
+and wraps it in an ASGI application, so one event loop per worker process serves
+every request:
+
+	uvicorn --factory server.asgi:create_asgi_application --workers 4
+
+The routes that spend their time waiting on I/O run as coroutines on that loop,
+with pymongo's AsyncMongoClient and the async model client: /register, /login,
+/code/all (paged) and /code/submit for submissions analyzed in a single model call,
+so many slow generations wait concurrently without holding a thread each. Password
+hashing and the analysis cache tiers are handed to threads. Every other request
+(streams, batches, jobs, chunked or incremental analyses, NDJSON exports...) is
+served by the WSGI application on a thread, so all endpoints keep their exact
+behavior and JSON contracts.
+
+Both paths go through the same before/after request hooks, error handlers and
+session cookie as the WSGI application.
+"""
+
+AsyncView = Callable[[], Awaitable[Any]]
+
+async def register_user() -> Tuple[Dict[str, str], int]:
+	data = request.get_json()
+	username = data.get("username")
+	password = data.get("password")
+
+	if not username or not password:
+		return ({"error": "Missing username or password"}, 400)
+
+	users = await get_async_collection("users")
+	with stage("password_hash"):
+		hashed_pw = await asyncio.to_thread(get_hasher().hash, password)
+	try:
+		with stage("database_write"):
+			await users.insert_one({ "username": username, "password": hashed_pw })
+	except DuplicateKeyError:
+		return ({"error": "Username already exists"}, 409)
+
+	return ({"message": "User registered successfully"}, 201)
+
+async def login_user() -> Tuple[Dict[str, str], int]:
+	data = request.get_json()
+	username = data.get("username")
+	password = data.get("password")
+
+	if not username or not password:
+		return ({"error": "Missing username or password"}, 400)
+
+	users = await get_async_collection("users")
+	with stage("database_read"):
+		user = await users.find_one({"username": username}, {"password": 1})
+	if not user:
+		return ({"error": "User does not exist"}, 404)
+
+	hasher = get_hasher()
+	with stage("password_verify"):
+		verified = await asyncio.to_thread(hasher.verify, user.get("password"), password)
+	if not verified:
+		return ({"error": "Incorrect password"}, 401)
+
+	if hasher.needs_rehash(user["password"]):
+		try:
+			rehashed = await asyncio.to_thread(hasher.hash, password)
+			await users.update_one({ "_id": user["_id"], "password": user["password"] }, { "$set": { "password": rehashed } })
+		except (HashingBusy, PyMongoError) as e:
+			print(e)
+
+	session["user"] = str(user["_id"])
+	session["logged_in"] = True
+	return ({"message": "User login successfully"}, 200)
+
+def single_call_submission() -> bool:
+	if any(flag(name) for name in ("static_only", "async", "incremental")):
+		return False
+
+	data = request.get_json(silent=True)
+	if not isinstance(data, dict) or data.get("previous_id"):
+		return False
+
+	code = data.get("code", "")
+	return isinstance(code, str) and plan_chunks(code) is None
+
+async def submit_code() -> Tuple[Dict[str, Any], int]:
+	router = get_router()
+	deadline = router.deadline(request.headers.get(router.header))
+	data = request.get_json()
+	code = data.get("code", "")
+
+	if not code:
+		return ({"error": "Code provided is empty"}, 400)
+
+	with stage("static_analysis"):
+		report = analyze_static(code, current_app.config, data.get("language", "python"))
+
+	answer = local_answer(report, current_app.config)
+	if answer is not None:
+		analysis = Analysis(answer, path="local")
+	else:
+		analysis = await analyze_code_async(code, use_cache=use_cache(), deadline=deadline)
+
+	if analysis.timed_out:
+		analysis = await asyncio.to_thread(deadline_fallback, code, analysis, report, deadline, use_cache())
+	if not analysis.text:
+		if analysis.timed_out:
+			return ({"error": "Model did not answer within the deadline"}, 504)
+		return ({"error": "Model did not respond with any content"}, 503)
+
+	document = { "code": code, "response": analysis.text, "user": session["user"], "route": route_record(analysis, deadline) }
+	writer = get_writer()
+	if writer.enabled:
+		# Waits for room in the buffer off the loop; WriteBufferFull becomes a 503
+		message_id = await asyncio.to_thread(writer.submit, document)
+		return (analysis_payload(analysis, str(message_id), report, answer is not None), 200)
+
+	codes = await get_async_collection("codes")
+	if not writer.write_concern.is_server_default:
+		codes = codes.with_options(write_concern=writer.write_concern)
+	with stage("database_write"):
+		insert_response = await codes.insert_one(document)
+
+	if writer.write_concern.acknowledged and not insert_response.acknowledged:
+		return ({"error": "Internal Server Error"}, 500)
+
+	return (analysis_payload(analysis, str(insert_response.inserted_id), report, answer is not None), 200)
+
+async def get_codes() -> Tuple[Dict[str, Any], int]:
+	listing = listing_query()
+	if listing is None:
+		return ({"error": "Invalid cursor"}, 400)
+	query, projection = listing
+
+	limit = page_limit()
+	codes = await get_async_collection("codes")
+	documents = await codes.find(query, projection).sort("_id", DESCENDING).limit(limit + 1).to_list(None)
+	return (page_payload(documents, limit), 200)
+
+# Endpoint: (whether the coroutine can serve this request, coroutine)
+ASYNC_VIEWS: Dict[str, Tuple[Callable[[], bool], AsyncView]] = {
+	"routes.register_user": (lambda: True, register_user),
+	"routes.login_user": (lambda: True, login_user),
+	"code.submit_code": (single_call_submission, submit_code),
+	"code.get_codes": (lambda: request.args.get("format") != "ndjson", get_codes),
+}
+
+def build_environ(scope: Mapping[str, Any], body: bytes) -> Dict[str, Any]:
+	root_path = scope.get("root_path", "")
+	path = scope["path"]
+	if root_path and path.startswith(root_path):
+		path = path[len(root_path):]
+	server = scope.get("server") or ("localhost", 80)
+	client = scope.get("client")
+
+	environ: Dict[str, Any] = {
+		"REQUEST_METHOD": scope["method"],
+		"SCRIPT_NAME": root_path.encode("utf-8").decode("latin-1"),
+		"PATH_INFO": path.encode("utf-8").decode("latin-1"),
+		"QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+		"SERVER_NAME": str(server[0]),
+		"SERVER_PORT": str(server[1]),
+		"SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+		"REMOTE_ADDR": client[0] if client else "",
+		"CONTENT_LENGTH": str(len(body)),
+		"wsgi.version": (1, 0),
+		"wsgi.url_scheme": scope.get("scheme", "http"),
+		"wsgi.input": io.BytesIO(body),
+		"wsgi.errors": sys.stderr,
+		"wsgi.multithread": True,
+		"wsgi.multiprocess": True,
+		"wsgi.run_once": False,
+	}
+
+	for raw_name, raw_value in scope.get("headers", []):
+		name = raw_name.decode("latin-1").upper().replace("-", "_")
+		value = raw_value.decode("latin-1")
+		if name == "CONTENT_LENGTH":
+			continue
+		key = name if name == "CONTENT_TYPE" else f"HTTP_{name}"
+		environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+	return environ
+
+def encode_headers(headers: List[Tuple[str, str]]) -> List[Tuple[bytes, bytes]]:
+	return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+class AsgiApplication:
+	"""Serves a Flask application over ASGI, running its I/O-bound routes as coroutines."""
+
+	def __init__(self, application: Flask) -> None:
+		self.application = application
+
+	async def __call__(self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]], send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+		if scope["type"] == "lifespan":
+			await self.lifespan(receive, send)
+			return
+		if scope["type"] != "http":
+			raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+		body = b""
+		while True:
+			message = await receive()
+			if message["type"] == "http.disconnect":
+				return
+			body += message.get("body", b"")
+			if not message.get("more_body"):
+				break
+
+		environ = build_environ(scope, body)
+		response = await self.dispatch(environ)
+		if response is not None:
+			await send({ "type": "http.response.start", "status": response.status_code, "headers": encode_headers(response.headers.to_wsgi_list()) })
+			await send({ "type": "http.response.body", "body": response.get_data() })
+			return
+
+		await self.call_wsgi(build_environ(scope, body), receive, send)
+
+	async def dispatch(self, environ: Dict[str, Any]) -> Optional[Response]:
+		"""Serve the request with its coroutine, or return None when the WSGI application must."""
+		application = self.application
+		context = application.request_context(environ)
+		context.push()
+		error: Optional[BaseException] = None
+		try:
+			entry = ASYNC_VIEWS.get(request.endpoint or "") if request.routing_exception is None else None
+			if entry is None or not entry[0]():
+				return None
+
+			# Mirrors Flask.full_dispatch_request() with an awaited view
+			try:
+				try:
+					rv = application.preprocess_request()
+					if rv is None:
+						rv = await entry[1]()
+				except Exception as e:
+					rv = application.handle_user_exception(e)
+				return application.finalize_request(rv)
+			except Exception as e:
+				error = e
+				return application.finalize_request(application.handle_exception(e), from_error_handler=True)
+		finally:
+			context.pop(error)
+
+	async def call_wsgi(self, environ: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]], send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+		"""Run the WSGI application on a single thread and relay its (possibly streamed) response."""
+		loop = asyncio.get_running_loop()
+		messages: asyncio.Queue = asyncio.Queue()
+		stopped = threading.Event()
+
+		def put(message: Tuple[Any, ...]) -> None:
+			loop.call_soon_threadsafe(messages.put_nowait, message)
+
+		def start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any = None) -> Callable[[bytes], None]:
+			put(("start", status, headers))
+			return lambda data: put(("body", data))
+
+		# Iterating on one thread keeps the contexts pushed by streaming generators valid
+		def produce() -> None:
+			try:
+				iterable = self.application(environ, start_response)
+				try:
+					for data in iterable:
+						if stopped.is_set():
+							break
+						if data:
+							put(("body", data))
+				finally:
+					if hasattr(iterable, "close"):
+						iterable.close()
+			finally:
+				put(("end",))
+
+		async def watch_disconnect() -> None:
+			while (await receive())["type"] != "http.disconnect":
+				pass
+			stopped.set()
+
+		producer = asyncio.ensure_future(asyncio.to_thread(produce))
+		watcher = asyncio.ensure_future(watch_disconnect())
+		try:
+			while True:
+				message = await messages.get()
+				if message[0] == "start":
+					await send({ "type": "http.response.start", "status": int(message[1].split(" ", 1)[0]), "headers": encode_headers(message[2]) })
+				elif message[0] == "body":
+					await send({ "type": "http.response.body", "body": message[1], "more_body": True })
+				else:
+					break
+			await send({ "type": "http.response.body", "body": b"" })
+		finally:
+			stopped.set()
+			watcher.cancel()
+			await producer
+
+	async def lifespan(self, receive: Callable[[], Awaitable[Dict[str, Any]]], send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+		while True:
+			message = await receive()
+			if message["type"] == "lifespan.startup":
+				await send({ "type": "lifespan.startup.complete" })
+			elif message["type"] == "lifespan.shutdown":
+				await asyncio.to_thread(get_writer(self.application).close)
+				with self.application.app_context():
+					await get_async_pool().close()
+				await send({ "type": "lifespan.shutdown.complete" })
+				return
+
+def create_asgi_application(test_configuration: Optional[Mapping[str, Any]] = None) -> AsgiApplication:
+	application = create_application(test_configuration)
+	init_async_database(application)
+	return AsgiApplication(application)
@@ -0,0 +1,182 @@
+import time
+import hashlib
+import datetime
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from flask import Flask, current_app
+from server.indexes import get_collection
+"""
+Content-addressed cache for code analyses.
+
+Entries are keyed on a hash of the normalized code, the model name and the prompt
+version, so resubmitting the same file (or one that only differs in trailing
+whitespace or line endings) never reaches the model twice.
+
+The cache has two tiers:
+	- an in-process LRU bounded by entry count and TTL, and
+	- a MongoDB collection shared by every worker, expired by a TTL index.
+
+Configuration keys (all optional):
+	ANALYSIS_CACHE_ENABLED: Turn the cache on or off. Defaults to True.
+	ANALYSIS_CACHE_SIZE: Maximum entries held in memory. Defaults to 1024.
+	ANALYSIS_CACHE_TTL: Seconds an in-memory entry stays valid. Defaults to 3600.
+	ANALYSIS_CACHE_STORE: Use the MongoDB tier. Defaults to True.
+	ANALYSIS_CACHE_STORE_TTL: Seconds a stored entry stays valid. Defaults to 7 days.
+"""
+
+CACHE_COLLECTION = "analysis_cache"
+EXTENSION_KEY = "analysis_cache"
+
+def normalize_code(code: str) -> str:
+	"""Drop differences that cannot change an analysis: line endings, trailing and edge blank space."""
+	lines = code.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+	return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+def cache_key(code: str, model: str, prompt_version: str) -> str:
+	digest = hashlib.sha256()
+	for part in (model, prompt_version, normalize_code(code)):
+		digest.update(part.encode("utf-8"))
+		digest.update(b"\0")
+	return digest.hexdigest()
+
+class LRUCache:
+	"""Thread-safe LRU mapping with an optional per-entry time to live."""
+
+	def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = None) -> None:
+		self.max_size = max_size
+		self.ttl_seconds = ttl_seconds
+		self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key: str) -> Any:
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+
+			stored_at, value = entry
+			if self.ttl_seconds is not None and time.monotonic() - stored_at > self.ttl_seconds:
+				del self._entries[key]
+				return None
+
+			self._entries.move_to_end(key)
+			return value
+
+	def set(self, key: str, value: Any) -> None:
+		if self.max_size <= 0:
+			return
+
+		with self._lock:
+			self._entries[key] = (time.monotonic(), value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+class MongoCache:
+	"""Cache tier stored in a dedicated collection and expired by a TTL index."""
+
+	def __init__(self, ttl_seconds: int, collection_name: str = CACHE_COLLECTION) -> None:
+		self.ttl_seconds = ttl_seconds
+		self.collection_name = collection_name
+
+	def _collection(self):
+		return get_collection(self.collection_name)
+
+	def get(self, key: str) -> Any:
+		document = self._collection().find_one({ "_id": key })
+		if document is None:
+			return None
+
+		# The TTL monitor only runs periodically, so expired documents can linger
+		age = datetime.datetime.now(datetime.timezone.utc) - document["created_at"].replace(tzinfo=datetime.timezone.utc)
+		if age.total_seconds() > self.ttl_seconds:
+			return None
+
+		return document.get("value")
+
+	def set(self, key: str, value: Any) -> None:
+		self._collection().update_one(
+			{ "_id": key },
+			{ "$set": { "value": value, "created_at": datetime.datetime.now(datetime.timezone.utc) } },
+			upsert=True
+		)
+
+class AnalysisCache:
+	"""Two-tier cache that counts hits per tier and misses."""
+
+	def __init__(self, memory: LRUCache, store: Optional[MongoCache] = None, enabled: bool = True) -> None:
+		self.memory = memory
+		self.store = store
+		self.enabled = enabled
+		self._counters: Dict[str, int] = { "memory_hits": 0, "store_hits": 0, "misses": 0 }
+		self._lock = threading.Lock()
+
+	def _count(self, name: str) -> None:
+		with self._lock:
+			self._counters[name] += 1
+
+	def get(self, key: str) -> Any:
+		if not self.enabled:
+			return None
+
+		value = self.memory.get(key)
+		if value is not None:
+			self._count("memory_hits")
+			return value
+
+		if self.store is not None:
+			try:
+				value = self.store.get(key)
+			except Exception as e:
+				print(e)
+				value = None
+
+			if value is not None:
+				self._count("store_hits")
+				self.memory.set(key, value)
+				return value
+
+		self._count("misses")
+		return None
+
+	def set(self, key: str, value: Any) -> None:
+		if not self.enabled:
+			return
+
+		self.memory.set(key, value)
+		if self.store is not None:
+			try:
+				self.store.set(key, value)
+			except Exception as e:
+				print(e)
+
+	def stats(self) -> Dict[str, int]:
+		with self._lock:
+			counters = dict(self._counters)
+		counters["hits"] = counters["memory_hits"] + counters["store_hits"]
+		counters["size"] = len(self.memory)
+		return counters
+
+def init_cache(application: Flask) -> AnalysisCache:
+	configuration = application.config
+	memory = LRUCache(configuration.get("ANALYSIS_CACHE_SIZE", 1024), configuration.get("ANALYSIS_CACHE_TTL", 3600))
+
+	store = None
+	if configuration.get("ANALYSIS_CACHE_STORE", True):
+		store = MongoCache(configuration.get("ANALYSIS_CACHE_STORE_TTL", 7 * 24 * 3600))
+
+	cache = AnalysisCache(memory, store, configuration.get("ANALYSIS_CACHE_ENABLED", True))
+	application.extensions[EXTENSION_KEY] = cache
+	return cache
+
+def get_cache() -> AnalysisCache:
+	return current_app.extensions[EXTENSION_KEY]
@@ -0,0 +1,161 @@
+import ast
+import hashlib
+import textwrap
+
+from dataclasses import dataclass
+from typing import List, Optional
+"""
+Splitting of large submissions into independently analyzable chunks.
+
+Python sources are split along top-level statements (functions, classes and the
+module code between them) using the ast module, so no definition is cut in half
+unless it alone exceeds the budget. Anything that does not parse as Python is split
+along line boundaries instead.
+
+Functions:
+	estimate_tokens(text) -> int:
+		Cheap token estimate (about four characters per token).
+	split_code(code, token_budget) -> List[Chunk]:
+		Splits code into chunks of at most token_budget estimated tokens each.
+	split_units(code) -> List[Unit] | None:
+		Splits Python code into one unit per top-level definition (plus the module
+		code between them), or returns None when it does not parse.
+"""
+
+@dataclass
+class Chunk:
+	start_line: int
+	end_line: int
+	text: str
+	# Names of the top-level definitions in the chunk, if any
+	names: List[str]
+
+	def label(self) -> str:
+		label = f"Lines {self.start_line}-{self.end_line}"
+		return f"{label} ({', '.join(self.names)})" if self.names else label
+
+def estimate_tokens(text: str) -> int:
+	return (len(text) + 3) // 4
+
+def split_code(code: str, token_budget: int) -> List[Chunk]:
+	lines = code.splitlines()
+
+	try:
+		tree = ast.parse(code)
+	except (SyntaxError, ValueError):
+		return split_lines(lines, 1, len(lines), token_budget)
+
+	return split_python(tree, lines, token_budget)
+
+def split_lines(lines: List[str], start_line: int, end_line: int, token_budget: int, names: Optional[List[str]] = None) -> List[Chunk]:
+	"""Pack consecutive lines (1-based, inclusive range) into chunks under the budget."""
+	chunks: List[Chunk] = []
+	current: List[str] = []
+	current_start = start_line
+	current_tokens = 0
+
+	for number in range(start_line, end_line + 1):
+		line = lines[number - 1]
+		tokens = estimate_tokens(line + "\n")
+		if current and current_tokens + tokens > token_budget:
+			chunks.append(Chunk(current_start, number - 1, "\n".join(current), list(names or [])))
+			current, current_start, current_tokens = [], number, 0
+		current.append(line)
+		current_tokens += tokens
+
+	if current:
+		chunks.append(Chunk(current_start, end_line, "\n".join(current), list(names or [])))
+	return chunks
+
+def split_python(tree: ast.Module, lines: List[str], token_budget: int) -> List[Chunk]:
+	# Each top-level statement owns the lines from the end of the previous one, so
+	# comments and blank lines travel with the definition that follows them
+	units: List[tuple[int, int, List[str]]] = []
+	previous_end = 0
+	for node in tree.body:
+		end = node.end_lineno or node.lineno
+		name = getattr(node, "name", None)
+		units.append((previous_end + 1, end, [name] if name else []))
+		previous_end = end
+
+	if previous_end < len(lines):
+		units.append((previous_end + 1, len(lines), []))
+
+	chunks: List[Chunk] = []
+	pending: Optional[tuple[int, int, List[str]]] = None
+
+	def text(start: int, end: int) -> str:
+		return "\n".join(lines[start - 1:end])
+
+	for start, end, names in units:
+		if estimate_tokens(text(start, end)) > token_budget:
+			if pending:
+				chunks.append(Chunk(pending[0], pending[1], text(pending[0], pending[1]), pending[2]))
+				pending = None
+			chunks.extend(split_lines(lines, start, end, token_budget, names))
+			continue
+
+		if pending and estimate_tokens(text(pending[0], end)) <= token_budget:
+			pending = (pending[0], end, pending[2] + names)
+			continue
+
+		if pending:
+			chunks.append(Chunk(pending[0], pending[1], text(pending[0], pending[1]), pending[2]))
+		pending = (start, end, names)
+
+	if pending:
+		chunks.append(Chunk(pending[0], pending[1], text(pending[0], pending[1]), pending[2]))
+	return chunks
+
+@dataclass
+class Unit(Chunk):
+	# Stable identity across edits: the definition name, or "<module N>" for the
+	# N-th stretch of module-level code, suffixed when a name is repeated
+	key: str = ""
+	# Hash of the unit's text, independent of where it sits in the file
+	digest: str = ""
+	# First line that is not blank; where the unit moved to is measured from it,
+	# since blank lines before a unit belong to its span but not to its digest
+	code_start_line: int = 0
+
+def split_units(code: str) -> Optional[List[Unit]]:
+	try:
+		tree = ast.parse(code)
+	except (SyntaxError, ValueError):
+		return None
+
+	lines = code.splitlines()
+	spans: List[tuple[int, int, Optional[str]]] = []
+	previous_end = 0
+	for node in tree.body:
+		end = node.end_lineno or node.lineno
+		name = node.name if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) else None
+		# Consecutive module-level statements form a single unit
+		if name is None and spans and spans[-1][2] is None:
+			spans[-1] = (spans[-1][0], end, None)
+		else:
+			spans.append((previous_end + 1, end, name))
+		previous_end = end
+
+	if previous_end < len(lines) and spans:
+		spans[-1] = (spans[-1][0], len(lines), spans[-1][2])
+
+	units: List[Unit] = []
+	seen: dict[str, int] = {}
+	modules = 0
+	for start, end, name in spans:
+		if name is None:
+			modules += 1
+			base = f"<module {modules}>"
+		else:
+			base = name
+		seen[base] = seen.get(base, 0) + 1
+		key = base if seen[base] == 1 else f"{base}#{seen[base]}"
+
+		text = "\n".join(lines[start - 1:end])
+		normalized = "\n".join(line.rstrip() for line in textwrap.dedent(text).strip("\n").splitlines())
+		digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+		code_start_line = start + next((index for index, line in enumerate(lines[start - 1:end]) if line.strip()), 0)
+		units.append(Unit(start, end, text, [name] if name else [], key, digest, code_start_line))
+
+	return units
@@ -0,0 +1,237 @@
+import io
+import re
+import ast
+import inspect
+import tokenize
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from server.chunking import estimate_tokens
+"""
+Compaction of the code sent to the model.
+
+Model latency and cost grow with prompt tokens, while comments, docstrings, blank
+lines and repeated blocks add little to an analysis. compact() runs these steps,
+each of which can be turned off:
+	comments: Drops comment-only lines and cuts inline comments to
+		PROMPT_COMPACTION_COMMENT_LENGTH characters. Comments that flag something
+		(TODO, FIXME, noqa, type:, pragma...) are kept, cut to the same length.
+	docstrings: Shortens multi-line docstrings to their summary line.
+	whitespace: Strips trailing whitespace and drops blank lines.
+	dedupe: Replaces a run of at least PROMPT_COMPACTION_DEDUPE_MIN_LINES lines
+		identical to an earlier run by a reference to it.
+The comments and docstrings steps only apply to code that parses as Python, where no
+step touches the inside of a string literal either.
+
+Line references stay exact: whenever lines were removed, the compacted text carries
+an "@@ N @@" marker saying the next line is line N of the submission, and repeated
+runs become "@@ lines a-b repeat lines c-d @@". Compaction.line_map gives the
+original line of every compacted line.
+
+Functions:
+	compact(code, first_line, steps, comment_length, dedupe_min_lines) -> Compaction:
+		Compacts code whose first line is line first_line of the submission.
+	compaction_settings(configuration) -> Dict | None:
+		The compact() arguments configured for an application, or None when
+		compaction is disabled.
+
+Configuration keys (all optional):
+	PROMPT_COMPACTION: Compact the code of every prompt. Defaults to True.
+	PROMPT_COMPACTION_STEPS: Steps to run. Defaults to all of them.
+	PROMPT_COMPACTION_COMMENT_LENGTH: Longest comment kept. Defaults to 60.
+	PROMPT_COMPACTION_DEDUPE_MIN_LINES: Shortest run replaced as a repeat. Defaults to 4.
+"""
+
+# Bump whenever the output of compact() changes, as it is part of the prompt
+COMPACTION_VERSION = "2"
+COMPACTION_STEPS = ("comments", "docstrings", "whitespace", "dedupe")
+FLAGGED_COMMENT = re.compile(r"\b(TODO|FIXME|XXX|HACK|BUG|SECURITY)\b|noqa|nosec|pragma|type:", re.IGNORECASE)
+
+# Told to the model whenever compaction changed the code
+COMPACTION_NOTE = (
+	"Compacted code: comments, docstrings and blank lines may be shortened or removed. "
+	"\"@@ N @@\" means the next line is line N; \"@@ lines a-b repeat lines c-d @@\" means lines a-b equal lines c-d. "
+	"Cite the original line numbers."
+)
+
+@dataclass(frozen=True)
+class Compaction:
+	text: str
+	# Line of the submission of every line of text, None for annotations
+	line_map: Tuple[Optional[int], ...]
+	original_tokens: int
+	tokens: int
+	# Steps that changed something
+	applied: Tuple[str, ...]
+
+	def original_line(self, line: int) -> Optional[int]:
+		"""Line of the submission shown as the given 1-based line of the compacted text."""
+		return self.line_map[line - 1] if 0 < line <= len(self.line_map) else None
+
+	def report(self) -> Dict[str, Any]:
+		return {
+			"original_tokens": self.original_tokens,
+			"prompt_tokens": self.tokens,
+			"saved_tokens": self.original_tokens - self.tokens,
+			"steps": list(self.applied),
+		}
+
+def string_lines(code: str) -> Optional[Tuple[set[int], List[tokenize.TokenInfo]]]:
+	"""Lines whose line break lies inside a string literal, and the comment tokens; None unless Python."""
+	try:
+		ast.parse(code)
+		tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+	except (SyntaxError, ValueError, tokenize.TokenError):
+		return None
+
+	protected: set[int] = set()
+	comments: List[tokenize.TokenInfo] = []
+	for token in tokens:
+		if token.type == tokenize.COMMENT:
+			comments.append(token)
+		elif token.start[0] != token.end[0] and token.type not in (tokenize.NEWLINE, tokenize.NL):
+			protected.update(range(token.start[0], token.end[0]))
+	return protected, comments
+
+def shorten(comment: str, length: int) -> str:
+	return comment if len(comment) <= length else comment[:max(1, length - 3)].rstrip() + "..."
+
+def compact_comments(lines: List[Optional[str]], comments: List[tokenize.TokenInfo], length: int) -> None:
+	for token in comments:
+		row, column = token.start
+		line = lines[row - 1]
+		if line is None:
+			continue
+		if line[:column].strip() or FLAGGED_COMMENT.search(token.string):
+			lines[row - 1] = line[:column] + shorten(token.string, length) + line[token.end[1]:]
+		else:
+			lines[row - 1] = None
+
+def compact_docstrings(code: str, lines: List[Optional[str]]) -> None:
+	for node in ast.walk(ast.parse(code)):
+		if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) or not node.body:
+			continue
+		docstring = node.body[0]
+		if not (isinstance(docstring, ast.Expr) and isinstance(docstring.value, ast.Constant) and isinstance(docstring.value.value, str)):
+			continue
+
+		first, last = docstring.lineno, docstring.end_lineno or docstring.lineno
+		if first == last or any(lines[row - 1] is None for row in (first, last)):
+			continue
+		# ast offsets count UTF-8 bytes
+		head = lines[first - 1].encode("utf-8")[:docstring.col_offset].decode("utf-8", "ignore")
+		tail = lines[last - 1].encode("utf-8")[docstring.end_col_offset or 0:].decode("utf-8", "ignore")
+		if tail.strip():
+			continue
+
+		summary = next((line.strip() for line in inspect.cleandoc(docstring.value.value).splitlines() if line.strip()), "")
+		literal = f'"""{summary}"""' if '"""' not in summary and not summary.endswith(("\"", "\\")) else repr(summary)
+		lines[first - 1] = head + literal
+		for row in range(first + 1, last + 1):
+			lines[row - 1] = None
+
+def compact_whitespace(lines: List[Optional[str]], protected: set[int]) -> None:
+	for index, line in enumerate(lines):
+		if line is None or index + 1 in protected:
+			continue
+		line = line.rstrip()
+		lines[index] = line if line else None
+
+# (first line, last line, text): a single line of the submission, or a repeat
+# annotation standing for a range of them
+Entry = Tuple[int, int, str]
+
+def dedupe(entries: List[Entry], min_lines: int, protected: frozenset[int] = frozenset()) -> List[Entry]:
+	"""Replace every run of at least min_lines lines seen before (and not overlapping it) by a reference; protected lines are never part of a run."""
+	output: List[Entry] = []
+	first_seen: Dict[Tuple[str, ...], int] = {}
+	index = 0
+
+	while index < len(entries):
+		window = tuple(text for _, _, text in entries[index:index + min_lines])
+		if any(first in protected for first, _, _ in entries[index:index + min_lines]):
+			window = ()
+		earlier = first_seen.get(window) if len(window) == min_lines else None
+		if earlier is not None and earlier + min_lines <= index:
+			length = min_lines
+			while (
+				index + length < len(entries) and earlier + length < index
+				and entries[earlier + length][2] == entries[index + length][2]
+				and entries[index + length][0] not in protected and entries[earlier + length][0] not in protected
+			):
+				length += 1
+			first, last = entries[index][0], entries[index + length - 1][1]
+			reference = f"@@ lines {first}-{last} repeat lines {entries[earlier][0]}-{entries[earlier + length - 1][1]} @@"
+			# Runs of short lines such as closing braces are cheaper than the reference
+			if estimate_tokens("\n".join(text for _, _, text in entries[index:index + length])) > estimate_tokens(reference):
+				output.append((first, last, reference))
+				index += length
+				continue
+
+		if len(window) == min_lines:
+			first_seen.setdefault(window, index)
+		output.append(entries[index])
+		index += 1
+
+	return output
+
+def render(entries: List[Entry], first_line: int) -> Tuple[str, Tuple[Optional[int], ...]]:
+	lines: List[str] = []
+	line_map: List[Optional[int]] = []
+	expected = first_line
+
+	for first, last, text in entries:
+		repeat = first != last
+		if first != expected and not repeat:
+			lines.append(f"@@ {first} @@")
+			line_map.append(None)
+		lines.append(text)
+		line_map.append(None if repeat else first)
+		expected = last + 1
+
+	return "\n".join(lines), tuple(line_map)
+
+@lru_cache(maxsize=512)
+def compact(code: str, first_line: int = 1, steps: Tuple[str, ...] = COMPACTION_STEPS, comment_length: int = 60, dedupe_min_lines: int = 4) -> Compaction:
+	source = code.splitlines()
+	lines: List[Optional[str]] = list(source)
+	applied: List[str] = []
+	python = string_lines(code)
+	protected, comments = python if python is not None else (set(), [])
+
+	for step, run, applies in (
+		("comments", lambda: compact_comments(lines, comments, comment_length), python is not None),
+		("docstrings", lambda: compact_docstrings(code, lines), python is not None),
+		("whitespace", lambda: compact_whitespace(lines, protected), True),
+	):
+		if step in steps and applies:
+			before = list(lines)
+			run()
+			if lines != before:
+				applied.append(step)
+
+	entries: List[Entry] = [(first_line + index, first_line + index, line) for index, line in enumerate(lines) if line is not None]
+	if "dedupe" in steps and dedupe_min_lines > 0:
+		# A repeat always spans several lines, which tells it apart from a line of code.
+		# Every line of a multi-line string, the one it ends on included, is left alone
+		in_strings = frozenset(first_line + row - 1 + offset for row in protected for offset in (0, 1))
+		deduped = dedupe(entries, max(2, dedupe_min_lines), in_strings)
+		if len(deduped) != len(entries):
+			applied.append("dedupe")
+		entries = deduped
+
+	if not applied:
+		return Compaction(code, tuple(range(first_line, first_line + len(source))), estimate_tokens(code), estimate_tokens(code), ())
+
+	text, line_map = render(entries, first_line)
+	return Compaction(text, line_map, estimate_tokens(code), estimate_tokens(text), tuple(applied))
+
+def compaction_settings(configuration: Mapping[str, Any]) -> Optional[Dict[str, Any]]:
+	if not configuration.get("PROMPT_COMPACTION", True):
+		return None
+	return {
+		"steps": tuple(step for step in configuration.get("PROMPT_COMPACTION_STEPS", COMPACTION_STEPS) if step in COMPACTION_STEPS),
+		"comment_length": configuration.get("PROMPT_COMPACTION_COMMENT_LENGTH", 60),
+		"dedupe_min_lines": configuration.get("PROMPT_COMPACTION_DEDUPE_MIN_LINES", 4),
+	}
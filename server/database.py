@@ -1,33 +1,57 @@
 import os
+import atexit
+import threading
 
+from typing import Any, List, Mapping, Optional, Tuple
+from flask import Flask, current_app
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.database import AsyncDatabase
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from pymongo.database import Database
+from pymongo.collection import Collection
+from server.metrics import get_metrics
 """
-Establishes a connection to a MongoDB database.
+MongoDB connection management.
 
-This function creates a connection to a MongoDB database using either a provided URI
-or one from environment variables. It performs a ping test to verify the connection
-and returns a database instance.
+A single MongoClient (and therefore a single connection pool) is shared by every
+request handled in a process. The pool is created by create_application() through
+init_database() and handlers reach it with get_database().
 
-Args:
-	uri (str | None, optional): MongoDB connection URI. If not provided, 
-		will attempt to use MONGO_URI from environment variables. Defaults to None.
-	database_name (str, optional): Name of the database to connect to. 
-		Defaults to "FlaskApplication#01".
+Configuration keys (all optional):
+	MONGO_URI: Connection URI. Falls back to the MONGO_URI environment variable.
+	MONGO_DATABASE: Database name. Defaults to "FlaskApplication#01".
+	MONGO_MAX_POOL_SIZE: Maximum connections per server. Defaults to 100.
+	MONGO_MIN_POOL_SIZE: Connections kept open when idle. Defaults to 0.
+	MONGO_MAX_IDLE_TIME_MS: Idle time before a pooled connection is closed.
+	MONGO_CONNECT_TIMEOUT_MS: Socket connect timeout. Defaults to 5000.
+	MONGO_SERVER_SELECTION_TIMEOUT_MS: Server selection timeout. Defaults to 5000.
+	MONGO_SOCKET_TIMEOUT_MS: Socket read/write timeout. Defaults to None (no timeout).
+	MONGO_WAIT_QUEUE_TIMEOUT_MS: Time a request waits for a free pooled connection.
+	MONGO_HEALTH_CHECK: Ping the server once at startup. Defaults to True unless TESTING.
+	MONGO_CLIENT: A ready-made client (e.g. mongomock.MongoClient) used instead of
+		building one from the settings above.
+	MONGO_ASYNC_CLIENT: Same for the AsyncMongoClient of the async serving mode.
 
-Returns:
-	Database: A pymongo Database instance connected to the specified database.
+Clients built by the pool report command timings and pool usage to server.metrics.
 
-Raises:
-	Exception: If the database connection cannot be established or verified.
-
-Example:
-	>>> db = connect_database()
-	>>> db = connect_database("mongodb://localhost:27017", "my_database")
+Functions:
+	connect_database(uri, database_name) -> Database:
+		Creates a standalone client and returns a database handle. Kept for scripts
+		and tests that run outside of an application context.
+	init_database(application) -> MongoPool:
+		Creates the process-wide pool for an application.
+	get_database() -> Database:
+		Returns the database of the current application's pool.
+	init_async_database(application) -> AsyncMongoPool / get_async_pool() -> AsyncMongoPool:
+		Same for the async serving mode (see server.asgi).
 """
 
-def connect_database(uri: str | None = None, database_name: str = "FlaskApplication#01") -> Database:
+DEFAULT_DATABASE_NAME = "FlaskApplication#01"
+EXTENSION_KEY = "mongo_pool"
+ASYNC_EXTENSION_KEY = "async_mongo_pool"
+
+def connect_database(uri: str | None = None, database_name: str = DEFAULT_DATABASE_NAME) -> Database:
 	URI: str | None = uri or os.getenv("MONGO_URI")
 
 	client: MongoClient = MongoClient(URI, server_api=ServerApi("1"))
@@ -38,3 +62,152 @@ def connect_database(uri: str | None = None, database_name: str = "FlaskApplicat
 		print(e)
 
 	return client[database_name]
+
+class MongoPool:
+	"""
+	Owns the MongoClient of a process.
+
+	The client is created lazily on first use and re-created when the process id
+	changes, so a pool built before a pre-fork server forks its workers never hands
+	a parent's sockets to a child.
+	"""
+
+	def __init__(self, configuration: Mapping[str, Any], event_listeners: Optional[List[Any]] = None) -> None:
+		self.uri: str | None = configuration.get("MONGO_URI") or os.getenv("MONGO_URI")
+		self.database_name: str = configuration.get("MONGO_DATABASE") or DEFAULT_DATABASE_NAME
+		self.options: dict[str, Any] = {
+			"maxPoolSize": configuration.get("MONGO_MAX_POOL_SIZE", 100),
+			"minPoolSize": configuration.get("MONGO_MIN_POOL_SIZE", 0),
+			"maxIdleTimeMS": configuration.get("MONGO_MAX_IDLE_TIME_MS"),
+			"connectTimeoutMS": configuration.get("MONGO_CONNECT_TIMEOUT_MS", 5000),
+			"serverSelectionTimeoutMS": configuration.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+			"socketTimeoutMS": configuration.get("MONGO_SOCKET_TIMEOUT_MS"),
+			"waitQueueTimeoutMS": configuration.get("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+		}
+		# pymongo command and pool listeners, such as those of server.metrics
+		self.event_listeners: List[Any] = list(event_listeners or [])
+		self._injected_client: Any = configuration.get("MONGO_CLIENT")
+		self._client: Any = None
+		self._pid: int | None = None
+		self._lock = threading.Lock()
+		self._indexes: set[tuple] = set()
+		# Result of the last ping, None until one has run
+		self.healthy: bool | None = None
+
+	@property
+	def client(self) -> MongoClient:
+		if self._client is None or self._pid != os.getpid():
+			with self._lock:
+				if self._client is None or self._pid != os.getpid():
+					self._client = self._create_client()
+					self._pid = os.getpid()
+		return self._client
+
+	@property
+	def database(self) -> Database:
+		return self.client[self.database_name]
+
+	def _create_client(self) -> MongoClient:
+		if self._injected_client is not None:
+			return self._injected_client
+
+		options = { key: value for key, value in self.options.items() if value is not None }
+		if self.event_listeners:
+			options["event_listeners"] = self.event_listeners
+		return MongoClient(self.uri, server_api=ServerApi("1"), **options)
+
+	def ensure_index(self, collection_name: str, keys: List[Tuple[str, int | str]], **options: Any) -> Collection:
+		"""Return a collection, creating the given index the first time this pool asks for it."""
+		collection = self.database[collection_name]
+		marker = (collection_name, tuple(keys), repr(sorted(options.items())))
+		if marker not in self._indexes:
+			collection.create_index(keys, **options)
+			self._indexes.add(marker)
+		return collection
+
+	def ping(self) -> bool:
+		"""Run a single round trip to the server, returning False instead of raising."""
+		try:
+			self.client.admin.command('ping')
+		except Exception as e:
+			print(e)
+			self.healthy = False
+		else:
+			self.healthy = True
+		return self.healthy
+
+	def close(self) -> None:
+		with self._lock:
+			# Only close a client this process created; a forked child must not
+			# tear down sockets still owned by its parent.
+			if self._client is not None and self._pid == os.getpid() and self._injected_client is None:
+				self._client.close()
+			self._client = None
+			self._pid = None
+
+class AsyncMongoPool:
+	"""
+	Owns the AsyncMongoClient of a process, for the async serving mode.
+
+	Takes the same settings as MongoPool. The client binds to the event loop it is
+	first used on, which is the single loop of the serving process.
+	"""
+
+	def __init__(self, configuration: Mapping[str, Any], event_listeners: Optional[List[Any]] = None) -> None:
+		self.settings = MongoPool(configuration, event_listeners)
+		self._injected_client: Any = configuration.get("MONGO_ASYNC_CLIENT")
+		self._client: Any = None
+		self._pid: int | None = None
+		# Collections whose declared indexes were checked (see server.indexes)
+		self.prepared: set[str] = set()
+
+	@property
+	def client(self) -> AsyncMongoClient:
+		# Only ever touched from the event loop's thread, so no lock is needed
+		if self._client is None or self._pid != os.getpid():
+			self._client = self._create_client()
+			self._pid = os.getpid()
+		return self._client
+
+	@property
+	def database(self) -> AsyncDatabase:
+		return self.client[self.settings.database_name]
+
+	def _create_client(self) -> AsyncMongoClient:
+		if self._injected_client is not None:
+			return self._injected_client
+
+		options = { key: value for key, value in self.settings.options.items() if value is not None }
+		if self.settings.event_listeners:
+			options["event_listeners"] = self.settings.event_listeners
+		return AsyncMongoClient(self.settings.uri, server_api=ServerApi("1"), **options)
+
+	async def close(self) -> None:
+		if self._client is not None and self._pid == os.getpid() and self._injected_client is None:
+			await self._client.close()
+		self._client = None
+		self._pid = None
+
+def init_database(application: Flask) -> MongoPool:
+	pool = MongoPool(application.config, get_metrics(application).mongo_listeners())
+	application.extensions[EXTENSION_KEY] = pool
+
+	if application.config.get("MONGO_HEALTH_CHECK", not application.testing):
+		pool.ping()
+
+	atexit.register(pool.close)
+	return pool
+
+def get_pool(application: Optional[Flask] = None) -> MongoPool:
+	return (application or current_app).extensions[EXTENSION_KEY]
+
+def get_database() -> Database:
+	return get_pool().database
+
+def init_async_database(application: Flask) -> AsyncMongoPool:
+	pool = AsyncMongoPool(application.config, get_metrics(application).mongo_listeners())
+	application.extensions[ASYNC_EXTENSION_KEY] = pool
+	return pool
+
+def get_async_pool() -> AsyncMongoPool:
+	return current_app.extensions[ASYNC_EXTENSION_KEY]
@@ -0,0 +1,137 @@
+import os
+import time
+import atexit
+import threading
+import multiprocessing
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, TimeoutError
+from typing import Any, Callable, Dict, Optional
+from flask import Flask, current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+"""
+Password hashing off the request threads.
+
+Hashing and verification are deliberately CPU-heavy, so they run on a dedicated
+process pool where they scale across cores and do not hold the GIL of the worker
+serving other requests. The pool processes are started by a forkserver (spawn where
+there is none) rather than forked from the threaded server. Work is admitted through
+a bounded number of pending operations; beyond it callers get HashingBusy straight
+away instead of queueing. An operation the caller stopped waiting for keeps its
+slot until the pool has finished it.
+
+Configuration keys (all optional):
+	PASSWORD_HASH_WORKERS: Processes in the pool. 0 hashes inline on the request
+		thread. Defaults to the number of CPUs.
+	PASSWORD_HASH_MAX_PENDING: Operations queued or running before new ones are
+		refused. Defaults to four per worker.
+	PASSWORD_HASH_TIMEOUT: Seconds a request waits for its operation. Defaults to 10.
+	PASSWORD_HASH_METHOD: Werkzeug hash method, e.g. "scrypt:32768:8:1" (default)
+		or "pbkdf2:sha256:1000000". Stored hashes made with other parameters are
+		upgraded on the next successful login.
+	PASSWORD_HASH_SALT_LENGTH: Salt length. Defaults to 16.
+"""
+
+EXTENSION_KEY = "password_hasher"
+
+class HashingBusy(Exception):
+	"""Raised when the hashing pool already holds its maximum of pending operations."""
+
+def normalize_method(method: str) -> str:
+	"""Spell out the parameters Werkzeug would fill in, as they appear in stored hashes."""
+	parts = method.split(":")
+	if parts[0] == "scrypt" and len(parts) == 1:
+		return "scrypt:32768:8:1"
+	if parts[0] == "pbkdf2":
+		if len(parts) == 1:
+			parts.append("sha256")
+		if len(parts) == 2:
+			parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+	return ":".join(parts)
+
+class PasswordHasher:
+	"""Runs password hashing on a bounded process pool and times every operation."""
+
+	def __init__(self, configuration: Dict[str, Any]) -> None:
+		self.workers: int = configuration.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)
+		self.max_pending: int = configuration.get("PASSWORD_HASH_MAX_PENDING", max(1, self.workers) * 4)
+		self.timeout: float = configuration.get("PASSWORD_HASH_TIMEOUT", 10)
+		self.method: str = normalize_method(configuration.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1"))
+		self.salt_length: int = configuration.get("PASSWORD_HASH_SALT_LENGTH", 16)
+		self._executor: Optional[Executor] = None
+		self._pid: Optional[int] = None
+		self._slots = threading.BoundedSemaphore(self.max_pending) if self.max_pending > 0 else None
+		self._lock = threading.Lock()
+		self._timings: Dict[str, Dict[str, float]] = {
+			name: { "count": 0, "total_seconds": 0.0, "max_seconds": 0.0 } for name in ("hash", "verify")
+		}
+		self._rejected = 0
+
+	@property
+	def executor(self) -> Optional[Executor]:
+		if self.workers <= 0:
+			return None
+
+		with self._lock:
+			if self._executor is None or self._pid != os.getpid():
+				# Forking a process that runs threads can copy locks held by other threads
+				method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+				self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+				self._pid = os.getpid()
+		return self._executor
+
+	def _run(self, name: str, function: Callable[..., Any], *arguments: Any) -> Any:
+		if self._slots is None or not self._slots.acquire(blocking=False):
+			with self._lock:
+				self._rejected += 1
+			raise HashingBusy()
+
+		started = time.perf_counter()
+		future: Optional[Future] = None
+		try:
+			executor = self.executor
+			if executor is None:
+				return function(*arguments)
+			future = executor.submit(function, *arguments)
+			return future.result(timeout=self.timeout)
+		except TimeoutError:
+			raise HashingBusy()
+		finally:
+			if future is None or future.done() or future.cancel():
+				self._slots.release()
+			else:
+				# Still running on the pool, so it keeps its slot until it finishes
+				future.add_done_callback(lambda _: self._slots.release())
+			self._record(name, time.perf_counter() - started)
+
+	def _record(self, name: str, seconds: float) -> None:
+		with self._lock:
+			timing = self._timings[name]
+			timing["count"] += 1
+			timing["total_seconds"] += seconds
+			timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+	def hash(self, password: str) -> str:
+		return self._run("hash", generate_password_hash, password, self.method, self.salt_length)
+
+	def verify(self, pwhash: str, password: str) -> bool:
+		return self._run("verify", check_password_hash, pwhash, password)
+
+	def needs_rehash(self, pwhash: str) -> bool:
+		return pwhash.split("$", 1)[0] != self.method
+
+	def stats(self) -> Dict[str, Any]:
+		with self._lock:
+			return { **{ name: dict(timing) for name, timing in self._timings.items() }, "rejected": self._rejected }
+
+	def shutdown(self) -> None:
+		if self._executor is not None and self._pid == os.getpid():
+			self._executor.shutdown(wait=False, cancel_futures=True)
+
+def init_hashing(application: Flask) -> PasswordHasher:
+	hasher = PasswordHasher(application.config)
+	application.extensions[EXTENSION_KEY] = hasher
+	atexit.register(hasher.shutdown)
+	return hasher
+
+def get_hasher() -> PasswordHasher:
+	return current_app.extensions[EXTENSION_KEY]
@@ -0,0 +1,103 @@
+import time
+import threading
+
+from typing import Any, Dict, List, Optional, Tuple
+from flask import Flask, current_app
+from pymongo.errors import PyMongoError
+from server.database import get_pool
+from server.indexes import ensure_indexes, verify_indexes
+from server.model import get_model
+from server.static_analysis import analyze_static
+"""
+Warmup and readiness.
+
+warmup() pays every first-request cost up front: it opens the MongoDB pool, checks
+(and creates, with MONGO_ENSURE_INDEXES) the declared indexes, imports and builds
+the model client, and serves a synthetic request through the whole stack. /ready
+answers 503 until warmup has completed in this process, and afterwards whenever
+MongoDB stops answering, so a load balancer only routes to warm, healthy workers.
+/initial stays a plain liveness check.
+
+Configuration keys (all optional):
+	READINESS_PING_INTERVAL: Seconds a MongoDB ping result is reused by /ready.
+		Defaults to 5.
+"""
+
+EXTENSION_KEY = "readiness"
+
+class Readiness:
+	def __init__(self, ping_interval: float) -> None:
+		self.ping_interval = ping_interval
+		self.ready = False
+		self.checks: Dict[str, Any] = {}
+		self._pinged_at = 0.0
+		self._lock = threading.Lock()
+
+	def mark_ready(self, checks: Dict[str, Any]) -> None:
+		with self._lock:
+			self.checks = checks
+			self.ready = True
+			self._pinged_at = time.monotonic()
+
+	def status(self) -> Tuple[Dict[str, Any], int]:
+		if not self.ready:
+			return ({"status": "starting"}, 503)
+
+		pool = get_pool()
+		with self._lock:
+			stale = time.monotonic() - self._pinged_at > self.ping_interval
+			if stale:
+				self._pinged_at = time.monotonic()
+		if stale:
+			pool.ping()
+
+		if not pool.healthy:
+			return ({"status": "unavailable", "checks": { **self.checks, "mongo": False }}, 503)
+		return ({"status": "ready", "checks": self.checks}, 200)
+
+def warmup(application: Flask) -> Dict[str, Any]:
+	"""Run every warmup step in this process and mark it ready; returns what each step found."""
+	checks: Dict[str, Any] = {}
+	started = time.perf_counter()
+
+	with application.app_context():
+		pool = get_pool()
+		checks["mongo"] = pool.ping()
+
+		problems: List[str] = []
+		if checks["mongo"]:
+			try:
+				if application.config.get("MONGO_ENSURE_INDEXES", not application.testing):
+					ensure_indexes(application.config)
+				problems = verify_indexes(pool.database, application.config)
+			except PyMongoError as e:
+				print(e)
+				problems = [str(e)]
+		checks["index_problems"] = problems
+
+		get_model().warmup()
+		checks["model"] = True
+
+		analyze_static("def warmup():\n\treturn 1\n", application.config)
+
+	# Goes through routing, hooks and serialization like a real request would
+	response = application.test_client().get("/initial")
+	checks["synthetic_request"] = response.status_code == 200
+
+	checks["seconds"] = round(time.perf_counter() - started, 3)
+	get_readiness(application).mark_ready(checks)
+	return checks
+
+def init_health(application: Flask) -> Readiness:
+	readiness = Readiness(application.config.get("READINESS_PING_INTERVAL", 5))
+	application.extensions[EXTENSION_KEY] = readiness
+
+	# Readiness probe, separate from the /initial liveness check
+	@application.route("/ready", methods=["GET"])
+	def ready() -> Tuple[Dict[str, Any], int]:
+		return readiness.status()
+
+	return readiness
+
+def get_readiness(application: Optional[Flask] = None) -> Readiness:
+	return (application or current_app).extensions[EXTENSION_KEY]
@@ -0,0 +1,150 @@
+import click
+import asyncio
+
+from typing import Any, Dict, List, Mapping, Tuple, Union
+from flask import Flask, current_app
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+from server.database import get_async_pool, get_pool
+"""
+Declaration and bootstrap of every MongoDB index the application relies on.
+
+Indexes are declared once in declared_indexes() and created either at startup
+(MONGO_ENSURE_INDEXES, on by default unless TESTING), by the "create-indexes" CLI
+command, or lazily the first time get_collection() hands out a collection. Creation
+is idempotent and remembered per process, so the lazy path costs nothing once the
+indexes exist.
+
+	flask --app server create-indexes            # create missing indexes
+	flask --app server create-indexes --verify   # only report missing or different ones
+
+Functions:
+	declared_indexes(configuration) -> Dict[str, List[Tuple[keys, options]]]:
+		Indexes per collection, including TTL indexes whose lifetime comes from config.
+	get_collection(name) -> Collection:
+		Returns a collection of the current database with its declared indexes in place.
+	get_async_collection(name) -> AsyncCollection:
+		Same for the async serving mode (see server.asgi).
+	ensure_indexes(configuration) -> None:
+		Creates every declared index through the current application's pool.
+	verify_indexes(database, configuration) -> List[str]:
+		Describes every declared index that is missing or has different options.
+"""
+
+IndexKeys = List[Tuple[str, Union[int, str]]]
+
+def declared_indexes(configuration: Mapping[str, Any]) -> Dict[str, List[Tuple[IndexKeys, Dict[str, Any]]]]:
+	return {
+		# Makes registration a single atomic insert and serves login lookups
+		"users": [
+			([("username", ASCENDING)], { "unique": True }),
+		],
+		# ObjectIds grow with creation time, so this index serves the per-user
+		# history in creation order without a separate timestamp field
+		"codes": [
+			([("user", ASCENDING), ("_id", DESCENDING)], {}),
+			# Serves /code/search; the "user" prefix keeps each query within one
+			# user's records. language_override points at a field records never
+			# have, so a stored "language" (e.g. "python") cannot break inserts
+			([("user", ASCENDING), ("code", TEXT), ("response", TEXT)], {
+				"name": "codes_text",
+				"weights": { "code": 1, "response": 3 },
+				"default_language": "english",
+				"language_override": "text_language",
+			}),
+		],
+		"analysis_cache": [
+			([("created_at", ASCENDING)], { "expireAfterSeconds": configuration.get("ANALYSIS_CACHE_STORE_TTL", 7 * 24 * 3600) }),
+		],
+		"jobs": [
+			([("expires_at", ASCENDING)], { "expireAfterSeconds": 0 }),
+		],
+		"analysis_leases": [
+			([("expires_at", ASCENDING)], { "expireAfterSeconds": 0 }),
+		],
+		"rate_limits": [
+			([("expires_at", ASCENDING)], { "expireAfterSeconds": 0 }),
+		],
+	}
+
+def get_collection(name: str) -> Collection:
+	pool = get_pool()
+	collection = pool.database[name]
+	for keys, options in declared_indexes(current_app.config).get(name, []):
+		collection = pool.ensure_index(name, keys, **options)
+	return collection
+
+async def get_async_collection(name: str) -> AsyncCollection:
+	"""get_collection() for the async serving mode; indexes are created through the blocking pool, once."""
+	pool = get_async_pool()
+	if name not in pool.prepared:
+		await asyncio.to_thread(get_collection, name)
+		pool.prepared.add(name)
+	return pool.database[name]
+
+def ensure_indexes(configuration: Mapping[str, Any]) -> None:
+	pool = get_pool()
+	for name, indexes in declared_indexes(configuration).items():
+		for keys, options in indexes:
+			pool.ensure_index(name, keys, **options)
+
+TEXT_INDEX_OPTIONS = ("weights", "default_language", "language_override")
+
+# Keys of an existing index as declared; MongoDB reports the fields of a text
+# index through its weights and stores them under "_fts" and "_ftsx"
+def index_keys(info: Mapping[str, Any]) -> IndexKeys:
+	keys: IndexKeys = []
+	for key, direction in info["key"]:
+		if key == "_fts":
+			keys.extend((field, TEXT) for field in sorted(info.get("weights", {})))
+		elif key != "_ftsx":
+			keys.append((key, direction))
+	return keys
+
+def verify_indexes(database: Database, configuration: Mapping[str, Any]) -> List[str]:
+	problems: List[str] = []
+
+	for name, indexes in declared_indexes(configuration).items():
+		existing = database[name].index_information()
+		for keys, options in indexes:
+			match = next(((index_name, info) for index_name, info in existing.items() if index_keys(info) == keys), None)
+			if match is None:
+				problems.append(f"{name}: missing index on {keys}")
+				continue
+
+			index_name, info = match
+			for option, value in options.items():
+				# mongomock does not report the options of text indexes
+				if option in TEXT_INDEX_OPTIONS and option not in info:
+					continue
+				actual = index_name if option == "name" else info.get(option)
+				if actual != value:
+					problems.append(f"{name}: index on {keys} has {option}={actual!r}, expected {value!r}")
+
+	return problems
+
+def init_indexes(application: Flask) -> None:
+	@application.cli.command("create-indexes")
+	@click.option("--verify", is_flag=True, help="Only report missing or different indexes.")
+	def create_indexes_command(verify: bool) -> None:
+		"""Create and verify the MongoDB indexes used by the application."""
+		if not verify:
+			ensure_indexes(current_app.config)
+
+		problems = verify_indexes(get_pool().database, current_app.config)
+		for problem in problems:
+			click.echo(problem)
+		if problems:
+			raise SystemExit(1)
+		click.echo("All indexes are in place")
+
+	# Skip when the startup health check already found the server unreachable
+	if application.config.get("MONGO_ENSURE_INDEXES", not application.testing) and get_pool(application).healthy is not False:
+		with application.app_context():
+			try:
+				ensure_indexes(application.config)
+			except PyMongoError as e:
+				print(e)
@@ -0,0 +1,208 @@
+import os
+import time
+import atexit
+import datetime
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+from bson import ObjectId
+from flask import Flask, current_app
+from server.indexes import get_collection
+from server.analysis import analyze_code, route_record
+from server.routing import get_router
+from server.utils import parse_object_id, submit_to_database
+"""
+Asynchronous analysis jobs.
+
+A submission made in async mode is recorded in the "jobs" collection and handed to a
+bounded worker pool, so the request thread returns immediately. Job state lives in
+MongoDB, which lets any worker process answer a poll for any job. Jobs still queued
+when the process exits are marked failed, so polls do not wait on them forever.
+
+Job documents:
+	{ "_id": ObjectId, "user": str, "status": "queued" | "running" | "done" | "failed",
+	  "result": { "message", "message_id", "cached" } | None, "error": str | None,
+	  "created_at": datetime, "expires_at": datetime }
+
+Configuration keys (all optional):
+	JOBS_WORKERS: Concurrent analyses per process. Defaults to 4.
+	JOBS_MAX_DEPTH: Jobs queued or running per process before submissions are
+		refused. Defaults to 100.
+	JOBS_EXPIRY_SECONDS: Lifetime of a job document. Defaults to 3600.
+	JOBS_WAIT_TIMEOUT: Longest a /wait request may block, in seconds. Defaults to 30.
+	JOBS_POLL_INTERVAL: Seconds between polls for jobs run by other processes.
+		Defaults to 0.25.
+"""
+
+JOBS_COLLECTION = "jobs"
+EXTENSION_KEY = "job_queue"
+FINISHED_STATUSES = ("done", "failed")
+
+class QueueFull(Exception):
+	"""Raised when a job is submitted while the queue is at its maximum depth."""
+
+def serialize_job(job: Dict[str, Any]) -> Dict[str, Any]:
+	payload: Dict[str, Any] = { "job_id": str(job["_id"]), "status": job["status"] }
+	if job.get("result"):
+		payload.update(job["result"])
+	if job.get("error"):
+		payload["error"] = job["error"]
+	return payload
+
+class JobQueue:
+	"""Bounded thread pool that runs analysis jobs and records them in MongoDB."""
+
+	def __init__(self, application: Flask) -> None:
+		configuration = application.config
+		self.application = application
+		self.max_workers: int = configuration.get("JOBS_WORKERS", 4)
+		self.max_depth: int = configuration.get("JOBS_MAX_DEPTH", 100)
+		self.expiry_seconds: int = configuration.get("JOBS_EXPIRY_SECONDS", 3600)
+		self.wait_timeout: float = configuration.get("JOBS_WAIT_TIMEOUT", 30)
+		self.poll_interval: float = configuration.get("JOBS_POLL_INTERVAL", 0.25)
+		self._executor: Optional[ThreadPoolExecutor] = None
+		self._pid: Optional[int] = None
+		self._depth = 0
+		self._events: Dict[str, threading.Event] = {}
+		self._futures: Dict[str, Future] = {}
+		self._lock = threading.Lock()
+
+	@property
+	def executor(self) -> ThreadPoolExecutor:
+		# Worker threads do not survive a fork, so each process builds its own pool
+		if self._executor is None or self._pid != os.getpid():
+			self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="analysis-job")
+			self._pid = os.getpid()
+			self._depth = 0
+			self._events = {}
+			self._futures = {}
+		return self._executor
+
+	def collection(self):
+		return get_collection(JOBS_COLLECTION)
+
+	def submit(self, code: str, user: str, use_cache: bool = True) -> str:
+		with self._lock:
+			executor = self.executor
+			if self._depth >= self.max_depth:
+				raise QueueFull()
+			self._depth += 1
+
+		now = datetime.datetime.now(datetime.timezone.utc)
+		job_id = ObjectId()
+		try:
+			self.collection().insert_one({
+				"_id": job_id,
+				"user": user,
+				"status": "queued",
+				"result": None,
+				"error": None,
+				"created_at": now,
+				"expires_at": now + datetime.timedelta(seconds=self.expiry_seconds)
+			})
+		except Exception:
+			self._release(None)
+			raise
+
+		key = str(job_id)
+		self._events[key] = threading.Event()
+		future = self._futures[key] = executor.submit(self._run, job_id, code, user, use_cache)
+		future.add_done_callback(lambda _: self._futures.pop(key, None))
+		return key
+
+	def _release(self, job_id: Optional[ObjectId]) -> None:
+		with self._lock:
+			self._depth -= 1
+		if job_id is not None:
+			event = self._events.pop(str(job_id), None)
+			if event is not None:
+				event.set()
+
+	def _run(self, job_id: ObjectId, code: str, user: str, use_cache: bool) -> None:
+		with self.application.app_context():
+			collection = self.collection()
+			try:
+				collection.update_one({ "_id": job_id }, { "$set": { "status": "running" } })
+
+				deadline = get_router().deadline()
+				analysis = analyze_code(code, use_cache=use_cache, deadline=deadline)
+				if not analysis.text:
+					update = { "status": "failed", "error": "Model did not respond with any content" }
+				else:
+					database_response = submit_to_database(code, analysis.text, user=user, extra={ "route": route_record(analysis, deadline) })
+					if database_response.get("error"):
+						update = { "status": "failed", "error": "Internal Server Error" }
+					else:
+						update = { "status": "done", "result": {
+							"message": analysis.text,
+							"message_id": database_response["id"],
+							"cached": analysis.cached
+						} }
+			except Exception as e:
+				print(e)
+				update = { "status": "failed", "error": "Model failed while generating the response" }
+
+			try:
+				collection.update_one({ "_id": job_id }, { "$set": update })
+			except Exception as e:
+				print(e)
+			finally:
+				self._release(job_id)
+
+	def get(self, job_id: str, user: str) -> Optional[Dict[str, Any]]:
+		object_id = parse_object_id(job_id)
+		if object_id is None:
+			return None
+		return self.collection().find_one({ "_id": object_id, "user": user })
+
+	def wait(self, job_id: str, user: str, timeout: float) -> Optional[Dict[str, Any]]:
+		"""Block until the job finishes or the timeout elapses and return its latest state."""
+		timeout = max(0.0, min(timeout, self.wait_timeout))
+		deadline = time.monotonic() + timeout
+
+		job = self.get(job_id, user)
+		while job is not None and job["status"] not in FINISHED_STATUSES:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+
+			# Jobs run by this process signal completion; others are polled
+			event = self._events.get(job_id)
+			if event is not None:
+				event.wait(remaining)
+			else:
+				time.sleep(min(self.poll_interval, remaining))
+			job = self.get(job_id, user)
+
+		return job
+
+	def shutdown(self) -> None:
+		if self._executor is None or self._pid != os.getpid():
+			return
+
+		futures = dict(self._futures)
+		self._executor.shutdown(wait=False, cancel_futures=True)
+		cancelled = [ObjectId(job_id) for job_id, future in futures.items() if future.cancelled()]
+		if not cancelled:
+			return
+
+		with self.application.app_context():
+			try:
+				self.collection().update_many(
+					{ "_id": { "$in": cancelled }, "status": "queued" },
+					{ "$set": { "status": "failed", "error": "Server shut down before the job ran" } }
+				)
+			except Exception as e:
+				print(e)
+		for job_id in cancelled:
+			self._release(job_id)
+
+def init_jobs(application: Flask) -> JobQueue:
+	queue = JobQueue(application)
+	application.extensions[EXTENSION_KEY] = queue
+	atexit.register(queue.shutdown)
+	return queue
+
+def get_jobs() -> JobQueue:
+	return current_app.extensions[EXTENSION_KEY]
@@ -0,0 +1,338 @@
+import time
+import uuid
+import logging
+import threading
+
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+from flask import Flask, Response, current_app, g, has_app_context, request
+from flask.logging import default_handler, wsgi_errors_stream
+from pymongo import monitoring
+from server.chunking import estimate_tokens
+"""
+Built-in instrumentation of the hot paths.
+
+create_application() registers a registry of counters, gauges and latency histograms
+and, unless disabled, request hooks that time every route, pymongo listeners that
+time every command and track the connection pool, and a /metrics endpoint that
+renders everything in the Prometheus text format. Code on the hot paths times its
+stages with stage(), which costs a single attribute check when metrics are disabled.
+
+Streaming responses are timed until their first byte is ready, not until the
+stream ends; the model call behind them is timed in full by model_request_duration.
+
+Configuration keys (all optional):
+	METRICS_ENABLED: Collect metrics and serve /metrics. Defaults to True.
+	METRICS_BUCKETS: Upper bounds in seconds of the latency histogram buckets.
+	METRICS_TRACE_IDS: Give every request a trace ID, taken from the TRACE_ID_HEADER
+		request header when present, echoed in the response and added to every log
+		record of the application logger, which then logs through a handler of its
+		own instead of Flask's default one. Defaults to False.
+	TRACE_ID_HEADER: Header carrying the trace ID. Defaults to "X-Request-ID".
+"""
+
+EXTENSION_KEY = "metrics"
+TRACE_LOG_HANDLER = "trace_ids"
+TRACE_LOG_FORMAT = "[%(asctime)s] %(levelname)s [%(trace_id)s] in %(module)s: %(message)s"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Name: (type, help) of every metric the application records
+DESCRIPTIONS: Dict[str, Tuple[str, str]] = {
+	"http_requests_total": ("counter", "Requests handled, by route, method and status."),
+	"http_request_errors_total": ("counter", "Requests that failed with a 5xx status or an unhandled exception."),
+	"http_request_duration_seconds": ("histogram", "Time to produce a response, by route and method."),
+	"stage_duration_seconds": ("histogram", "Time spent in each stage of a request (model, database, hashing...)."),
+	"mongo_command_duration_seconds": ("histogram", "Round trip time of MongoDB commands."),
+	"mongo_command_failures_total": ("counter", "MongoDB commands that failed."),
+	"mongo_pool_wait_seconds": ("histogram", "Time spent waiting for a pooled MongoDB connection."),
+	"mongo_pool_checkout_failures_total": ("counter", "Failed checkouts of a pooled MongoDB connection, by reason."),
+	"mongo_connections_open": ("gauge", "Open MongoDB connections."),
+	"mongo_connections_checked_out": ("gauge", "MongoDB connections currently in use."),
+	"model_request_duration_seconds": ("histogram", "Latency of model calls, by model and outcome."),
+	"model_prompt_bytes_total": ("counter", "Bytes of prompt sent to the model."),
+	"model_response_bytes_total": ("counter", "Bytes of analysis received from the model."),
+	"model_prompt_tokens_total": ("counter", "Estimated tokens of prompt sent to the model."),
+	"model_response_tokens_total": ("counter", "Estimated tokens of analysis received from the model."),
+	"prompt_compaction_saved_tokens_total": ("counter", "Estimated prompt tokens saved by compacting the code sent to the model."),
+	"component_stat": ("gauge", "Counters reported by the cache, coalescer, rate limiter, model router and hashing pool."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def label_key(labels: Mapping[str, Any]) -> Labels:
+	return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(labels: Labels) -> str:
+	if not labels:
+		return ""
+	escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+	return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(labels, escaped)) + "}"
+
+def format_value(value: float) -> str:
+	return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Histogram:
+	def __init__(self, buckets: Tuple[float, ...]) -> None:
+		self.buckets = buckets
+		self.counts = [0] * len(buckets)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value: float) -> None:
+		for index, bound in enumerate(self.buckets):
+			if value <= bound:
+				self.counts[index] += 1
+				break
+		self.count += 1
+		self.sum += value
+
+class Metrics:
+	"""Thread-safe registry of counters, gauges and histograms keyed by name and labels."""
+
+	def __init__(self, enabled: bool = True, buckets: Iterable[float] = DEFAULT_BUCKETS) -> None:
+		self.enabled = enabled
+		self.buckets = tuple(sorted(buckets))
+		self._values: Dict[str, Dict[Labels, float]] = {}
+		self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+		self._collectors: List[Callable[[], Iterable[Tuple[str, Mapping[str, Any], float]]]] = []
+		self._lock = threading.Lock()
+
+	def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+		"""Add to a counter or gauge; gauges also take negative values."""
+		if not self.enabled:
+			return
+		key = label_key(labels)
+		with self._lock:
+			series = self._values.setdefault(name, {})
+			series[key] = series.get(key, 0) + value
+
+	def observe(self, name: str, value: float, **labels: Any) -> None:
+		if not self.enabled:
+			return
+		key = label_key(labels)
+		with self._lock:
+			series = self._histograms.setdefault(name, {})
+			histogram = series.get(key)
+			if histogram is None:
+				histogram = series[key] = Histogram(self.buckets)
+			histogram.observe(value)
+
+	@contextmanager
+	def time(self, name: str, **labels: Any) -> Iterator[None]:
+		if not self.enabled:
+			yield
+			return
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - started, **labels)
+
+	def record_model_call(self, model: str, duration: float, outcome: str, prompt: str, response: str) -> None:
+		if not self.enabled:
+			return
+		self.observe("model_request_duration_seconds", duration, model=model, outcome=outcome)
+		self.observe("stage_duration_seconds", duration, stage="model")
+		self.inc("model_prompt_bytes_total", len(prompt.encode("utf-8")), model=model)
+		self.inc("model_response_bytes_total", len(response.encode("utf-8")), model=model)
+		self.inc("model_prompt_tokens_total", estimate_tokens(prompt), model=model)
+		self.inc("model_response_tokens_total", estimate_tokens(response), model=model)
+
+	def add_collector(self, collector: Callable[[], Iterable[Tuple[str, Mapping[str, Any], float]]]) -> None:
+		"""Register a callback returning (name, labels, value) gauges, evaluated at each scrape."""
+		self._collectors.append(collector)
+
+	def value(self, name: str, **labels: Any) -> float:
+		with self._lock:
+			return self._values.get(name, {}).get(label_key(labels), 0)
+
+	def histogram(self, name: str, **labels: Any) -> Optional[Histogram]:
+		with self._lock:
+			return self._histograms.get(name, {}).get(label_key(labels))
+
+	def mongo_listeners(self) -> List[Any]:
+		return [MongoCommandListener(self), MongoPoolListener(self)] if self.enabled else []
+
+	def render(self) -> str:
+		collected: Dict[str, Dict[Labels, float]] = {}
+		for collector in self._collectors:
+			try:
+				for name, labels, value in collector():
+					collected.setdefault(name, {})[label_key(labels)] = value
+			except Exception as e:
+				print(e)
+
+		lines: List[str] = []
+		with self._lock:
+			names = sorted(set(self._values) | set(self._histograms) | set(collected))
+			for name in names:
+				kind, description = DESCRIPTIONS.get(name, ("untyped", name))
+				lines.append(f"# HELP {name} {description}")
+				lines.append(f"# TYPE {name} {kind}")
+
+				for labels, value in sorted({ **self._values.get(name, {}), **collected.get(name, {}) }.items()):
+					lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+				for labels, histogram in sorted(self._histograms.get(name, {}).items()):
+					cumulative = 0
+					for bound, count in zip(histogram.buckets, histogram.counts):
+						cumulative += count
+						lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {cumulative}")
+					lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+					lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram.sum)}")
+					lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+		return "\n".join(lines) + "\n"
+
+class MongoCommandListener(monitoring.CommandListener):
+	def __init__(self, metrics: Metrics) -> None:
+		self.metrics = metrics
+
+	def started(self, event: monitoring.CommandStartedEvent) -> None:
+		pass
+
+	def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+		self.metrics.observe("mongo_command_duration_seconds", event.duration_micros / 1e6, command=event.command_name)
+
+	def failed(self, event: monitoring.CommandFailedEvent) -> None:
+		self.metrics.observe("mongo_command_duration_seconds", event.duration_micros / 1e6, command=event.command_name)
+		self.metrics.inc("mongo_command_failures_total", command=event.command_name)
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+	def __init__(self, metrics: Metrics) -> None:
+		self.metrics = metrics
+
+	def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+		pass
+
+	def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+		pass
+
+	def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+		pass
+
+	def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+		pass
+
+	def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+		self.metrics.inc("mongo_connections_open")
+
+	def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+		pass
+
+	def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+		self.metrics.inc("mongo_connections_open", -1)
+
+	def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent) -> None:
+		pass
+
+	def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent) -> None:
+		self.metrics.inc("mongo_pool_checkout_failures_total", reason=event.reason)
+
+	def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent) -> None:
+		self.metrics.inc("mongo_connections_checked_out")
+		if event.duration is not None:
+			self.metrics.observe("mongo_pool_wait_seconds", event.duration)
+
+	def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+		self.metrics.inc("mongo_connections_checked_out", -1)
+
+class TraceIdFilter(logging.Filter):
+	"""Adds the trace ID of the current request (or "-") to every log record."""
+
+	def filter(self, record: logging.LogRecord) -> bool:
+		record.trace_id = g.get("trace_id", "-") if has_app_context() else "-"
+		return True
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+	"""Time a stage of the current request; a no-op outside of an application or when disabled."""
+	metrics = current_app.extensions.get(EXTENSION_KEY) if has_app_context() else None
+	if metrics is None or not metrics.enabled:
+		yield
+		return
+	with metrics.time("stage_duration_seconds", stage=name):
+		yield
+
+def collect_components(application: Flask) -> Iterable[Tuple[str, Mapping[str, Any], float]]:
+	components = {
+		"cache": lambda: application.extensions["analysis_cache"].stats(),
+		"coalescing": lambda: application.extensions["singleflight"].stats(),
+		"ratelimit": lambda: application.extensions["rate_limiter"].stats(),
+		"writes": lambda: application.extensions["codes_writer"].stats(),
+		"routing": lambda: application.extensions["model_router"].stats(),
+	}
+	for component, read in components.items():
+		for name, value in read().items():
+			if isinstance(value, (int, float)):
+				yield "component_stat", { "component": component, "name": name }, value
+
+	for operation, timing in application.extensions["password_hasher"].stats().items():
+		if isinstance(timing, dict):
+			for name, value in timing.items():
+				yield "component_stat", { "component": "hashing", "name": f"{operation}_{name}" }, value
+		else:
+			yield "component_stat", { "component": "hashing", "name": operation }, timing
+
+def init_metrics(application: Flask) -> Metrics:
+	configuration = application.config
+	metrics = Metrics(configuration.get("METRICS_ENABLED", True), configuration.get("METRICS_BUCKETS", DEFAULT_BUCKETS))
+	application.extensions[EXTENSION_KEY] = metrics
+
+	if not metrics.enabled:
+		return metrics
+
+	trace_ids: bool = configuration.get("METRICS_TRACE_IDS", False)
+	trace_header: str = configuration.get("TRACE_ID_HEADER", "X-Request-ID")
+
+	# Flask's default handler is shared by every logger, so the application gets its own.
+	# Application loggers are shared by name too, hence the check for an earlier one
+	if trace_ids and not any(handler.get_name() == TRACE_LOG_HANDLER for handler in application.logger.handlers):
+		handler = logging.StreamHandler(wsgi_errors_stream)
+		handler.set_name(TRACE_LOG_HANDLER)
+		handler.setFormatter(logging.Formatter(TRACE_LOG_FORMAT))
+		handler.addFilter(TraceIdFilter())
+		application.logger.addHandler(handler)
+		application.logger.removeHandler(default_handler)
+
+	@application.before_request
+	def start_timer() -> None:
+		g.request_started = time.perf_counter()
+		if trace_ids:
+			g.trace_id = request.headers.get(trace_header) or uuid.uuid4().hex
+
+	@application.after_request
+	def record_request(response: Response) -> Response:
+		started = g.pop("request_started", None)
+		if started is None:
+			return response
+
+		endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+		metrics.observe("http_request_duration_seconds", time.perf_counter() - started, method=request.method, endpoint=endpoint)
+		metrics.inc("http_requests_total", method=request.method, endpoint=endpoint, status=response.status_code)
+		if response.status_code >= 500:
+			metrics.inc("http_request_errors_total", method=request.method, endpoint=endpoint)
+
+		if trace_ids:
+			response.headers[trace_header] = g.trace_id
+		return response
+
+	@application.teardown_request
+	def record_failure(error: Optional[BaseException]) -> None:
+		# after_request does not run when a handler raises, so the timer is still set
+		started = g.pop("request_started", None)
+		if error is not None and started is not None:
+			endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+			metrics.observe("http_request_duration_seconds", time.perf_counter() - started, method=request.method, endpoint=endpoint)
+			metrics.inc("http_request_errors_total", method=request.method, endpoint=endpoint)
+
+	metrics.add_collector(lambda: collect_components(application))
+
+	@application.route("/metrics", methods=["GET"])
+	def metrics_endpoint() -> Response:
+		return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+	return metrics
+
+def get_metrics(application: Optional[Flask] = None) -> Metrics:
+	return (application or current_app).extensions[EXTENSION_KEY]
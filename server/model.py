@@ -0,0 +1,196 @@
+import os
+import time
+import asyncio
+import threading
+
+from typing import Any, Iterator, Mapping, Optional
+from flask import Flask, current_app
+from server.chunking import estimate_tokens
+"""
+Model client layer.
+
+One backend is created per process by create_application() and shared by every
+request, so the google-genai import, client construction and HTTP connection pool
+are paid once instead of per submission.
+
+Both backends offer generate() and, for the async serving mode (see server.asgi),
+an agenerate() coroutine that waits on the event loop instead of a thread.
+
+Backends:
+	GeminiBackend: google-genai client with keep-alive pooling, per-call timeouts and
+		retries with exponential backoff on rate limits and transient 5xx responses.
+	FakeBackend: Local stand-in with a canned answer and injectable latency, for tests
+		and benchmarks that must not reach the network.
+
+Configuration keys (all optional):
+	MODEL_BACKEND: "gemini" (default) or "fake".
+	MODEL_CLIENT: A ready-made backend instance used instead of building one.
+	MODEL_API_KEY: API key. Falls back to the API_KEY environment variable.
+	MODEL_TIMEOUT: Seconds before a model call is abandoned. Defaults to 60.
+	MODEL_RETRY_ATTEMPTS: Attempts per call, including the first. Defaults to 3.
+		Calls given a timeout of their own make a single attempt.
+	MODEL_RETRY_INITIAL_DELAY / MODEL_RETRY_MAX_DELAY: Backoff bounds in seconds.
+		Default to 1 and 10.
+	MODEL_MAX_CONNECTIONS / MODEL_MAX_KEEPALIVE: HTTP pool limits. Default to 100 and 20.
+	MODEL_EAGER_INIT: Import google-genai and build the client at startup instead of
+		on the first call. Defaults to False.
+	FAKE_MODEL_RESPONSE: Answer of the fake backend. "{lines}" and "{model}" are
+		substituted. Defaults to "Analysis of {lines} line(s) by {model}.".
+	FAKE_MODEL_LATENCY: Seconds the fake backend takes per call. Defaults to 0.
+	FAKE_MODEL_LATENCY_PER_1K_TOKENS: Extra seconds per thousand estimated prompt
+		tokens, to model latency growing with input size. Defaults to 0.
+"""
+
+EXTENSION_KEY = "model_backend"
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+class GeminiBackend:
+	"""Shares one google-genai client (and its HTTP connection pool) per process."""
+
+	def __init__(self, configuration: Mapping[str, Any]) -> None:
+		self.api_key: str = configuration.get("MODEL_API_KEY") or os.getenv("API_KEY", "")
+		self.timeout: float = configuration.get("MODEL_TIMEOUT", 60)
+		self.retry_attempts: int = configuration.get("MODEL_RETRY_ATTEMPTS", 3)
+		self.retry_initial_delay: float = configuration.get("MODEL_RETRY_INITIAL_DELAY", 1.0)
+		self.retry_max_delay: float = configuration.get("MODEL_RETRY_MAX_DELAY", 10.0)
+		self.max_connections: int = configuration.get("MODEL_MAX_CONNECTIONS", 100)
+		self.max_keepalive: int = configuration.get("MODEL_MAX_KEEPALIVE", 20)
+		self._client: Any = None
+		self._pid: Optional[int] = None
+		self._lock = threading.Lock()
+
+	@property
+	def client(self) -> Any:
+		# The HTTP pool holds sockets, so a forked worker builds its own client
+		if self._client is None or self._pid != os.getpid():
+			with self._lock:
+				if self._client is None or self._pid != os.getpid():
+					self._client = self._create_client()
+					self._pid = os.getpid()
+		return self._client
+
+	def _create_client(self) -> Any:
+		import httpx
+		from google import genai
+		from google.genai import types
+
+		return genai.Client(api_key=self.api_key, http_options=types.HttpOptions(
+			timeout=int(self.timeout * 1000),
+			retry_options=types.HttpRetryOptions(
+				attempts=self.retry_attempts,
+				initial_delay=self.retry_initial_delay,
+				max_delay=self.retry_max_delay,
+				exp_base=2,
+				http_status_codes=RETRY_STATUS_CODES
+			),
+			client_args={ "limits": httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive) }
+		))
+
+	def _config(self, timeout: Optional[float]) -> Any:
+		if timeout is None:
+			return None
+
+		# Retries with backoff would outlast a deadline, so a call with one makes a
+		# single attempt and the router falls back instead (see server.routing)
+		from google.genai import types
+		return types.GenerateContentConfig(http_options=types.HttpOptions(
+			timeout=max(1, int(timeout * 1000)),
+			retry_options=types.HttpRetryOptions(attempts=1)
+		))
+
+	def warmup(self) -> None:
+		self.client
+
+	def generate(self, model: str, prompt: str, timeout: Optional[float] = None) -> str | None:
+		response = self.client.models.generate_content(model=model, contents=prompt, config=self._config(timeout))
+		return response.text
+
+	async def agenerate(self, model: str, prompt: str, timeout: Optional[float] = None) -> str | None:
+		# The async client shares the HTTP options (and retries) of the sync one
+		response = await self.client.aio.models.generate_content(model=model, contents=prompt, config=self._config(timeout))
+		return response.text
+
+	def generate_stream(self, model: str, prompt: str, timeout: Optional[float] = None) -> Iterator[str]:
+		stream = self.client.models.generate_content_stream(model=model, contents=prompt, config=self._config(timeout))
+		try:
+			for chunk in stream:
+				if chunk.text:
+					yield chunk.text
+		finally:
+			stream.close()
+
+	def close(self) -> None:
+		if self._client is not None and self._pid == os.getpid():
+			self._client.close()
+		self._client = None
+
+class FakeBackend:
+	"""Answers locally after an injectable delay; never touches the network."""
+
+	def __init__(self, response: str = "Analysis of {lines} line(s) by {model}.", latency: float = 0.0, token_latency: float = 0.0) -> None:
+		self.response = response
+		self.latency = latency
+		self.token_latency = token_latency
+		self.calls = 0
+		self._lock = threading.Lock()
+
+	def _answer(self, model: str, prompt: str) -> str:
+		with self._lock:
+			self.calls += 1
+		return self.response.format(lines=prompt.count("\n") + 1, model=model)
+
+	def _latency(self, prompt: str) -> float:
+		return self.latency + self.token_latency * estimate_tokens(prompt) / 1000
+
+	def warmup(self) -> None:
+		pass
+
+	def generate(self, model: str, prompt: str, timeout: Optional[float] = None) -> str | None:
+		latency = self._latency(prompt)
+		if latency:
+			time.sleep(latency if timeout is None else min(latency, timeout))
+			if timeout is not None and latency > timeout:
+				raise TimeoutError("Fake model call timed out")
+		return self._answer(model, prompt)
+
+	async def agenerate(self, model: str, prompt: str, timeout: Optional[float] = None) -> str | None:
+		latency = self._latency(prompt)
+		if latency:
+			await asyncio.sleep(latency if timeout is None else min(latency, timeout))
+			if timeout is not None and latency > timeout:
+				raise TimeoutError("Fake model call timed out")
+		return self._answer(model, prompt)
+
+	def generate_stream(self, model: str, prompt: str, timeout: Optional[float] = None) -> Iterator[str]:
+		latency = self._latency(prompt)
+		words = self._answer(model, prompt).split(" ")
+		for index, word in enumerate(words):
+			if latency:
+				time.sleep(latency / len(words))
+			yield word if index == len(words) - 1 else word + " "
+
+	def close(self) -> None:
+		pass
+
+def init_model(application: Flask) -> Any:
+	configuration = application.config
+	backend = configuration.get("MODEL_CLIENT")
+
+	if backend is None:
+		if configuration.get("MODEL_BACKEND", "gemini") == "fake":
+			backend = FakeBackend(
+				configuration.get("FAKE_MODEL_RESPONSE", "Analysis of {lines} line(s) by {model}."),
+				configuration.get("FAKE_MODEL_LATENCY", 0.0),
+				configuration.get("FAKE_MODEL_LATENCY_PER_1K_TOKENS", 0.0)
+			)
+		else:
+			backend = GeminiBackend(configuration)
+
+	if configuration.get("MODEL_EAGER_INIT", False):
+		backend.warmup()
+
+	application.extensions[EXTENSION_KEY] = backend
+	return backend
+
+def get_model() -> Any:
+	return current_app.extensions[EXTENSION_KEY]
@@ -0,0 +1,237 @@
+import math
+import time
+import asyncio
+import datetime
+import threading
+
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Mapping, Optional, Tuple
+from flask import Flask, current_app
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from server.cache import LRUCache
+from server.indexes import get_collection
+"""
+Admission control for model calls.
+
+Requests that start model calls pass through token buckets, one per session user and
+one for the whole process, and every model call holds a slot of a process-wide
+concurrency semaphore. A request over its limits is refused with 429 and a
+Retry-After header instead of queueing. A batch costs one token per snippet, so a
+batch costing more than a bucket holds could never be admitted and is refused with
+413 instead: the largest batch is the smallest of RATE_LIMIT_USER_BURST,
+RATE_LIMIT_GLOBAL_BURST and, with RATE_LIMIT_SHARED, the per-minute limits, which
+must be raised together with BATCH_MAX_ITEMS for larger batches.
+
+With RATE_LIMIT_SHARED the per-minute limits are also enforced across worker
+processes by fixed one-minute windows counted in the "rate_limits" collection.
+
+Configuration keys (all optional):
+	RATE_LIMIT_ENABLED: Turn rate limiting on or off. Defaults to True.
+	RATE_LIMIT_USER_PER_MINUTE / RATE_LIMIT_USER_BURST: Sustained rate and bucket
+		size per user. Default to 30 and 10.
+	RATE_LIMIT_GLOBAL_PER_MINUTE / RATE_LIMIT_GLOBAL_BURST: Same for the process.
+		Default to 600 and 100.
+	RATE_LIMIT_MODEL_CONCURRENCY: Model calls in flight per process. Defaults to 16.
+	RATE_LIMIT_MODEL_WAIT: Seconds a model call waits for a free slot. Defaults to 5.
+		A call with a deadline waits no longer than its time left, then times out.
+	RATE_LIMIT_SHARED: Also count requests per minute in MongoDB. Defaults to False.
+"""
+
+LIMITS_COLLECTION = "rate_limits"
+EXTENSION_KEY = "rate_limiter"
+
+class RateLimited(Exception):
+	"""Raised when a request or model call is over its limit."""
+
+	def __init__(self, scope: str, retry_after: float) -> None:
+		super().__init__(scope)
+		self.scope = scope
+		self.retry_after = retry_after
+
+class CostTooHigh(Exception):
+	"""Raised when a request costs more than its limits could ever admit."""
+
+	def __init__(self, cost: int, limit: int) -> None:
+		super().__init__(f"Cost {cost} is over the limit of {limit}")
+		self.cost = cost
+		self.limit = limit
+
+class TokenBucket:
+	"""Refills at rate tokens per second up to capacity; not thread-safe on its own."""
+
+	def __init__(self, rate: float, capacity: float) -> None:
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+
+	def take(self, cost: float = 1) -> Tuple[bool, float]:
+		"""Take cost tokens, or return False with the seconds until they will be available."""
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+		if self.tokens >= cost:
+			self.tokens -= cost
+			return True, 0.0
+		return False, (cost - self.tokens) / self.rate
+
+class MongoWindow:
+	"""Per-minute request counters shared by every worker process."""
+
+	def hit(self, scope: str, limit: int, cost: int, now: datetime.datetime) -> Tuple[bool, float]:
+		window = now.replace(second=0, microsecond=0)
+		counter = get_collection(LIMITS_COLLECTION).find_one_and_update(
+			{ "_id": f"{scope}:{window.isoformat()}" },
+			{ "$inc": { "count": cost }, "$setOnInsert": { "expires_at": window + datetime.timedelta(minutes=2) } },
+			upsert=True,
+			return_document=ReturnDocument.AFTER
+		)
+
+		if counter["count"] > limit:
+			return False, 60 - (now - window).total_seconds()
+		return True, 0.0
+
+	def refund(self, scope: str, cost: int, now: datetime.datetime) -> None:
+		"""Give back cost to the window a hit at now was counted in."""
+		window = now.replace(second=0, microsecond=0)
+		get_collection(LIMITS_COLLECTION).update_one({ "_id": f"{scope}:{window.isoformat()}" }, { "$inc": { "count": -cost } })
+
+class RateLimiter:
+	def __init__(self, configuration: Mapping[str, Any]) -> None:
+		self.enabled: bool = configuration.get("RATE_LIMIT_ENABLED", True)
+		self.user_per_minute: int = configuration.get("RATE_LIMIT_USER_PER_MINUTE", 30)
+		self.user_burst: int = configuration.get("RATE_LIMIT_USER_BURST", 10)
+		self.global_per_minute: int = configuration.get("RATE_LIMIT_GLOBAL_PER_MINUTE", 600)
+		self.global_burst: int = configuration.get("RATE_LIMIT_GLOBAL_BURST", 100)
+		self.model_concurrency: int = configuration.get("RATE_LIMIT_MODEL_CONCURRENCY", 16)
+		self.model_wait: float = configuration.get("RATE_LIMIT_MODEL_WAIT", 5)
+		self.shared = MongoWindow() if configuration.get("RATE_LIMIT_SHARED", False) else None
+		# Highest cost every limit can admit at once
+		self.max_cost: int = min(self.user_burst, self.global_burst)
+		if self.shared is not None:
+			self.max_cost = min(self.max_cost, self.user_per_minute, self.global_per_minute)
+
+		# An evicted bucket would have refilled completely by the time it expires; buckets
+		# are stored again on every take, so they expire once idle, not once old
+		self._users = LRUCache(max_size=10000, ttl_seconds=60 * self.user_burst / self.user_per_minute)
+		self._global = TokenBucket(self.global_per_minute / 60, self.global_burst)
+		self._slots = threading.BoundedSemaphore(self.model_concurrency)
+		self._lock = threading.Lock()
+		self._in_flight = 0
+		self._counters: Dict[str, int] = { "allowed": 0, "limited_user": 0, "limited_global": 0, "limited_concurrency": 0 }
+
+	def _count(self, name: str) -> None:
+		with self._lock:
+			self._counters[name] += 1
+
+	def check(self, user: str, cost: int = 1) -> None:
+		"""Admit a request of the given cost for a user, or raise RateLimited; CostTooHigh when it never could be."""
+		if not self.enabled:
+			return
+		if cost > self.max_cost:
+			raise CostTooHigh(cost, self.max_cost)
+
+		with self._lock:
+			bucket = self._users.get(user) or TokenBucket(self.user_per_minute / 60, self.user_burst)
+			self._users.set(user, bucket)
+
+			allowed, retry_after = bucket.take(cost)
+			scope = "user"
+			if allowed:
+				allowed, retry_after = self._global.take(cost)
+				scope = "global"
+				if not allowed:
+					# Refund the user so a global limit does not also spend their quota
+					bucket.tokens = min(bucket.capacity, bucket.tokens + cost)
+
+		if allowed and self.shared is not None:
+			try:
+				now = datetime.datetime.now(datetime.timezone.utc)
+				allowed, retry_after = self.shared.hit(f"user:{user}", self.user_per_minute, cost, now)
+				scope = "user"
+				if allowed:
+					allowed, retry_after = self.shared.hit("global", self.global_per_minute, cost, now)
+					scope = "global"
+					if not allowed:
+						self.shared.refund(f"user:{user}", cost, now)
+			except PyMongoError as e:
+				# Keep serving on the in-process limits when MongoDB is unavailable
+				print(e)
+				allowed = True
+
+		if not allowed:
+			self._count(f"limited_{scope}")
+			raise RateLimited(scope, retry_after)
+		self._count("allowed")
+
+	def _slot_unavailable(self, wait: Optional[float]) -> Exception:
+		# Running out of the caller's own time is a timeout, not a rate limit
+		if wait is not None and wait < self.model_wait:
+			return TimeoutError("No model call slot freed up within the deadline")
+		self._count("limited_concurrency")
+		return RateLimited("concurrency", 1.0)
+
+	@contextmanager
+	def model_slot(self, wait: Optional[float] = None) -> Iterator[None]:
+		"""Hold one of the process-wide model call slots for the duration of a call, waiting at most wait seconds for it."""
+		if not self.enabled:
+			yield
+			return
+
+		if not self._slots.acquire(timeout=self.model_wait if wait is None else max(0.0, min(wait, self.model_wait))):
+			raise self._slot_unavailable(wait)
+
+		with self._lock:
+			self._in_flight += 1
+		try:
+			yield
+		finally:
+			with self._lock:
+				self._in_flight -= 1
+			self._slots.release()
+
+	async def _acquire_async(self, wait: float) -> bool:
+		"""Wait for a slot on a thread; a slot taken after the caller was cancelled is handed back."""
+		waiter = asyncio.ensure_future(asyncio.to_thread(self._slots.acquire, True, wait))
+		try:
+			# shield() lets the thread's result arrive even when the caller is cancelled
+			return await asyncio.shield(waiter)
+		except asyncio.CancelledError:
+			waiter.add_done_callback(lambda future: self._slots.release() if not future.cancelled() and future.result() else None)
+			raise
+
+	@asynccontextmanager
+	async def model_slot_async(self, wait: Optional[float] = None) -> AsyncIterator[None]:
+		"""model_slot() for coroutines; waiting for a slot does not block the event loop."""
+		if not self.enabled:
+			yield
+			return
+
+		if not self._slots.acquire(blocking=False) and not await self._acquire_async(self.model_wait if wait is None else max(0.0, min(wait, self.model_wait))):
+			raise self._slot_unavailable(wait)
+
+		with self._lock:
+			self._in_flight += 1
+		try:
+			yield
+		finally:
+			with self._lock:
+				self._in_flight -= 1
+			self._slots.release()
+
+	def stats(self) -> Dict[str, int]:
+		with self._lock:
+			return { **self._counters, "model_calls_in_flight": self._in_flight, "tracked_users": len(self._users) }
+
+def retry_after_header(error: RateLimited) -> Dict[str, str]:
+	return { "Retry-After": str(max(1, math.ceil(error.retry_after))) }
+
+def init_ratelimit(application: Flask) -> RateLimiter:
+	limiter = RateLimiter(application.config)
+	application.extensions[EXTENSION_KEY] = limiter
+	return limiter
+
+def get_limiter() -> RateLimiter:
+	return current_app.extensions[EXTENSION_KEY]
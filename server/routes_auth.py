@@ -1,7 +1,9 @@
 from typing import Tuple, Dict
 from flask import Blueprint, request, session
-from werkzeug.security import generate_password_hash, check_password_hash
-from server.database import connect_database
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from server.indexes import get_collection
+from server.hashing import HashingBusy, get_hasher
+from server.metrics import stage
 """
 Functions:
 	hello_world() -> dict[str, str]:
@@ -14,6 +16,7 @@ Functions:
 				201: User registered successfully
 				400: Missing username or password
 				409: Username already exists
+				503: Password hashing pool is saturated (with Retry-After)
 	login_user() -> Tuple[Dict[str, str], int]:
 		Authenticates user credentials and creates a session.
 			tuple: A tuple containing response message and HTTP status code.
@@ -22,6 +25,9 @@ Functions:
 				400: Missing username or password
 				401: Incorrect password
 				404: User does not exist
+				503: Password hashing pool is saturated (with Retry-After)
+			A stored hash made with outdated PASSWORD_HASH_METHOD parameters is
+			replaced after a successful login.
 	logout() -> Dict[str, str]:
 		Clears user session.
 			dict: A dictionary containing logout confirmation message.
@@ -38,6 +44,10 @@ Note:
 
 routes_blueprint = Blueprint("routes", __name__)
 
+@routes_blueprint.errorhandler(HashingBusy)
+def hashing_busy(error: HashingBusy) -> Tuple[Dict[str, str], int, Dict[str, str]]:
+	return ({"error": "Server is busy, try again later"}, 503, {"Retry-After": "1"})
+
 # Initial route for testing
 @routes_blueprint.route("/initial", methods=["GET"])
 def hello_world() -> dict[str, str]:
@@ -46,7 +56,7 @@ def hello_world() -> dict[str, str]:
 # Route for registering a user
 @routes_blueprint.route("/register", methods=["POST"])
 def register_user() -> Tuple[Dict[str, str], int]:
-	database = connect_database()
+	users = get_collection("users")
 
 	data = request.get_json()
 	username = data.get("username")
@@ -55,17 +65,21 @@ def register_user() -> Tuple[Dict[str, str], int]:
 	if not username or not password:
 		return ({"error": "Missing username or password"}, 400)
 
-	if database["users"].find_one({ "username": username }):
+	# The unique index on username makes the insert itself the existence check
+	with stage("password_hash"):
+		hashed_pw = get_hasher().hash(password)
+	try:
+		with stage("database_write"):
+			users.insert_one({ "username": username, "password": hashed_pw })
+	except DuplicateKeyError:
 		return ({"error": "Username already exists"}, 409)
 
-	hashed_pw = generate_password_hash(password)
-	database["users"].insert_one({ "username": username, "password": hashed_pw })
 	return ({"message": "User registered successfully"}, 201)
 
 # Route for user login
 @routes_blueprint.route("/login", methods=["POST"])
 def login_user() -> Tuple[Dict[str, str], int]:
-	database = connect_database()
+	users = get_collection("users")
 
 	data = request.get_json()
 	username = data.get("username")
@@ -74,13 +88,25 @@ def login_user() -> Tuple[Dict[str, str], int]:
 	if not username or not password:
 		return ({"error": "Missing username or password"}, 400)
 
-	user = database["users"].find_one({"username": username})
+	with stage("database_read"):
+		user = users.find_one({"username": username}, {"password": 1})
 	if not user:
 		return ({"error": "User does not exist"}, 404)
 
-	if not check_password_hash(user.get("password"), password):
+	hasher = get_hasher()
+	with stage("password_verify"):
+		verified = hasher.verify(user.get("password"), password)
+	if not verified:
 		return ({"error": "Incorrect password"}, 401)
 
+	if hasher.needs_rehash(user["password"]):
+		# Best effort: the login stands even when the upgrade has to wait for the next one.
+		# Conditional on the old hash so a concurrent password change is not overwritten
+		try:
+			users.update_one({ "_id": user["_id"], "password": user["password"] }, { "$set": { "password": hasher.hash(password) } })
+		except (HashingBusy, PyMongoError) as e:
+			print(e)
+
 	session["user"] = str(user["_id"])
 	session["logged_in"] = True
 	return ({"message": "User login successfully"}, 200)
@@ -1,15 +1,78 @@
-import os
+import json
 
-from typing import Dict, Tuple, List
-from flask import Blueprint, session, request
-from server.utils import submit_to_database
-from server.database import connect_database
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, Tuple, List
+from flask import Blueprint, Response, current_app, session, request, stream_with_context
+from pymongo import DESCENDING
+from pymongo.errors import ExecutionTimeout
+from server.utils import parse_object_id, submit_to_database, submit_many_to_database
+from server.indexes import get_collection
+from server.analysis import Analysis, analyze_code, analyze_incremental, compaction_report, deadline_fallback, route_record, stream_analysis, lookup_cached, store_cached
+from server.static_analysis import analyze_static, local_answer
+from server.cache import get_cache
+from server.singleflight import get_flights
+from server.metrics import stage
+from server.ratelimit import CostTooHigh, RateLimited, get_limiter, retry_after_header
+from server.jobs import FINISHED_STATUSES, QueueFull, get_jobs, serialize_job
+from server.writer import WriteBufferFull, get_writer
+from server.search import get_search, highlight
+from server.routing import Routed, get_router
 """
 Flask Blueprint for code analysis functionality.
 This module provides endpoints for submitting and analyzing code using Google's Generative AI.
 Requires authentication for all routes.
 Routes:
-	/submit (GET): Submit code for analysis using Gemini AI model
+	/submit (GET): Submit code for analysis using Gemini AI model. Identical code
+		is answered from the analysis cache; pass ?cache=0 or a
+		"Cache-Control: no-cache" header to force a fresh analysis. With ?async=1
+		the analysis runs in the background and a job id is returned at once.
+		Large submissions are analyzed in chunks; the response then lists each
+		chunk's line range under "chunks". A local static report (syntax errors,
+		complexity, long functions, unused imports) is returned under "static";
+		?static_only=1 returns only that report, and trivial or unparsable code can
+		be answered from it without the model (STATIC_ANSWER_TRIVIAL,
+		STATIC_ANSWER_UNPARSABLE), flagged by "local". Pass "language" in the body
+		for non-Python code. When the code sent to the model was compacted (see
+		server.compaction), "compaction" reports the estimated tokens saved.
+		Pass "previous_id" (the message_id of an earlier submission) to re-analyze
+		only the top-level functions and classes that changed since then; unchanged
+		ones reuse their stored analysis, and "incremental" lists which units were
+		reused, analyzed, failed or removed. ?incremental=1 stores per-unit results
+		without a previous submission. The analysis must be ready by the deadline
+		given in milliseconds by the X-Request-Deadline-Ms header (MODEL_DEADLINE
+		by default); models are picked and fallen back on within it, and "route"
+		names the fallback that served the submission, if any (see server.routing).
+	/submit/stream (GET): Same as /submit, but the analysis is streamed as it is
+		generated, as Server-Sent Events (default) or NDJSON (?format=ndjson).
+		Every piece arrives as a "chunk" event with a "text" field; a final "done"
+		event carries the "message_id" of the stored record (and "compaction"), or
+		an "error" event reports a failure. Disconnecting cancels the upstream
+		generation.
+	/submit/batch (GET): Analyze a list of snippets ({"codes": [...]}) concurrently,
+		at most BATCH_PARALLELISM (default 8) at a time and BATCH_MAX_ITEMS (default
+		100) per request. Every item gets its own result or error; one failing item
+		does not fail the batch. Each snippet counts against the rate limits, so a
+		batch holds at most as many snippets as they admit at once (see
+		server.ratelimit); with the default RATE_LIMIT_USER_BURST of 10 that is 10
+		snippets, and BATCH_MAX_ITEMS only takes effect once the burst (and, with
+		RATE_LIMIT_SHARED, the per-minute limits) are raised with it. A larger batch
+		is refused with 413.
+	/all (GET): The current user's submissions, newest first, as pages of at most
+		?limit= records (CODES_PAGE_SIZE, capped by CODES_MAX_PAGE_SIZE). Pass the
+		returned "next_cursor" as ?cursor= to fetch the following page, ?fields=
+		(e.g. "response" or "") to skip large bodies, and ?format=ndjson to stream
+		every record for an export.
+	/search (GET): The current user's submissions matching ?q=, most relevant
+		first. Terms match in any form ("injection" finds "injected"), "quoted
+		phrases" must all appear and -term excludes records. Each result carries
+		its "score" and, unless ?highlight=0, "highlights": a snippet per matching
+		field with the [start, end] offsets of the matches in it. Pages work like
+		/all (?limit=, ?cursor=next_cursor, ?fields=). See server.search.
+	/jobs/<job_id> (GET): Status and, once finished, result of an async submission
+	/jobs/<job_id>/wait (GET): Same as /jobs/<job_id>, but blocks up to ?timeout=
+		seconds for the job to finish
+	/cache (GET): Analysis cache hit and miss counters, and coalescing counters
+	/limits (GET): Rate limiter counters
 Dependencies:
 	- Flask
 	- Google GenerativeAI client
@@ -17,56 +80,398 @@ Dependencies:
 Functions:
 	check_user(): Middleware to verify user authentication
 	submit_code(): Endpoint to handle code submission and analysis
+	submit_code_stream(): Endpoint streaming the analysis of a submission
+	submit_code_batch(): Endpoint analyzing several submissions in one request
+	get_codes(): Endpoint listing the user's submissions
+	search_codes(): Endpoint searching the user's submissions
+	get_job(): Endpoint reporting the state of an async submission
+	wait_job(): Endpoint waiting for an async submission to finish
+	cache_stats(): Endpoint reporting analysis cache counters
+	limit_stats(): Endpoint reporting rate limiter counters
 Returns:
 	Tuple containing response dictionary and HTTP status code
 Error Codes:
 	- 401: User not authenticated
-	- 400: Empty code submission
-	- 503: AI model failed to generate response
+	- 400: Empty code submission or search query, or malformed cursor
+	- 404: Unknown job or previous submission
+	- 429: Over the per-user, global or concurrent model call limits (with Retry-After)
+	- 503: AI model failed to generate response, or the job queue or write buffer
+		is full (see server.writer)
+	- 504: No model answered within the deadline and no fallback was available
 """
 
 code_blueprint = Blueprint("code", __name__)
 
-# Middleware to check if user is authenticated or not
+# Fields a listing may project; "_id" is always returned
+CODE_FIELDS = ("code", "response")
+
+# Endpoints that may start model calls and therefore pass admission control
+MODEL_ENDPOINTS = ("code.submit_code", "code.submit_code_stream", "code.submit_code_batch")
+
+# Middleware to check if user is authenticated or not, and within their model call limits
 @code_blueprint.before_request
 def check_user() -> Tuple[Dict[str, str], int] | None:
 	user_logged_in = session.get("logged_in", False)
 
 	if not user_logged_in:
 		return ({"error": "Login credentials are invalid"}, 401)
+
+	if request.endpoint in MODEL_ENDPOINTS and not flag("static_only"):
+		data = request.get_json(silent=True) or {}
+		codes = data.get("codes") if request.endpoint == "code.submit_code_batch" else None
+		get_limiter().check(session["user"], len(codes) if isinstance(codes, list) and codes else 1)
 	
 	return None
 
+@code_blueprint.errorhandler(RateLimited)
+def rate_limited(error: RateLimited) -> Tuple[Dict[str, str], int, Dict[str, str]]:
+	return ({"error": "Too many requests, try again later"}, 429, retry_after_header(error))
+
+@code_blueprint.errorhandler(CostTooHigh)
+def cost_too_high(error: CostTooHigh) -> Tuple[Dict[str, str], int]:
+	return ({"error": f"At most {error.limit} codes can be submitted at once"}, 413)
+
+@code_blueprint.errorhandler(WriteBufferFull)
+def write_buffer_full(error: WriteBufferFull) -> Tuple[Dict[str, str], int, Dict[str, str]]:
+	return ({"error": "Too many pending writes, try again later"}, 503, { "Retry-After": "1" })
+
 # Submit the code to the server
 @code_blueprint.route("/submit", methods=["GET"])
 def submit_code() -> Tuple[Dict[str, str], int]:
+	router = get_router()
+	deadline = router.deadline(request.headers.get(router.header))
 	data = request.get_json()
 	code = data.get("code", "")
 
 	if not code:
 		return ({"error": "Code provided is empty"}, 400)
-	
-	from google import genai
 
-	client = genai.Client(api_key=os.getenv("API_KEY", ""))
-	response = client.models.generate_content(model="gemini-2.5-flash-lite", contents=f"Analyze:\n\n{code}")
+	with stage("static_analysis"):
+		report = analyze_static(code, current_app.config, data.get("language", "python"))
+	if flag("static_only"):
+		return ({"static": report}, 200)
+
+	if flag("async"):
+		try:
+			job_id = get_jobs().submit(code, session["user"], use_cache=use_cache())
+		except QueueFull:
+			return ({"error": "Too many pending jobs, try again later"}, 503)
+		return ({"job_id": job_id, "status": "queued"}, 202)
+
+	previous_id = data.get("previous_id")
+	answer = local_answer(report, current_app.config)
+	if answer is not None:
+		analysis = Analysis(answer, path="local")
+	elif previous_id or flag("incremental"):
+		previous_units: List[Dict[str, Any]] = []
+		if previous_id:
+			previous_object_id = parse_object_id(previous_id)
+			# The previous record may still wait in the write-behind buffer
+			previous = get_writer().pending(previous_object_id, session["user"]) or get_collection("codes").find_one({ "_id": previous_object_id, "user": session["user"] }, { "units": 1 })
+			if previous is None:
+				return ({"error": "Previous submission does not exist"}, 404)
+			previous_units = previous.get("units") or []
+		analysis = analyze_incremental(code, previous_units, use_cache=use_cache(), deadline=deadline)
+	else:
+		analysis = analyze_code(code, use_cache=use_cache(), deadline=deadline)
 
-	if not response.text:
+	analysis = deadline_fallback(code, analysis, report, deadline, use_cache())
+	if not analysis.text:
+		if analysis.timed_out:
+			return ({"error": "Model did not answer within the deadline"}, 504)
 		return ({"error": "Model did not respond with any content"}, 503)
 	
-	database_response = submit_to_database(code, response.text)
+	extra: Dict[str, Any] = { "route": route_record(analysis, deadline) }
+	if analysis.units:
+		extra["units"] = analysis.units
+	database_response = submit_to_database(code, analysis.text, extra=extra)
 
 	if database_response.get("error"):
 		return ({"error": "Internal Server Error"}, 500)
-	
-	return ({"message": response.text, "message_id": database_response["id"]}, 200)
 
+	return (analysis_payload(analysis, database_response["id"], report, answer is not None), 200)
+
+# Response body of a stored analysis
+def analysis_payload(analysis: Analysis, message_id: str, report: Dict[str, Any], local: bool) -> Dict[str, Any]:
+	payload: Dict[str, Any] = {"message": analysis.text, "message_id": message_id, "cached": analysis.cached, "static": report}
+	if analysis.coalesced:
+		payload["coalesced"] = True
+	if analysis.compaction:
+		payload["compaction"] = analysis.compaction
+	if local:
+		payload["local"] = True
+	# The full route is stored with the record; clients only hear about fallbacks
+	if analysis.path and analysis.path.startswith("fallback_"):
+		payload["route"] = analysis.path
+	if analysis.chunks:
+		payload["chunks"] = analysis.chunks
+	if analysis.reuse is not None:
+		payload["incremental"] = analysis.reuse
+	return payload
+
+# Whether a boolean query flag such as ?async=1 is set
+def flag(name: str) -> bool:
+	return request.args.get(name, "0").lower() in ("1", "true", "yes")
+
+# Whether the current request may be answered from the analysis cache
+def use_cache() -> bool:
+	if request.args.get("cache", "1").lower() in ("0", "false", "no"):
+		return False
+
+	return "no-cache" not in request.headers.get("Cache-Control", "").lower()
+
+# Submit the code to the server and stream the analysis back
+@code_blueprint.route("/submit/stream", methods=["GET"])
+def submit_code_stream() -> Tuple[Dict[str, str], int] | Response:
+	data = request.get_json()
+	code = data.get("code", "")
+
+	if not code:
+		return ({"error": "Code provided is empty"}, 400)
+
+	ndjson = request.args.get("format") == "ndjson"
+	router = get_router()
+	deadline = router.deadline(request.headers.get(router.header))
+	cached = lookup_cached(code) if use_cache() else None
+
+	def encode(event: str, payload: Dict[str, Any]) -> str:
+		if ndjson:
+			return json.dumps({ "type": event, **payload }) + "\n"
+		return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+	def generate() -> Iterator[str]:
+		pieces: List[str] = []
+
+		if cached is not None:
+			pieces.append(cached)
+			yield encode("chunk", { "text": cached })
+		else:
+			upstream = stream_analysis(code)
+			try:
+				for text in upstream:
+					pieces.append(text)
+					yield encode("chunk", { "text": text })
+			except Exception as e:
+				print(e)
+				yield encode("error", { "error": "Model failed while generating the response" })
+				return
+			finally:
+				# A client disconnect closes this generator, which must stop the model too
+				upstream.close()
+
+		text = "".join(pieces)
+		if not text:
+			yield encode("error", { "error": "Model did not respond with any content" })
+			return
+
+		if cached is None:
+			store_cached(code, text)
+			# Streams always go to the primary model, in a single attempt
+			attempt = { "model": router.primary, "outcome": "ok", "elapsed_ms": round(deadline.elapsed() * 1000, 1) }
+			route = route_record(Analysis(text, path="model", routed=[Routed(text, router.primary, [attempt])]), deadline)
+		else:
+			route = route_record(Analysis(text, cached=True, path="cache"), deadline)
+
+		try:
+			database_response = submit_to_database(code, text, extra={ "route": route })
+		except WriteBufferFull:
+			yield encode("error", { "error": "Too many pending writes, try again later" })
+			return
+		if database_response.get("error"):
+			yield encode("error", { "error": "Internal Server Error" })
+			return
+
+		done: Dict[str, Any] = { "message_id": database_response["id"], "cached": cached is not None }
+		compaction = compaction_report(code) if cached is None else None
+		if compaction:
+			done["compaction"] = compaction
+		yield encode("done", done)
+
+	return Response(
+		stream_with_context(generate()),
+		mimetype="application/x-ndjson" if ndjson else "text/event-stream",
+		headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" }
+	)
+
+# Submit several snippets in one request
+@code_blueprint.route("/submit/batch", methods=["GET"])
+def submit_code_batch() -> Tuple[Dict[str, Any], int]:
+	data = request.get_json()
+	codes = data.get("codes")
+
+	if not isinstance(codes, list) or not codes:
+		return ({"error": "Codes provided are empty"}, 400)
+
+	limiter = get_limiter()
+	max_items = current_app.config.get("BATCH_MAX_ITEMS", 100)
+	# The rate limits charge every snippet, so a batch can never cost more than they admit
+	if limiter.enabled:
+		max_items = min(max_items, limiter.max_cost)
+	if len(codes) > max_items:
+		return ({"error": f"At most {max_items} codes can be submitted at once"}, 400)
+
+	application = current_app._get_current_object()
+	cache = use_cache()
+	router = get_router()
+	requested_deadline = request.headers.get(router.header)
+	# Route record of every analyzed item, stored with its record
+	routes: Dict[int, Dict[str, Any]] = {}
+
+	def analyze(index: int, code: Any) -> Dict[str, Any]:
+		if not isinstance(code, str) or not code:
+			return {"error": "Code provided is empty"}
+
+		with application.app_context():
+			deadline = router.deadline(requested_deadline)
+			try:
+				analysis = analyze_code(code, use_cache=cache, deadline=deadline)
+			except Exception as e:
+				print(e)
+				return {"error": "Model failed while generating the response"}
+
+			if not analysis.text:
+				return {"error": "Model did not respond with any content"}
+			routes[index] = route_record(analysis, deadline)
+		return {"message": analysis.text, "cached": analysis.cached}
+
+	parallelism = max(1, min(current_app.config.get("BATCH_PARALLELISM", 8), len(codes)))
+	with ThreadPoolExecutor(max_workers=parallelism) as executor:
+		results = list(executor.map(analyze, range(len(codes)), codes))
+
+	analyzed = [index for index, result in enumerate(results) if "message" in result]
+	stored = submit_many_to_database([(codes[index], results[index]["message"], { "route": routes[index] }) for index in analyzed])
+
+	for index, database_response in zip(analyzed, stored):
+		if database_response.get("error"):
+			results[index] = {"error": "Internal Server Error"}
+		else:
+			results[index]["message_id"] = database_response["id"]
+
+	return ({"results": results}, 200)
+
+@code_blueprint.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str) -> Tuple[Dict[str, Any], int]:
+	job = get_jobs().get(job_id, session["user"])
+
+	if job is None:
+		return ({"error": "Job does not exist"}, 404)
+
+	return (serialize_job(job), 200)
+
+@code_blueprint.route("/jobs/<job_id>/wait", methods=["GET"])
+def wait_job(job_id: str) -> Tuple[Dict[str, Any], int]:
+	jobs = get_jobs()
+	timeout = request.args.get("timeout", jobs.wait_timeout, type=float)
+	job = jobs.wait(job_id, session["user"], timeout)
+
+	if job is None:
+		return ({"error": "Job does not exist"}, 404)
+
+	return (serialize_job(job), 200 if job["status"] in FINISHED_STATUSES else 202)
+
+@code_blueprint.route("/cache", methods=["GET"])
+def cache_stats() -> Tuple[Dict[str, Any], int]:
+	return ({"cache": get_cache().stats(), "coalescing": get_flights().stats()}, 200)
+
+# List the submissions of the current user, newest first
 @code_blueprint.route("/all", methods=["GET"])
-def get_codes() -> Tuple[Dict[str, List], int]:
-	database = connect_database()
+def get_codes() -> Tuple[Dict[str, Any], int] | Response:
+	configuration = current_app.config
+	codes = get_collection("codes")
+
+	listing = listing_query()
+	if listing is None:
+		return ({"error": "Invalid cursor"}, 400)
+	query, projection = listing
+
+	if request.args.get("format") == "ndjson":
+		documents = codes.find(query, projection).sort("_id", DESCENDING).batch_size(configuration.get("CODES_EXPORT_BATCH_SIZE", 500))
+
+		def export() -> Iterator[str]:
+			try:
+				for document in documents:
+					yield json.dumps(serialize_code(document)) + "\n"
+			finally:
+				documents.close()
+
+		return Response(export(), mimetype="application/x-ndjson")
+
+	# One extra document tells whether another page follows
+	limit = page_limit()
+	documents = list(codes.find(query, projection).sort("_id", DESCENDING).limit(limit + 1))
+	return (page_payload(documents, limit), 200)
+
+# Query and projection of a listing request, or None for a malformed cursor
+def listing_query() -> Tuple[Dict[str, Any], Dict[str, int]] | None:
+	projection = listing_projection()
+
+	query: Dict[str, Any] = { "user": session["user"] }
+	cursor = request.args.get("cursor")
+	if cursor:
+		last_id = parse_object_id(cursor)
+		if last_id is None:
+			return None
+		query["_id"] = { "$lt": last_id }
+
+	return query, projection
+
+def listing_projection() -> Dict[str, int]:
+	fields = request.args.get("fields")
+	if fields is None:
+		return { field: 1 for field in CODE_FIELDS }
+	# An empty projection would return every field, so an empty selection asks for "_id" alone
+	return { field: 1 for field in fields.split(",") if field in CODE_FIELDS } or { "_id": 1 }
+
+def page_limit() -> int:
+	configuration = current_app.config
+	limit = request.args.get("limit", configuration.get("CODES_PAGE_SIZE", 50), type=int)
+	return max(1, min(limit, configuration.get("CODES_MAX_PAGE_SIZE", 200)))
+
+# Response body of a page fetched with limit + 1 documents
+def page_payload(documents: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+	next_cursor = str(documents[limit - 1]["_id"]) if len(documents) > limit else None
+	return {"codes": [serialize_code(document) for document in documents[:limit]], "next_cursor": next_cursor}
+
+def serialize_code(document: Dict[str, Any]) -> Dict[str, Any]:
+	return { **document, "_id": str(document["_id"]) }
+
+# Search the submissions of the current user, most relevant first
+@code_blueprint.route("/search", methods=["GET"])
+def search_codes() -> Tuple[Dict[str, Any], int]:
+	search = get_search()
+	text = request.args.get("q", "").strip()
+
+	if not text:
+		return ({"error": "Search query is empty"}, 400)
+	if len(text) > search.max_query_length:
+		return ({"error": f"Search query is longer than {search.max_query_length} characters"}, 400)
+
+	# Results are ranked rather than ordered by id, so the cursor is an offset
+	cursor = request.args.get("cursor", "0")
+	if not cursor.isdigit():
+		return ({"error": "Invalid cursor"}, 400)
+	offset = int(cursor)
+
+	projection = listing_projection()
+	highlights = flag("highlight") if "highlight" in request.args else True
+	limit = page_limit()
+	try:
+		documents = search.search(session["user"], text, offset, limit + 1, { field: 1 for field in CODE_FIELDS } if highlights else projection)
+	except ExecutionTimeout as e:
+		print(e)
+		return ({"error": "Search took too long, try a more specific query"}, 503)
 
-	user = session["user"]
+	results: List[Dict[str, Any]] = []
+	for document in documents[:limit]:
+		result: Dict[str, Any] = { "_id": str(document["_id"]), "score": round(document["score"], 4) }
+		result.update({ field: document[field] for field in CODE_FIELDS if field in projection and field in document })
+		if highlights:
+			result["highlights"] = highlight(document, text, search.snippet_width)
+		results.append(result)
 
-	codes = database["users"].find({ "_id": user })
+	next_cursor = str(offset + limit) if len(documents) > limit else None
+	return ({"codes": results, "next_cursor": next_cursor}, 200)
 
-	return ({"codes": codes.to_list()}, 200)
+@code_blueprint.route("/limits", methods=["GET"])
+def limit_stats() -> Tuple[Dict[str, Any], int]:
+	return ({"limits": get_limiter().stats()}, 200)
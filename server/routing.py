@@ -0,0 +1,262 @@
+import time
+import asyncio
+import threading
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional
+from flask import Flask, current_app
+from server.ratelimit import RateLimited
+"""
+Latency-budgeted model routing.
+
+Every submission gets a deadline: the request's MODEL_DEADLINE_HEADER (in
+milliseconds, capped by MODEL_MAX_DEADLINE) or MODEL_DEADLINE. Routes are listed
+most capable first, each expected to be faster than the one before. A call goes to
+the first route that accepts the size of its prompt and is expected to answer within
+the time left; the estimate is the route's configured latency, scaled by how fast
+the model actually answered lately. Every call gets the time left as its timeout,
+minus the estimate of the next faster route when both fit, so a stalled upstream
+call is cancelled instead of holding the worker. When a call times out or fails,
+the next faster route gets the time left.
+
+When the deadline cuts the model path short, the submission can still be answered
+from a cached analysis by any routed model (MODEL_FALLBACK_CACHED) or from its static
+report (MODEL_FALLBACK_STATIC); otherwise it fails with 504. Every stored record
+carries a "route" field telling which path served it:
+	{ "path": "model" | "fallback_model" | "cache" | "fallback_cache" | "fallback_static" | "local",
+	  "models": [str], "deadline_ms": int, "elapsed_ms": float,
+	  "attempts": [{ "model", "outcome": "ok" | "empty" | "timeout" | "error", "elapsed_ms" }] }
+
+Configuration keys (all optional):
+	MODEL_ROUTES: List of { "model", "max_input_tokens", "latency",
+		"latency_per_1k_tokens" } (latencies in seconds), most capable first.
+		Defaults to gemini-2.5-flash-lite alone, for any input size.
+	MODEL_DEADLINE: Seconds a submission may spend when its request sets no
+		deadline. Defaults to MODEL_TIMEOUT, or 60.
+	MODEL_MAX_DEADLINE: Longest deadline a request may ask for. Defaults to
+		MODEL_DEADLINE.
+	MODEL_DEADLINE_HEADER: Request header carrying the deadline in milliseconds.
+		Defaults to "X-Request-Deadline-Ms".
+	MODEL_DEADLINE_RESERVE: Seconds of the deadline kept for the fallbacks and for
+		storing the record. Defaults to 0.25.
+	MODEL_FALLBACK_CACHED: Answer from the analysis cache when the deadline cut the
+		model path short. Defaults to True.
+	MODEL_FALLBACK_STATIC: Answer from the static report when nothing else did.
+		Defaults to True.
+"""
+
+EXTENSION_KEY = "model_router"
+MODEL_NAME = "gemini-2.5-flash-lite"
+# Weight of the latest call in the smoothed ratio of observed to estimated latency
+LATENCY_SMOOTHING = 0.2
+
+@dataclass(frozen=True)
+class ModelRoute:
+	model: str
+	max_input_tokens: Optional[int] = None
+	latency: float = 2.0
+	latency_per_1k_tokens: float = 0.5
+
+	def accepts(self, tokens: int) -> bool:
+		return self.max_input_tokens is None or tokens <= self.max_input_tokens
+
+class Deadline:
+	"""The time by which a submission must be answered."""
+
+	def __init__(self, seconds: float) -> None:
+		self.seconds = seconds
+		self.started = time.monotonic()
+
+	def remaining(self) -> float:
+		return max(0.0, self.seconds - self.elapsed())
+
+	def elapsed(self) -> float:
+		return time.monotonic() - self.started
+
+@dataclass
+class Routed:
+	"""Outcome of the model calls made for one prompt."""
+	text: str | None = None
+	model: Optional[str] = None
+	attempts: List[Dict[str, Any]] = field(default_factory=list)
+	# True when a call timed out or no route was left time to answer
+	timed_out: bool = False
+
+	@property
+	def fell_back(self) -> bool:
+		return self.text is not None and len(self.attempts) > 1
+
+class ModelRouter:
+	def __init__(self, configuration: Mapping[str, Any]) -> None:
+		routes = configuration.get("MODEL_ROUTES") or [{ "model": MODEL_NAME }]
+		self.routes: List[ModelRoute] = [route if isinstance(route, ModelRoute) else ModelRoute(**route) for route in routes]
+		self.default_deadline: float = configuration.get("MODEL_DEADLINE", configuration.get("MODEL_TIMEOUT", 60))
+		self.max_deadline: float = configuration.get("MODEL_MAX_DEADLINE", self.default_deadline)
+		self.header: str = configuration.get("MODEL_DEADLINE_HEADER", "X-Request-Deadline-Ms")
+		self.reserve: float = configuration.get("MODEL_DEADLINE_RESERVE", 0.25)
+		self.fallback_cached: bool = configuration.get("MODEL_FALLBACK_CACHED", True)
+		self.fallback_static: bool = configuration.get("MODEL_FALLBACK_STATIC", True)
+
+		self._ratios: Dict[str, float] = {}
+		self._lock = threading.Lock()
+		self._counters: Dict[str, int] = {
+			"model": 0, "fallback_model": 0, "cache": 0, "fallback_cache": 0, "fallback_static": 0, "local": 0,
+			"deadline_exceeded": 0, "timeouts": 0
+		}
+
+	@property
+	def primary(self) -> str:
+		return self.routes[0].model
+
+	@property
+	def models(self) -> List[str]:
+		return [route.model for route in self.routes]
+
+	def _count(self, name: str) -> None:
+		with self._lock:
+			self._counters[name] += 1
+
+	def exceeded(self) -> None:
+		"""Count a submission the deadline left without any answer."""
+		self._count("deadline_exceeded")
+
+	def deadline(self, requested: Optional[str] = None) -> Deadline:
+		"""Deadline of a request asking for requested milliseconds, or the default one."""
+		seconds = self.default_deadline
+		if requested:
+			try:
+				seconds = min(max(0.0, float(requested) / 1000), self.max_deadline)
+			except ValueError:
+				pass
+		return Deadline(seconds)
+
+	def estimate(self, route: ModelRoute, tokens: int) -> float:
+		with self._lock:
+			ratio = self._ratios.get(route.model, 1.0)
+		return (route.latency + route.latency_per_1k_tokens * tokens / 1000) * ratio
+
+	def observe(self, route: ModelRoute, tokens: int, seconds: float) -> None:
+		ratio = seconds / max(1e-3, route.latency + route.latency_per_1k_tokens * tokens / 1000)
+		with self._lock:
+			previous = self._ratios.get(route.model, 1.0)
+			self._ratios[route.model] = previous + LATENCY_SMOOTHING * (ratio - previous)
+
+	def plan(self, tokens: int, deadline: Deadline) -> List[ModelRoute]:
+		"""Routes to try in order: the first expected to answer in time, then every faster one."""
+		# Size limits are preferences; a prompt no route accepts still goes to every route
+		candidates = [route for route in self.routes if route.accepts(tokens)] or list(self.routes)
+		budget = deadline.remaining() - self.reserve
+		for index, route in enumerate(candidates):
+			if self.estimate(route, tokens) <= budget:
+				return candidates[index:]
+		# Nothing is expected to make it, so the fastest route gets whatever time is left
+		return candidates[-1:]
+
+	def _timeout(self, routed: Routed, route: ModelRoute, following: Optional[ModelRoute], tokens: int, deadline: Deadline) -> Optional[float]:
+		"""Timeout of a call to route, or None when it should be skipped."""
+		timeout = deadline.remaining() - self.reserve
+		if timeout <= 0:
+			routed.timed_out = True
+			return None
+
+		# Give up early enough for the next faster route, when both fit in the time left
+		if following is not None and timeout - self.estimate(following, tokens) >= self.estimate(route, tokens):
+			timeout -= self.estimate(following, tokens)
+		return timeout
+
+	def _record(self, routed: Routed, route: ModelRoute, tokens: int, timeout: float, started: float, text: str | None, error: Optional[Exception]) -> None:
+		elapsed = time.perf_counter() - started
+		if error is None:
+			outcome = "ok" if text else "empty"
+		else:
+			outcome = "timeout" if isinstance(error, TimeoutError) or elapsed >= timeout else "error"
+
+		if outcome == "timeout":
+			routed.timed_out = True
+			self._count("timeouts")
+		if outcome != "error":
+			self.observe(route, tokens, elapsed)
+		routed.attempts.append({ "model": route.model, "outcome": outcome, "elapsed_ms": round(elapsed * 1000, 1) })
+		if text:
+			routed.text, routed.model = text, route.model
+
+	def run(self, tokens: int, deadline: Deadline, call: Callable[[str, float], str | None]) -> Routed:
+		"""Call call(model, timeout) along the planned routes until one answers or time runs out."""
+		routed = Routed()
+		error: Optional[Exception] = None
+		plan = self.plan(tokens, deadline)
+		for index, route in enumerate(plan):
+			timeout = self._timeout(routed, route, plan[index + 1] if index + 1 < len(plan) else None, tokens, deadline)
+			if timeout is None:
+				continue
+
+			started, text, failure = time.perf_counter(), None, None
+			try:
+				text = call(route.model, timeout)
+			except RateLimited:
+				raise
+			except Exception as e:
+				print(e)
+				failure = error = e
+			self._record(routed, route, tokens, timeout, started, text, failure)
+			if routed.text:
+				return routed
+
+		# Failures unrelated to the deadline surface as they did without routing
+		if error is not None and not routed.timed_out:
+			raise error
+		return routed
+
+	async def arun(self, tokens: int, deadline: Deadline, call: Callable[[str, float], Awaitable[str | None]]) -> Routed:
+		"""run() for coroutines; a call running past its timeout is cancelled."""
+		routed = Routed()
+		error: Optional[Exception] = None
+		plan = self.plan(tokens, deadline)
+		for index, route in enumerate(plan):
+			timeout = self._timeout(routed, route, plan[index + 1] if index + 1 < len(plan) else None, tokens, deadline)
+			if timeout is None:
+				continue
+
+			started, text, failure = time.perf_counter(), None, None
+			try:
+				text = await asyncio.wait_for(call(route.model, timeout), timeout)
+			except RateLimited:
+				raise
+			except Exception as e:
+				print(e)
+				failure = error = e
+			self._record(routed, route, tokens, timeout, started, text, failure)
+			if routed.text:
+				return routed
+
+		if error is not None and not routed.timed_out:
+			raise error
+		return routed
+
+	def record(self, path: str, deadline: Deadline, routed: Optional[List[Routed]] = None) -> Dict[str, Any]:
+		"""The "route" field stored with a submission served by path."""
+		self._count(path)
+		models = [route.model for route in self.routes if any(result.model == route.model for result in routed or [])]
+		return {
+			"path": path,
+			"models": models,
+			"deadline_ms": int(deadline.seconds * 1000),
+			"elapsed_ms": round(deadline.elapsed() * 1000, 1),
+			"attempts": [attempt for result in routed or [] for attempt in result.attempts],
+		}
+
+	def stats(self) -> Dict[str, Any]:
+		with self._lock:
+			return { **self._counters, **{ f"latency_ratio:{model}": round(ratio, 3) for model, ratio in self._ratios.items() } }
+
+def model_path(routed: List[Routed]) -> str:
+	"""Path of a submission whose prompts were all answered by a model."""
+	return "fallback_model" if any(result.fell_back for result in routed) else "model"
+
+def init_routing(application: Flask) -> ModelRouter:
+	router = ModelRouter(application.config)
+	application.extensions[EXTENSION_KEY] = router
+	return router
+
+def get_router() -> ModelRouter:
+	return current_app.extensions[EXTENSION_KEY]
@@ -0,0 +1,272 @@
+import re
+import math
+import threading
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+from datetime import timedelta
+from bson import ObjectId
+from flask import Flask, current_app
+from pymongo import ASCENDING
+from server.indexes import get_collection
+from server.metrics import stage
+"""
+Full-text search over the analyses of a user.
+
+The "text" backend (default) runs MongoDB $text queries against the compound text
+index on "codes" declared in server.indexes: its "user" prefix keeps every query
+within one user's records, and matches are ranked by textScore with the analysis
+weighted above the code. The "memory" backend keeps an in-process inverted index
+instead, for mongomock and other setups without $text; it follows the same query
+syntax (terms, "quoted phrases", -negations) and catches up with new records of a
+user on each query. Records can be stored after newer ones (write-behind buffer,
+batches, several processes), so each catch-up re-reads the last
+CODES_SEARCH_SYNC_WINDOW seconds of ids, and a user whose record count still differs
+from the index gets a full scan of its ids. The least recently searched users are
+dropped from memory once the index holds CODES_SEARCH_MEMORY_MAX_DOCUMENTS records.
+
+Both backends return documents with a "score" field, most relevant first.
+highlight() cuts snippets around the matches of a query, with match offsets.
+
+Configuration keys (all optional):
+	CODES_SEARCH_BACKEND: "text" or "memory". Defaults to "text".
+	CODES_SEARCH_MAX_TIME_MS: Server-side time limit of a $text query. Defaults to 500.
+	CODES_SEARCH_MAX_RESULTS: Deepest result reachable through pagination.
+		Defaults to 1000.
+	CODES_SEARCH_MAX_QUERY_LENGTH: Longest accepted query. Defaults to 256.
+	CODES_SEARCH_SNIPPET_WIDTH: Characters per highlighted snippet. Defaults to 160.
+	CODES_SEARCH_SYNC_WINDOW: Seconds of ids before the newest indexed one read again
+		on each catch-up of the memory backend. Defaults to 60.
+	CODES_SEARCH_MEMORY_MAX_DOCUMENTS: Records the memory backend keeps indexed over
+		all users. Defaults to 100000.
+"""
+
+EXTENSION_KEY = "code_search"
+
+# Field weights of the text index and of the in-process fallback
+SEARCH_WEIGHTS = { "code": 1, "response": 3 }
+
+STOP_WORDS = frozenset(("a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of", "on", "or", "that", "the", "this", "to", "was", "with"))
+SUFFIXES = ("ations", "ation", "ings", "ing", "ions", "ion", "ers", "er", "ed", "es", "s")
+WORD = re.compile(r"[^\W_]+")
+PHRASE = re.compile(r'"([^"]*)"')
+
+def stem(word: str) -> str:
+	"""Light suffix stripping, enough for "injection" to find "injected"."""
+	if word.endswith("ies") and len(word) > 4:
+		return word[:-3] + "y"
+	for suffix in SUFFIXES:
+		if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+			return word[:-len(suffix)]
+	return word
+
+def tokenize(text: str) -> List[Tuple[str, int, int]]:
+	"""Stemmed words of a text with their offsets, stop words left out."""
+	tokens: List[Tuple[str, int, int]] = []
+	for match in WORD.finditer(text):
+		word = match.group().lower()
+		if word not in STOP_WORDS:
+			tokens.append((stem(word), match.start(), match.end()))
+	return tokens
+
+@dataclass
+class SearchQuery:
+	terms: Set[str] = field(default_factory=set)
+	phrases: List[str] = field(default_factory=list)
+	negated: Set[str] = field(default_factory=set)
+
+def parse_query(text: str) -> SearchQuery:
+	"""Split a query like MongoDB's $search: any term may match, every phrase must."""
+	query = SearchQuery()
+	query.phrases = [phrase.lower() for phrase in PHRASE.findall(text) if phrase.strip()]
+
+	for word in PHRASE.sub(" ", text).split():
+		negated = word.startswith("-")
+		for term, _, _ in tokenize(word):
+			(query.negated if negated else query.terms).add(term)
+
+	for phrase in query.phrases:
+		query.terms.update(term for term, _, _ in tokenize(phrase))
+	query.terms -= query.negated
+	return query
+
+def highlight(document: Dict[str, Any], text: str, width: int) -> List[Dict[str, Any]]:
+	"""One snippet per matching field, centred on its first match, with [start, end] match offsets."""
+	query = parse_query(text)
+	highlights: List[Dict[str, Any]] = []
+
+	for name in sorted(SEARCH_WEIGHTS, key=SEARCH_WEIGHTS.get, reverse=True):
+		value = document.get(name)
+		if not isinstance(value, str):
+			continue
+
+		matches = [(start, end) for term, start, end in tokenize(value) if term in query.terms]
+		lowered = value.lower()
+		for phrase in query.phrases:
+			matches.extend((found.start(), found.end()) for found in re.finditer(re.escape(phrase), lowered))
+		if not matches:
+			continue
+
+		matches.sort()
+		first_start, first_end = matches[0]
+		start = max(0, min(first_start - (width - (first_end - first_start)) // 2, len(value) - width))
+		end = min(len(value), start + width)
+		highlights.append({
+			"field": name,
+			"snippet": value[start:end],
+			"matches": [[match_start - start, match_end - start] for match_start, match_end in matches if match_start >= start and match_end <= end],
+		})
+
+	return highlights
+
+class TextSearch:
+	"""Searches with MongoDB $text queries on the codes text index."""
+
+	def __init__(self, configuration: Dict[str, Any]) -> None:
+		self.max_time_ms: int = configuration.get("CODES_SEARCH_MAX_TIME_MS", 500)
+
+	def search(self, user: str, text: str, offset: int, limit: int, projection: Dict[str, int]) -> List[Dict[str, Any]]:
+		score = { "$meta": "textScore" }
+		with stage("database_read"):
+			return list(
+				get_collection("codes")
+				.find({ "user": user, "$text": { "$search": text } }, { **projection, "score": score })
+				.sort([("score", score)])
+				.skip(offset)
+				.limit(limit)
+				.max_time_ms(self.max_time_ms)
+			)
+
+class UserIndex:
+	def __init__(self) -> None:
+		# Stemmed term -> record id -> weighted frequency
+		self.postings: Dict[str, Dict[ObjectId, float]] = {}
+		self.ids: Set[ObjectId] = set()
+		self.newest: Optional[ObjectId] = None
+
+	@property
+	def documents(self) -> int:
+		return len(self.ids)
+
+	def add(self, document: Dict[str, Any]) -> None:
+		if document["_id"] in self.ids:
+			return
+		frequencies: Dict[str, float] = {}
+		for name, weight in SEARCH_WEIGHTS.items():
+			value = document.get(name)
+			if isinstance(value, str):
+				for term, _, _ in tokenize(value):
+					frequencies[term] = frequencies.get(term, 0.0) + weight
+
+		for term, frequency in frequencies.items():
+			self.postings.setdefault(term, {})[document["_id"]] = frequency
+		self.ids.add(document["_id"])
+		if self.newest is None or document["_id"] > self.newest:
+			self.newest = document["_id"]
+
+class MemorySearch:
+	"""In-process inverted index per user, for deployments without $text support."""
+
+	def __init__(self, configuration: Dict[str, Any]) -> None:
+		self.sync_window: float = configuration.get("CODES_SEARCH_SYNC_WINDOW", 60)
+		self.max_documents: int = configuration.get("CODES_SEARCH_MEMORY_MAX_DOCUMENTS", 100000)
+		# Least recently searched user first
+		self._indexes: OrderedDict[str, UserIndex] = OrderedDict()
+		self._documents = 0
+		self._lock = threading.Lock()
+
+	def _sync(self, user: str) -> UserIndex:
+		# Records only ever get added. Reading the trailing window of ids again (served by
+		# the user/_id index) catches the ones stored after newer ones; the count catches
+		# those stored later still, e.g. after a spill
+		with self._lock:
+			index = self._indexes.setdefault(user, UserIndex())
+			self._indexes.move_to_end(user)
+			before = index.documents
+			codes = get_collection("codes")
+
+			query: Dict[str, Any] = { "user": user }
+			if index.newest is not None:
+				query["_id"] = { "$gte": ObjectId.from_datetime(index.newest.generation_time - timedelta(seconds=self.sync_window)) }
+			for document in codes.find(query, { "code": 1, "response": 1 }).sort("_id", ASCENDING):
+				index.add(document)
+
+			if codes.count_documents({ "user": user }) != index.documents:
+				missing = [document["_id"] for document in codes.find({ "user": user }, { "_id": 1 }) if document["_id"] not in index.ids]
+				for document in codes.find({ "_id": { "$in": missing } }, { "code": 1, "response": 1 }):
+					index.add(document)
+
+			self._documents += index.documents - before
+			self._evict()
+			return index
+
+	def _evict(self) -> None:
+		# The user being searched was moved last, so it is kept even when it alone is over the limit
+		while self._documents > self.max_documents and len(self._indexes) > 1:
+			_, index = self._indexes.popitem(last=False)
+			self._documents -= index.documents
+
+	def search(self, user: str, text: str, offset: int, limit: int, projection: Dict[str, int]) -> List[Dict[str, Any]]:
+		query = parse_query(text)
+		index = self._sync(user)
+
+		scores: Dict[ObjectId, float] = {}
+		with self._lock:
+			for term in query.terms:
+				postings = index.postings.get(term, {})
+				if not postings:
+					continue
+				idf = math.log(1 + index.documents / len(postings))
+				for object_id, frequency in postings.items():
+					scores[object_id] = scores.get(object_id, 0.0) + idf * (1 + math.log(frequency))
+
+			for term in query.negated:
+				for object_id in index.postings.get(term, {}):
+					scores.pop(object_id, None)
+
+		ranked = sorted(scores, key=lambda object_id: (scores[object_id], object_id), reverse=True)
+		if query.phrases:
+			ranked = self._with_phrases(ranked, query.phrases, offset + limit)
+
+		selected = ranked[offset:offset + limit]
+		if not selected:
+			return []
+		documents = { document["_id"]: document for document in get_collection("codes").find({ "_id": { "$in": selected } }, projection or { "_id": 1 }) }
+		return [{ **documents[object_id], "score": scores[object_id] } for object_id in selected if object_id in documents]
+
+	def _with_phrases(self, ranked: List[ObjectId], phrases: List[str], needed: int) -> List[ObjectId]:
+		kept: List[ObjectId] = []
+		for start in range(0, len(ranked), 500):
+			batch = ranked[start:start + 500]
+			texts = { document["_id"]: " ".join(str(document.get(name, "")) for name in SEARCH_WEIGHTS).lower() for document in get_collection("codes").find({ "_id": { "$in": batch } }, { "code": 1, "response": 1 }) }
+			kept.extend(object_id for object_id in batch if all(phrase in texts.get(object_id, "") for phrase in phrases))
+			if len(kept) >= needed:
+				break
+		return kept
+
+class CodeSearch:
+	"""Search settings and the configured backend."""
+
+	def __init__(self, configuration: Dict[str, Any]) -> None:
+		backend = configuration.get("CODES_SEARCH_BACKEND", "text")
+		if backend not in ("text", "memory"):
+			raise ValueError(f"Unknown CODES_SEARCH_BACKEND {backend!r}")
+		self.backend: TextSearch | MemorySearch = MemorySearch(configuration) if backend == "memory" else TextSearch(configuration)
+		self.max_results: int = configuration.get("CODES_SEARCH_MAX_RESULTS", 1000)
+		self.max_query_length: int = configuration.get("CODES_SEARCH_MAX_QUERY_LENGTH", 256)
+		self.snippet_width: int = configuration.get("CODES_SEARCH_SNIPPET_WIDTH", 160)
+
+	def search(self, user: str, text: str, offset: int, limit: int, projection: Dict[str, int]) -> List[Dict[str, Any]]:
+		limit = min(limit, self.max_results - offset)
+		if limit <= 0:
+			return []
+		return self.backend.search(user, text, offset, limit, projection)
+
+def init_search(application: Flask) -> CodeSearch:
+	search = CodeSearch(application.config)
+	application.extensions[EXTENSION_KEY] = search
+	return search
+
+def get_search() -> CodeSearch:
+	return current_app.extensions[EXTENSION_KEY]
@@ -0,0 +1,260 @@
+import time
+import uuid
+import asyncio
+import datetime
+import threading
+
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from flask import Flask, current_app
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from server.indexes import get_collection
+"""
+Coalescing of identical concurrent model calls.
+
+Requests that need the same analysis while one is already being generated wait for
+that generation and share its result instead of starting their own. Within a process
+this is coordinated with threading primitives. With SINGLEFLIGHT_SHARED, a lease in
+the "analysis_leases" collection extends it across worker processes: the holder of
+the lease generates and publishes its result in the lease document, kept for a few
+poll intervals, and the others poll the lease and a lookup (the shared analysis
+cache) until the result appears, the lease is released, or it times out.
+AsyncSingleFlight does the same for the coroutines of the async serving mode,
+within the process.
+
+A caller with a deadline passes its time left as timeout: a follower still waiting
+when it runs out gets FlightTimeout and answers on its own (see server.routing),
+and a leader stops polling another process's lease.
+
+Configuration keys (all optional):
+	SINGLEFLIGHT_ENABLED: Coalesce identical calls. Defaults to True.
+	SINGLEFLIGHT_SHARED: Coordinate across processes through MongoDB. Defaults to False.
+	SINGLEFLIGHT_LEASE_TIMEOUT: Seconds a lease is held before others take over.
+		Defaults to 60.
+	SINGLEFLIGHT_POLL_INTERVAL: Seconds between polls while another process holds
+		the lease. Defaults to 0.2.
+"""
+
+LEASE_COLLECTION = "analysis_leases"
+EXTENSION_KEY = "singleflight"
+ASYNC_EXTENSION_KEY = "async_singleflight"
+# Poll intervals a published result stays in its lease document, at least a second
+PUBLISHED_POLLS = 5
+
+class FlightTimeout(TimeoutError):
+	"""Raised to a follower whose timeout ran out before the shared call finished."""
+
+class _Call:
+	def __init__(self) -> None:
+		self.event = threading.Event()
+		self.result: Any = None
+		self.error: Optional[BaseException] = None
+
+class MongoLease:
+	"""Expiring, owner-tagged lock documents keyed by the coalescing key."""
+
+	def __init__(self, timeout: float) -> None:
+		self.timeout = timeout
+
+	def acquire(self, key: str) -> Optional[str]:
+		leases = get_collection(LEASE_COLLECTION)
+		token = uuid.uuid4().hex
+		now = datetime.datetime.now(datetime.timezone.utc)
+		expires_at = now + datetime.timedelta(seconds=self.timeout)
+
+		try:
+			leases.insert_one({ "_id": key, "owner": token, "expires_at": expires_at })
+			return token
+		except DuplicateKeyError:
+			# Take over a lease whose holder died before the TTL monitor removed it
+			taken = leases.find_one_and_update(
+				{ "_id": key, "expires_at": { "$lt": now } },
+				{ "$set": { "owner": token, "expires_at": expires_at } }
+			)
+			return token if taken is not None else None
+
+	def release(self, key: str, token: str, result: Any = None, retention: float = 0.0) -> None:
+		"""Drop the lease, or keep it for retention seconds carrying the holder's result."""
+		leases = get_collection(LEASE_COLLECTION)
+		if result is None:
+			leases.delete_one({ "_id": key, "owner": token })
+			return
+
+		expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=retention)
+		leases.update_one({ "_id": key, "owner": token }, { "$set": { "result": result, "expires_at": expires_at } })
+
+	def published(self, key: str) -> Any:
+		"""The result published with the lease of key, or None."""
+		now = datetime.datetime.now(datetime.timezone.utc)
+		lease = get_collection(LEASE_COLLECTION).find_one({ "_id": key, "result": { "$exists": True }, "expires_at": { "$gte": now } }, { "result": 1 })
+		return lease["result"] if lease is not None else None
+
+class SingleFlight:
+	"""Runs at most one call per key at a time and hands its result to every waiter."""
+
+	def __init__(self, lease: Optional[MongoLease] = None, poll_interval: float = 0.2, enabled: bool = True) -> None:
+		self.lease = lease
+		self.poll_interval = poll_interval
+		self.enabled = enabled
+		self._calls: Dict[str, _Call] = {}
+		self._lock = threading.Lock()
+		self._counters: Dict[str, int] = { "leaders": 0, "followers": 0, "remote_results": 0, "follower_timeouts": 0 }
+
+	def _count(self, name: str) -> None:
+		with self._lock:
+			self._counters[name] += 1
+
+	def do(
+		self,
+		key: str,
+		function: Callable[[], Any],
+		lookup: Optional[Callable[[], Any]] = None,
+		timeout: Optional[float] = None,
+		publish: Optional[Callable[[Any], Any]] = None,
+		restore: Optional[Callable[[Any], Any]] = None
+	) -> Tuple[Any, bool]:
+		"""
+		Return function()'s result and whether it was shared with another caller.
+
+		In shared mode, publish turns the result into the value stored with the lease
+		(None publishes nothing) and restore turns a value published by another process
+		back into a result; lookup, when given, fetches a result that process stored
+		elsewhere. Both are only consulted while that process holds the lease. A
+		follower waits at most timeout seconds for the result, then raises FlightTimeout.
+		"""
+		if not self.enabled:
+			return function(), False
+
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+
+		if not leader:
+			self._count("followers")
+			if not call.event.wait(timeout):
+				self._count("follower_timeouts")
+				raise FlightTimeout(key)
+			if call.error is not None:
+				raise call.error
+			return call.result, True
+
+		self._count("leaders")
+		try:
+			call.result, shared = self._lead(key, function, lookup, timeout, publish, restore)
+			return call.result, shared
+		except BaseException as e:
+			call.error = e
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.event.set()
+
+	def _lead(
+		self,
+		key: str,
+		function: Callable[[], Any],
+		lookup: Optional[Callable[[], Any]],
+		timeout: Optional[float],
+		publish: Optional[Callable[[Any], Any]],
+		restore: Optional[Callable[[Any], Any]]
+	) -> Tuple[Any, bool]:
+		if self.lease is None or (lookup is None and restore is None):
+			return function(), False
+
+		deadline = time.monotonic() + (self.lease.timeout if timeout is None else min(timeout, self.lease.timeout))
+		while time.monotonic() < deadline:
+			try:
+				token = self.lease.acquire(key)
+				result = None if token is not None else self._remote(key, lookup, restore)
+			except PyMongoError as e:
+				print(e)
+				break
+
+			if token is not None:
+				result = None
+				try:
+					result = function()
+					return result, False
+				finally:
+					self._release(key, token, publish(result) if publish is not None and result is not None else None)
+
+			if result is not None:
+				self._count("remote_results")
+				return result, True
+
+			time.sleep(self.poll_interval)
+
+		# The lease holder is stuck, MongoDB is unavailable or the caller is out of
+		# time: generate regardless, which a caller out of time does within its deadline
+		return function(), False
+
+	def _remote(self, key: str, lookup: Optional[Callable[[], Any]], restore: Optional[Callable[[Any], Any]]) -> Any:
+		"""The result of the process holding the lease of key, once it has one."""
+		published = self.lease.published(key) if restore is not None else None
+		if published is not None:
+			return restore(published)
+		return lookup() if lookup is not None else None
+
+	def _release(self, key: str, token: str, result: Any = None) -> None:
+		try:
+			self.lease.release(key, token, result, max(1.0, PUBLISHED_POLLS * self.poll_interval))
+		except PyMongoError as e:
+			print(e)
+
+	def stats(self) -> Dict[str, int]:
+		with self._lock:
+			return { **self._counters, "in_flight": len(self._calls) }
+
+class AsyncSingleFlight:
+	"""SingleFlight for coroutines sharing one event loop; coalesces within the process only."""
+
+	def __init__(self, enabled: bool = True) -> None:
+		self.enabled = enabled
+		self._calls: Dict[str, asyncio.Future] = {}
+
+	async def do(self, key: str, function: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+		if not self.enabled:
+			return await function(), False
+
+		call = self._calls.get(key)
+		if call is not None:
+			# shield() keeps a cancelled follower from cancelling the leader's call
+			try:
+				return await asyncio.wait_for(asyncio.shield(call), timeout), True
+			except asyncio.TimeoutError:
+				raise FlightTimeout(key)
+
+		call = self._calls[key] = asyncio.get_running_loop().create_future()
+		try:
+			result = await function()
+			call.set_result(result)
+			return result, False
+		except asyncio.CancelledError:
+			call.cancel()
+			raise
+		except BaseException as e:
+			call.set_exception(e)
+			# Mark the exception as retrieved when no follower was waiting for it
+			call.exception()
+			raise
+		finally:
+			del self._calls[key]
+
+def init_singleflight(application: Flask) -> SingleFlight:
+	configuration = application.config
+	lease = None
+	if configuration.get("SINGLEFLIGHT_SHARED", False):
+		lease = MongoLease(configuration.get("SINGLEFLIGHT_LEASE_TIMEOUT", 60))
+
+	flights = SingleFlight(lease, configuration.get("SINGLEFLIGHT_POLL_INTERVAL", 0.2), configuration.get("SINGLEFLIGHT_ENABLED", True))
+	application.extensions[EXTENSION_KEY] = flights
+	application.extensions[ASYNC_EXTENSION_KEY] = AsyncSingleFlight(configuration.get("SINGLEFLIGHT_ENABLED", True))
+	return flights
+
+def get_flights() -> SingleFlight:
+	return current_app.extensions[EXTENSION_KEY]
+
+def get_async_flights() -> AsyncSingleFlight:
+	return current_app.extensions[ASYNC_EXTENSION_KEY]
@@ -0,0 +1,171 @@
+import ast
+import hashlib
+
+from typing import Any, Dict, List, Mapping, Optional, Set
+from server.cache import LRUCache
+"""
+Fast in-process static analysis of Python submissions.
+
+The report is computed with the ast module in milliseconds and cached per code hash.
+It is returned next to the model's analysis, and a configurable policy lets trivial
+or unparsable submissions be answered from it alone, without calling the model.
+static_answer() turns it into an analysis for submissions the model could not answer
+within their deadline (see server.routing).
+
+Report fields:
+	language: Language the report was made for.
+	supported: False when the language cannot be analyzed locally.
+	lines: Number of lines.
+	syntax_error: { "line", "column", "message" } or None.
+	functions: { "name", "line", "end_line", "length", "complexity" } per function.
+	long_functions / complex_functions: Names of functions over the thresholds.
+	unused_imports: { "name", "line" } per import never referenced.
+	trivial: True for short code without definitions, branches or loops.
+
+Configuration keys (all optional):
+	STATIC_LONG_FUNCTION_LINES: Length above which a function is long. Defaults to 50.
+	STATIC_COMPLEXITY_THRESHOLD: Cyclomatic complexity above which a function is
+		complex. Defaults to 10.
+	STATIC_TRIVIAL_MAX_LINES: Longest snippet that can count as trivial. Defaults to 3.
+	STATIC_ANSWER_TRIVIAL: Answer trivial submissions locally. Defaults to False.
+	STATIC_ANSWER_UNPARSABLE: Answer submissions with syntax errors locally.
+		Defaults to False.
+"""
+
+# Reports depend only on the code and thresholds, so they are shared process-wide
+_reports = LRUCache(max_size=1024)
+
+BRANCH_NODES = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.ExceptHandler, ast.IfExp, ast.Assert, ast.match_case)
+FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef)
+SCOPE_NODES = FUNCTION_NODES + (ast.ClassDef, ast.Lambda)
+
+def complexity(function: ast.AST) -> int:
+	"""McCabe complexity of a function body, excluding nested functions and classes."""
+	score = 1
+	pending = list(ast.iter_child_nodes(function))
+	while pending:
+		node = pending.pop()
+		if isinstance(node, SCOPE_NODES):
+			continue
+		if isinstance(node, BRANCH_NODES):
+			score += 1
+		elif isinstance(node, ast.BoolOp):
+			score += len(node.values) - 1
+		elif isinstance(node, ast.comprehension):
+			score += 1 + len(node.ifs)
+		pending.extend(ast.iter_child_nodes(node))
+	return score
+
+def unused_imports(tree: ast.Module) -> List[Dict[str, Any]]:
+	imported: Dict[str, int] = {}
+	used: Set[str] = set()
+
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Import):
+			for alias in node.names:
+				imported.setdefault(alias.asname or alias.name.split(".")[0], node.lineno)
+		elif isinstance(node, ast.ImportFrom) and node.module != "__future__":
+			for alias in node.names:
+				if alias.name != "*":
+					imported.setdefault(alias.asname or alias.name, node.lineno)
+		elif isinstance(node, ast.Name):
+			used.add(node.id)
+		elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+			# Names re-exported through __all__ or used in string annotations
+			used.add(node.value)
+
+	return [{ "name": name, "line": line } for name, line in imported.items() if name not in used]
+
+def analyze_python(code: str, long_function_lines: int, complexity_threshold: int, trivial_max_lines: int) -> Dict[str, Any]:
+	lines = len(code.splitlines())
+	report: Dict[str, Any] = {
+		"language": "python",
+		"supported": True,
+		"lines": lines,
+		"syntax_error": None,
+		"functions": [],
+		"long_functions": [],
+		"complex_functions": [],
+		"unused_imports": [],
+		"trivial": False
+	}
+
+	try:
+		tree = ast.parse(code)
+	except SyntaxError as e:
+		report["syntax_error"] = { "line": e.lineno, "column": e.offset, "message": e.msg }
+		return report
+	except ValueError as e:
+		report["syntax_error"] = { "line": None, "column": None, "message": str(e) }
+		return report
+
+	for node in ast.walk(tree):
+		if isinstance(node, FUNCTION_NODES):
+			end_line = node.end_lineno or node.lineno
+			function = {
+				"name": node.name,
+				"line": node.lineno,
+				"end_line": end_line,
+				"length": end_line - node.lineno + 1,
+				"complexity": complexity(node)
+			}
+			report["functions"].append(function)
+			if function["length"] > long_function_lines:
+				report["long_functions"].append(node.name)
+			if function["complexity"] > complexity_threshold:
+				report["complex_functions"].append(node.name)
+
+	report["unused_imports"] = unused_imports(tree)
+	report["trivial"] = lines <= trivial_max_lines and not any(
+		isinstance(node, SCOPE_NODES + BRANCH_NODES + (ast.Import, ast.ImportFrom, ast.Try, ast.With)) for node in ast.walk(tree)
+	)
+	return report
+
+def analyze_static(code: str, configuration: Mapping[str, Any], language: str = "python") -> Dict[str, Any]:
+	if language.lower() != "python":
+		return { "language": language, "supported": False, "lines": len(code.splitlines()) }
+
+	thresholds = (
+		configuration.get("STATIC_LONG_FUNCTION_LINES", 50),
+		configuration.get("STATIC_COMPLEXITY_THRESHOLD", 10),
+		configuration.get("STATIC_TRIVIAL_MAX_LINES", 3)
+	)
+	key = hashlib.sha256(f"{thresholds}\0{code}".encode("utf-8")).hexdigest()
+
+	report = _reports.get(key)
+	if report is None:
+		report = analyze_python(code, *thresholds)
+		_reports.set(key, report)
+	return report
+
+def local_answer(report: Dict[str, Any], configuration: Mapping[str, Any]) -> Optional[str]:
+	"""Return an analysis written from the report alone when the policy allows skipping the model."""
+	if not report.get("supported"):
+		return None
+
+	error = report["syntax_error"]
+	if error and configuration.get("STATIC_ANSWER_UNPARSABLE", False):
+		location = f" at line {error['line']}, column {error['column']}" if error["line"] else ""
+		return f"The code does not parse as Python{location}: {error['message']}. Fix the syntax error and resubmit for a full analysis."
+
+	if report["trivial"] and not error and configuration.get("STATIC_ANSWER_TRIVIAL", False):
+		return f"This is a trivial snippet of {report['lines']} line(s) with no definitions, branches, loops or imports; there is nothing to improve."
+
+	return None
+
+def static_answer(report: Dict[str, Any]) -> Optional[str]:
+	"""Return an analysis written from the report alone, for when the model could not answer in time."""
+	if not report.get("supported"):
+		return None
+
+	error = report["syntax_error"]
+	if error:
+		location = f" at line {error['line']}, column {error['column']}" if error["line"] else ""
+		findings = [f"the code does not parse as Python{location}: {error['message']}"]
+	else:
+		findings = [f"function {name} is long" for name in report["long_functions"]]
+		findings += [f"function {name} is complex" for name in report["complex_functions"]]
+		findings += [f"{entry['name']} is imported at line {entry['line']} but never used" for entry in report["unused_imports"]]
+
+	summary = f"Findings: {'; '.join(findings)}." if findings else "No syntax errors, long or complex functions or unused imports were found."
+	return f"Static analysis only, as the model did not answer in time. {summary} Resubmit later for a full analysis."
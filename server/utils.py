@@ -1,13 +1,68 @@
-from server.database import connect_database
-from typing import Dict
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from bson import ObjectId
+from bson.errors import InvalidId
 from flask import session
+from pymongo.errors import BulkWriteError, PyMongoError
+from server.metrics import stage
+from server.writer import WriteBufferFull, get_writer
 
-def submit_to_database(code: str, response: str) -> Dict[str, str]:
-	database = connect_database()
+# Parse an id received from a client, returning None when it is malformed
+def parse_object_id(value: str) -> Optional[ObjectId]:
+	try:
+		return ObjectId(value)
+	except (InvalidId, TypeError):
+		return None
 
-	insert_response = database["codes"].insert_one({ "code": code, "response": response, "user": session["user"] })
+# Store an analysis for a user, defaulting to the user of the current session,
+# along with any extra fields such as per-unit analyses. With write-behind enabled
+# the record is only buffered, under the id returned here
+def submit_to_database(code: str, response: str, user: Optional[str] = None, extra: Optional[Mapping[str, Any]] = None) -> Dict[str, str]:
+	writer = get_writer()
+	document = { "_id": ObjectId(), **(extra or {}), "code": code, "response": response, "user": user or session["user"] }
 
-	if not insert_response.acknowledged:
+	if writer.enabled:
+		return {"id": str(writer.submit(document))}
+
+	codes = writer.collection()
+	with stage("database_write"):
+		insert_response = codes.insert_one(document)
+
+	if codes.write_concern.acknowledged and not insert_response.acknowledged:
 		return {"error": "Database failed to insert the record"}
 
 	return {"id": str(insert_response.inserted_id)}
+
+# Store several analyses with a single round trip, reporting the outcome of each record
+def submit_many_to_database(records: List[Tuple[str, str, Optional[Mapping[str, Any]]]], user: Optional[str] = None) -> List[Dict[str, str]]:
+	writer = get_writer()
+	owner = user or session["user"]
+
+	documents = [{ "_id": ObjectId(), **(extra or {}), "code": code, "response": response, "user": owner } for code, response, extra in records]
+	if not documents:
+		return []
+
+	failed: set[int] = set()
+	if writer.enabled:
+		for index, document in enumerate(documents):
+			try:
+				writer.submit(document)
+			except WriteBufferFull:
+				failed = set(range(index, len(documents)))
+				break
+	else:
+		codes = writer.collection()
+		try:
+			with stage("database_write"):
+				insert_response = codes.insert_many(documents, ordered=False)
+			if codes.write_concern.acknowledged and not insert_response.acknowledged:
+				failed = set(range(len(documents)))
+		except BulkWriteError as e:
+			failed = { error["index"] for error in e.details.get("writeErrors", []) }
+		except PyMongoError as e:
+			print(e)
+			failed = set(range(len(documents)))
+
+	return [
+		{"error": "Database failed to insert the record"} if index in failed else {"id": str(document["_id"])}
+		for index, document in enumerate(documents)
+	]
@@ -0,0 +1,249 @@
+import os
+import time
+import click
+import atexit
+import threading
+
+from typing import Any, Dict, List, Mapping, Optional
+from bson import ObjectId, json_util
+from flask import Flask, current_app
+from pymongo import WriteConcern
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, PyMongoError
+from server.indexes import get_collection
+from server.metrics import stage
+"""
+Writes to the "codes" collection.
+
+By default every analysis is stored with its own acknowledged insert on the request
+path. With CODES_WRITE_BEHIND the records are collected in a bounded in-process
+buffer instead and a background thread stores them with insert_many once
+CODES_WRITE_BATCH_SIZE records are waiting or the oldest one has waited
+CODES_WRITE_FLUSH_INTERVAL seconds. Ids are generated client side, so the
+message_id handed back to the client is the _id the record will have.
+
+When the buffer holds CODES_WRITE_BUFFER_SIZE records that are not stored yet,
+submissions wait up to CODES_WRITE_BUFFER_TIMEOUT seconds for room and then fail
+with WriteBufferFull (503). A failed flush is retried with exponential backoff;
+records still failing after CODES_WRITE_RETRIES attempts are appended to a spill
+file (one Extended JSON document per line) that can be replayed with:
+
+	flask --app server replay-spilled-writes
+
+The buffer is flushed when the process exits. Records waiting in the buffer are not
+listed by /code/all yet, but can already be used as previous_id by their owner.
+
+Configuration keys (all optional):
+	CODES_WRITE_BEHIND: Buffer writes and store them in bulk. Defaults to False.
+	CODES_WRITE_CONCERN: Write concern "w" of every codes write, e.g. 0, 1 or
+		"majority". Defaults to the server default.
+	CODES_WRITE_JOURNAL: Write concern "j". Defaults to the server default.
+	CODES_WRITE_BATCH_SIZE: Records per insert_many. Defaults to 100.
+	CODES_WRITE_FLUSH_INTERVAL: Longest a record waits in the buffer, in seconds.
+		Defaults to 0.5.
+	CODES_WRITE_BUFFER_SIZE: Records not stored yet before submissions wait.
+		Defaults to 1000.
+	CODES_WRITE_BUFFER_TIMEOUT: Seconds a submission waits for room. Defaults to 5.
+	CODES_WRITE_RETRIES: Retries of a failed flush before spilling. Defaults to 3.
+	CODES_WRITE_RETRY_BACKOFF: Seconds before the first retry, doubled after each.
+		Defaults to 0.5.
+	CODES_WRITE_SPILL_PATH: Spill file. Defaults to "codes-spill.jsonl" in the
+		instance folder.
+"""
+
+EXTENSION_KEY = "codes_writer"
+DUPLICATE_KEY = 11000
+
+class WriteBufferFull(Exception):
+	"""Raised when the write buffer stays full for longer than the buffer timeout."""
+
+def write_concern(configuration: Mapping[str, Any]) -> WriteConcern:
+	return WriteConcern(w=configuration.get("CODES_WRITE_CONCERN"), j=configuration.get("CODES_WRITE_JOURNAL"))
+
+class BufferedWriter:
+	"""Stores code records directly or through a bounded write-behind buffer."""
+
+	def __init__(self, application: Flask) -> None:
+		configuration = application.config
+		self.application = application
+		self.enabled: bool = configuration.get("CODES_WRITE_BEHIND", False)
+		self.write_concern = write_concern(configuration)
+		self.batch_size: int = max(1, configuration.get("CODES_WRITE_BATCH_SIZE", 100))
+		self.flush_interval: float = configuration.get("CODES_WRITE_FLUSH_INTERVAL", 0.5)
+		self.max_buffered: int = max(1, configuration.get("CODES_WRITE_BUFFER_SIZE", 1000))
+		self.buffer_timeout: float = configuration.get("CODES_WRITE_BUFFER_TIMEOUT", 5)
+		self.retries: int = configuration.get("CODES_WRITE_RETRIES", 3)
+		self.retry_backoff: float = configuration.get("CODES_WRITE_RETRY_BACKOFF", 0.5)
+		self.spill_path: str = configuration.get("CODES_WRITE_SPILL_PATH") or os.path.join(application.instance_path, "codes-spill.jsonl")
+		self._buffer: List[Dict[str, Any]] = []
+		# Every record accepted but not stored or spilled yet, buffered or in flight
+		self._pending: Dict[ObjectId, Dict[str, Any]] = {}
+		self._oldest = 0.0
+		self._closed = False
+		self._thread: Optional[threading.Thread] = None
+		self._pid: Optional[int] = None
+		self._condition = threading.Condition()
+		self._spill_lock = threading.Lock()
+		self._stats = { "written": 0, "flushes": 0, "retried": 0, "spilled": 0, "rejected": 0 }
+
+	def collection(self) -> Collection:
+		collection = get_collection("codes")
+		if self.write_concern.is_server_default:
+			return collection
+		return collection.with_options(write_concern=self.write_concern)
+
+	def _start(self) -> None:
+		# The flush thread does not survive a fork; records buffered by the parent
+		# are the parent's to store, so a child starts empty
+		if self._pid != os.getpid():
+			self._buffer = []
+			self._pending = {}
+			self._closed = False
+			self._pid = os.getpid()
+			self._thread = threading.Thread(target=self._run, name="codes-writer", daemon=True)
+			self._thread.start()
+
+	def submit(self, document: Dict[str, Any]) -> ObjectId:
+		"""Buffer a record and return its _id, waiting while the buffer is full."""
+		document = { "_id": ObjectId(), **document }
+
+		with self._condition:
+			self._start()
+			if not self._closed:
+				deadline = time.monotonic() + self.buffer_timeout
+				while len(self._pending) >= self.max_buffered:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						self._stats["rejected"] += 1
+						raise WriteBufferFull()
+					self._condition.wait(remaining)
+
+				if not self._buffer:
+					self._oldest = time.monotonic()
+				self._buffer.append(document)
+				self._pending[document["_id"]] = document
+				if len(self._buffer) >= self.batch_size:
+					self._condition.notify_all()
+				return document["_id"]
+
+		# Accepted after close(), e.g. by a request finishing during shutdown
+		self._write([document])
+		return document["_id"]
+
+	def pending(self, object_id: Optional[ObjectId], user: str) -> Optional[Dict[str, Any]]:
+		"""Return a record of the user that is accepted but not stored yet."""
+		with self._condition:
+			document = self._pending.get(object_id) if object_id is not None and self._pid == os.getpid() else None
+		return document if document is not None and document.get("user") == user else None
+
+	def _run(self) -> None:
+		while True:
+			with self._condition:
+				while not self._closed and len(self._buffer) < self.batch_size:
+					if not self._buffer:
+						self._condition.wait()
+						continue
+					remaining = self._oldest + self.flush_interval - time.monotonic()
+					if remaining <= 0:
+						break
+					self._condition.wait(remaining)
+
+				batch = self._buffer[:self.batch_size]
+				del self._buffer[:self.batch_size]
+				self._oldest = time.monotonic()
+				if not batch:
+					return
+
+			self._write(batch)
+
+	def _write(self, documents: List[Dict[str, Any]]) -> None:
+		remaining = documents
+		attempt = 0
+		try:
+			while remaining:
+				try:
+					with self.application.app_context(), stage("database_flush"):
+						self.collection().insert_many(remaining, ordered=False)
+					remaining = []
+				except BulkWriteError as e:
+					# Duplicate keys come from a retry of a batch that partly landed
+					failed = { error["index"] for error in e.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY }
+					remaining = [document for index, document in enumerate(remaining) if index in failed]
+				except PyMongoError as e:
+					print(e)
+
+				if remaining:
+					attempt += 1
+					if attempt > self.retries:
+						self._spill(remaining)
+						break
+					with self._condition:
+						self._stats["retried"] += len(remaining)
+					time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+		finally:
+			with self._condition:
+				self._stats["flushes"] += 1
+				self._stats["written"] += len(documents) - len(remaining)
+				for document in documents:
+					self._pending.pop(document["_id"], None)
+				self._condition.notify_all()
+
+	def _spill(self, documents: List[Dict[str, Any]]) -> None:
+		try:
+			with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as spill:
+				for document in documents:
+					spill.write(json_util.dumps(document) + "\n")
+		except OSError as e:
+			print(e)
+			for document in documents:
+				print(f"lost codes record: {json_util.dumps(document)}")
+
+		with self._condition:
+			self._stats["spilled"] += len(documents)
+
+	def replay(self) -> int:
+		"""Store the records of the spill file and empty it; returns how many were stored."""
+		with self._spill_lock:
+			if not os.path.exists(self.spill_path):
+				return 0
+			with open(self.spill_path, encoding="utf-8") as spill:
+				documents = [json_util.loads(line) for line in spill if line.strip()]
+
+			if documents:
+				try:
+					self.collection().insert_many(documents, ordered=False)
+				except BulkWriteError as e:
+					if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+						raise
+			os.remove(self.spill_path)
+			return len(documents)
+
+	def close(self) -> None:
+		"""Stop accepting buffered records and store everything still waiting."""
+		with self._condition:
+			self._closed = True
+			self._condition.notify_all()
+			thread = self._thread if self._pid == os.getpid() else None
+
+		if thread is not None:
+			thread.join()
+
+	def stats(self) -> Dict[str, Any]:
+		with self._condition:
+			buffered = len(self._pending) if self._pid == os.getpid() else 0
+			return { **self._stats, "buffered": buffered }
+
+def init_writer(application: Flask) -> BufferedWriter:
+	writer = BufferedWriter(application)
+	application.extensions[EXTENSION_KEY] = writer
+	atexit.register(writer.close)
+
+	@application.cli.command("replay-spilled-writes")
+	def replay_spilled_writes_command() -> None:
+		"""Store the codes records spilled by failed write-behind flushes."""
+		click.echo(f"Stored {get_writer().replay()} spilled record(s)")
+
+	return writer
+
+def get_writer(application: Optional[Flask] = None) -> BufferedWriter:
+	return (application or current_app).extensions[EXTENSION_KEY]
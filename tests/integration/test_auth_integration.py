@@ -3,7 +3,6 @@ import unittest
 from server.database import connect_database
 from server import create_application
 from server.routes_auth import session
-from unittest.mock import patch
 from werkzeug.security import generate_password_hash
 
 class TestAuthIntegration(unittest.TestCase):	
@@ -11,7 +10,12 @@ class TestAuthIntegration(unittest.TestCase):
 	def setUpClass(cls) -> None:
 		"""Setup before each test instance"""
 		cls.database = connect_database(database_name="TestFlaskApplication")
-		cls.application = create_application({ "TESTING": True, "SECRET_KEY": "integration-secret" }).test_client()
+		cls.application = create_application({
+			"TESTING": True,
+			"SECRET_KEY": "integration-secret",
+			"MONGO_CLIENT": cls.database.client,
+			"MONGO_DATABASE": "TestFlaskApplication"
+		}).test_client()
 
 	@classmethod
 	def tearDownClass(cls) -> None:
@@ -26,11 +30,8 @@ class TestAuthIntegration(unittest.TestCase):
 		"""Tear down before each testcase"""
 		self.database.users.delete_many({})
 
-	@patch("server.routes_auth.connect_database")
-	def test_register_login_successful_flow(self, mock_connect_database) -> None:
+	def test_register_login_successful_flow(self) -> None:
 		"""Test successful register and login of a user"""
-		mock_connect_database.return_value = self.database
-
 		register = self.application.post("/register", json={
 			"username": "integration_username",
 			"password": "integration_password"
@@ -0,0 +1,201 @@
+import json
+import time
+import asyncio
+import unittest
+import mongomock
+
+from http.cookies import SimpleCookie
+from unittest.mock import patch
+from typing import Any, Dict, List, Optional, Tuple
+from werkzeug.security import generate_password_hash
+from server.asgi import create_asgi_application
+from server.hashing import HashingBusy, PasswordHasher
+from server.model import FakeBackend
+
+class AsyncCursor:
+	def __init__(self, cursor: Any) -> None:
+		self.cursor = cursor
+
+	def sort(self, *arguments: Any) -> "AsyncCursor":
+		self.cursor = self.cursor.sort(*arguments)
+		return self
+
+	def limit(self, limit: int) -> "AsyncCursor":
+		self.cursor = self.cursor.limit(limit)
+		return self
+
+	async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+		return list(self.cursor)
+
+class AsyncCollection:
+	"""Awaitable facade over a mongomock collection, shaped like pymongo's async API."""
+
+	def __init__(self, collection: Any) -> None:
+		self.collection = collection
+
+	def find(self, *arguments: Any) -> AsyncCursor:
+		return AsyncCursor(self.collection.find(*arguments))
+
+	def __getattr__(self, name: str) -> Any:
+		method = getattr(self.collection, name)
+
+		async def call(*arguments: Any, **keywords: Any) -> Any:
+			return method(*arguments, **keywords)
+		return call
+
+class AsyncClient:
+	def __init__(self, client: Any) -> None:
+		self.client = client
+
+	def __getitem__(self, name: str) -> Any:
+		database = self.client[name]
+
+		class AsyncDatabase:
+			def __getitem__(self, collection: str) -> AsyncCollection:
+				return AsyncCollection(database[collection])
+		return AsyncDatabase()
+
+class TestAsgi(unittest.TestCase):
+	"""TestAsgi verifies the async serving mode against the WSGI contracts."""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.database = self.client["FlaskApplication#01"]
+		self.database.users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
+		self.backend = FakeBackend(latency=0.2)
+		self.application = create_asgi_application({
+			"TESTING": True,
+			"MONGO_CLIENT": self.client,
+			"MONGO_ASYNC_CLIENT": AsyncClient(self.client),
+			"MODEL_CLIENT": self.backend,
+			"RATE_LIMIT_USER_BURST": 100,
+			"RATE_LIMIT_MODEL_CONCURRENCY": 100,
+		})
+		self.application.application.secret_key = "secret"
+
+	async def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None, cookie: str = "") -> Tuple[int, Dict[str, str], bytes]:
+		path, _, query = path.partition("?")
+		payload = json.dumps(body).encode("utf-8") if body is not None else b""
+		headers = [(b"content-type", b"application/json")]
+		if cookie:
+			headers.append((b"cookie", cookie.encode("latin-1")))
+		scope = { "type": "http", "method": method, "path": path, "query_string": query.encode("latin-1"), "headers": headers, "http_version": "1.1", "scheme": "http", "server": ("testserver", 80) }
+
+		received = [{ "type": "http.request", "body": payload, "more_body": False }]
+		done = asyncio.Event()
+
+		async def receive() -> Dict[str, Any]:
+			if received:
+				return received.pop(0)
+			await done.wait()
+			return { "type": "http.disconnect" }
+
+		messages: List[Dict[str, Any]] = []
+
+		async def send(message: Dict[str, Any]) -> None:
+			messages.append(message)
+
+		await self.application({ **scope }, receive, send)
+		done.set()
+
+		start = messages[0]
+		response_headers = { name.decode("latin-1"): value.decode("latin-1") for name, value in start["headers"] }
+		return start["status"], response_headers, b"".join(message.get("body", b"") for message in messages[1:])
+
+	async def login(self) -> str:
+		status, headers, _ = await self.request("POST", "/login", { "username": "predefined", "password": "password" })
+		self.assertEqual(status, 200)
+		cookie = SimpleCookie(headers["set-cookie"])
+		return "; ".join(f"{name}={morsel.value}" for name, morsel in cookie.items())
+
+	def test_auth_contracts(self) -> None:
+		"""Test that register and login answer like the WSGI routes"""
+		async def scenario() -> None:
+			status, _, body = await self.request("POST", "/register", { "username": "new", "password": "secret" })
+			self.assertEqual((status, json.loads(body)), (201, {"message": "User registered successfully"}))
+
+			status, _, body = await self.request("POST", "/register", { "username": "new", "password": "secret" })
+			self.assertEqual((status, json.loads(body)), (409, {"error": "Username already exists"}))
+
+			status, _, _ = await self.request("POST", "/login", { "username": "new", "password": "wrong" })
+			self.assertEqual(status, 401)
+			status, _, _ = await self.request("POST", "/login", { "username": "missing", "password": "wrong" })
+			self.assertEqual(status, 404)
+			await self.login()
+
+			# The optional rehash of an outdated hash never fails a correct login
+			self.database.users.insert_one({ "username": "legacy", "password": generate_password_hash("password", "pbkdf2:sha256:1000") })
+			with patch.object(PasswordHasher, "hash", side_effect=HashingBusy()):
+				status, _, _ = await self.request("POST", "/login", { "username": "legacy", "password": "password" })
+			self.assertEqual(status, 200)
+
+		asyncio.run(scenario())
+
+	def test_submit_and_list(self) -> None:
+		"""Test that submissions are analyzed, stored and listed with the same payloads"""
+		async def scenario() -> None:
+			status, _, _ = await self.request("GET", "/code/submit", { "code": "x = 1" })
+			self.assertEqual(status, 401)
+
+			cookie = await self.login()
+			status, _, body = await self.request("GET", "/code/submit", { "code": "x = 1" }, cookie)
+			payload = json.loads(body)
+			self.assertEqual(status, 200)
+			self.assertEqual(set(payload), { "message", "message_id", "cached", "static" })
+			self.assertFalse(payload["cached"])
+
+			status, _, body = await self.request("GET", "/code/submit", { "code": "x = 1" }, cookie)
+			self.assertTrue(json.loads(body)["cached"])
+
+			status, _, body = await self.request("GET", "/code/submit", { "code": "" }, cookie)
+			self.assertEqual(status, 400)
+
+			status, _, body = await self.request("GET", "/code/all?limit=1", None, cookie)
+			page = json.loads(body)
+			self.assertEqual(status, 200)
+			self.assertEqual(len(page["codes"]), 1)
+			self.assertIsNotNone(page["next_cursor"])
+
+			status, _, _ = await self.request("GET", "/code/all?cursor=invalid", None, cookie)
+			self.assertEqual(status, 400)
+
+		asyncio.run(scenario())
+
+	def test_concurrent_generations_share_the_loop(self) -> None:
+		"""Test that slow generations wait concurrently on one event loop"""
+		async def scenario() -> None:
+			cookie = await self.login()
+			started = time.perf_counter()
+			results = await asyncio.gather(*(self.request("GET", "/code/submit", { "code": f"value = {index}" }, cookie) for index in range(20)))
+			elapsed = time.perf_counter() - started
+
+			self.assertEqual([status for status, _, _ in results], [200] * 20)
+			self.assertEqual(self.backend.calls, 20)
+			self.assertLess(elapsed, 2.0)
+
+		asyncio.run(scenario())
+
+	def test_wsgi_fallback(self) -> None:
+		"""Test that other routes, including streams, are served by the WSGI application"""
+		async def scenario() -> None:
+			status, _, body = await self.request("GET", "/initial")
+			self.assertEqual((status, json.loads(body)), (200, {"message": "hello world"}))
+
+			cookie = await self.login()
+			status, _, body = await self.request("GET", "/code/submit?static_only=1", { "code": "x = 1" }, cookie)
+			self.assertEqual((status, list(json.loads(body))), (200, ["static"]))
+
+			status, headers, body = await self.request("GET", "/code/submit/stream?format=ndjson", { "code": "y = 2" }, cookie)
+			events = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+			self.assertEqual(status, 200)
+			self.assertEqual(events[-1]["type"], "done")
+			self.assertEqual(len([event for event in events if event["type"] == "chunk"]), 6)
+
+			status, _, _ = await self.request("GET", "/missing")
+			self.assertEqual(status, 404)
+
+		asyncio.run(scenario())
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,10 +1,12 @@
+import time
 import unittest
 import mongomock
 
+from unittest.mock import patch
 from werkzeug.security import generate_password_hash
 from server import create_application
+from server.hashing import HashingBusy, PasswordHasher
 from server.routes_auth import session
-from unittest.mock import patch
 
 class TestAuth(unittest.TestCase):
 	"""TestAuth verifies the application's authentication behaviour."""
@@ -13,7 +15,7 @@ class TestAuth(unittest.TestCase):
 		"""Setup before each testcase"""
 		self.client = mongomock.MongoClient()
 		self.database = self.client["FlaskApplication#01"]
-		self.application = create_application({ "TESTING": True }).test_client()
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client }).test_client()
 
 		self.database.users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
 
@@ -21,11 +23,8 @@ class TestAuth(unittest.TestCase):
 		"""Tear down after each testcase"""
 		self.client.database.users.delete_many({})
 
-	@patch("server.routes_auth.connect_database")
-	def test_register_user_success(self, mock_connect_database) -> None:
+	def test_register_user_success(self) -> None:
 		"""Test new user registration"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/register", json={ "username": "test", "password": "password" })
 
 		self.assertEqual(response.status_code, 201)
@@ -33,11 +32,8 @@ class TestAuth(unittest.TestCase):
 
 		self.assertIsNotNone(self.database.users.find_one({"username": "test"}))
 
-	@patch("server.routes_auth.connect_database")
-	def test_register_user_incomplete(self, mock_connect_database) -> None:
+	def test_register_user_incomplete(self) -> None:
 		"""Test incomplete user registeration"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/register", json={ "username": "predefined" })
 		self.assertEqual(response.status_code, 400)
 		self.assertEqual(response.get_json()["error"], "Missing username or password")
@@ -46,29 +42,20 @@ class TestAuth(unittest.TestCase):
 		self.assertEqual(response.status_code, 400)
 		self.assertEqual(response.get_json()["error"], "Missing username or password")
 
-	@patch("server.routes_auth.connect_database")
-	def test_register_user_existing(self, mock_connect_database) -> None:
+	def test_register_user_existing(self) -> None:
 		"""Test existing user registeration error"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/register", json={ "username": "predefined", "password": "password" })
 		self.assertEqual(response.status_code, 409)
 		self.assertEqual(response.get_json()["error"], "Username already exists")
 
-	@patch("server.routes_auth.connect_database")
-	def test_login_user_successfully(self, mock_connect_database) -> None:
+	def test_login_user_successfully(self) -> None:
 		"""Test existing user login"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/login", json={ "username": "predefined", "password": "password" })
 		self.assertEqual(response.status_code, 200)
 		self.assertEqual(response.get_json()["message"], "User login successfully")
 
-	@patch("server.routes_auth.connect_database")
-	def test_login_user_incomplete(self, mock_connect_database) -> None:
+	def test_login_user_incomplete(self) -> None:
 		"""Test incomplete user login"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/login", json={ "username": "predefined" })
 		self.assertEqual(response.status_code, 400)
 		self.assertEqual(response.get_json()["error"], "Missing username or password")
@@ -77,31 +64,71 @@ class TestAuth(unittest.TestCase):
 		self.assertEqual(response.status_code, 400)
 		self.assertEqual(response.get_json()["error"], "Missing username or password")
 
-	@patch("server.routes_auth.connect_database")
-	def test_login_user_incorrect_password(self, mock_connect_database) -> None:
+	def test_login_user_incorrect_password(self) -> None:
 		"""Test inccorect user login"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/login", json={ "username": "predefined", "password": "wrong_password" })
 		self.assertEqual(response.status_code, 401)
 		self.assertEqual(response.get_json()["error"], "Incorrect password")
 
-	@patch("server.routes_auth.connect_database")
-	def test_login_user_incorrect_username(self, mock_connect_database) -> None:
+	def test_login_user_incorrect_username(self) -> None:
 		"""Test inccorect user login"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.post("/login", json={ "username": "wrong_username", "password": "password" })
 		self.assertEqual(response.status_code, 404)
 		self.assertEqual(response.get_json()["error"], "User does not exist")
 
-	@patch("server.routes_auth.connect_database")
-	def test_logout_user(self, mock_connect_database) -> None:
+	def test_logout_user(self) -> None:
 		"""Test user logout"""
-		mock_connect_database.return_value = self.database
-
 		with self.application as client:
 			client.post("/login", json={ "username": "predefined", "password": "password" })
 			client.get("/logout")
 
 			self.assertIsNone(session.get("user"))
+
+	def test_login_rehashes_outdated_password(self) -> None:
+		"""Test if a hash with outdated parameters is replaced on login"""
+		self.database.users.insert_one({ "username": "legacy", "password": generate_password_hash("password", "pbkdf2:sha256:1000") })
+
+		response = self.application.post("/login", json={ "username": "legacy", "password": "password" })
+		self.assertEqual(response.status_code, 200)
+
+		stored = self.database.users.find_one({ "username": "legacy" })["password"]
+		self.assertTrue(stored.startswith("scrypt:32768:8:1$"))
+
+		response = self.application.post("/login", json={ "username": "legacy", "password": "password" })
+		self.assertEqual(response.status_code, 200)
+
+	def test_login_survives_a_failed_rehash(self) -> None:
+		"""Test if a login stands when the optional rehash finds the pool saturated"""
+		legacy = generate_password_hash("password", "pbkdf2:sha256:1000")
+		self.database.users.insert_one({ "username": "legacy", "password": legacy })
+
+		with patch.object(PasswordHasher, "hash", side_effect=HashingBusy()):
+			response = self.application.post("/login", json={ "username": "legacy", "password": "password" })
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(self.database.users.find_one({ "username": "legacy" })["password"], legacy)
+
+	def test_hashing_saturated(self) -> None:
+		"""Test if a saturated hashing pool answers 503 with Retry-After"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "PASSWORD_HASH_MAX_PENDING": 0 }).test_client()
+
+		response = application.post("/login", json={ "username": "predefined", "password": "password" })
+		self.assertEqual(response.status_code, 503)
+		self.assertEqual(response.headers["Retry-After"], "1")
+
+	def test_timed_out_hash_keeps_its_slot(self) -> None:
+		"""Test if an operation the caller stopped waiting for holds its slot until it finishes"""
+		hasher = PasswordHasher({ "PASSWORD_HASH_WORKERS": 1, "PASSWORD_HASH_MAX_PENDING": 1 })
+		try:
+			# Start the pool first so its startup does not count against the timeout
+			hasher._run("verify", bool, 1)
+			hasher.timeout = 0.1
+			with self.assertRaises(HashingBusy):
+				hasher._run("hash", time.sleep, 1)
+			with self.assertRaises(HashingBusy):
+				hasher._run("verify", bool, 1)
+			self.assertEqual(hasher.stats()["rejected"], 1)
+
+			time.sleep(1.5)
+			self.assertTrue(hasher._run("verify", bool, 1))
+		finally:
+			hasher.shutdown()
@@ -0,0 +1,38 @@
+import unittest
+
+from benchmarks.harness import compare, percentile, run_scenario
+
+class TestBenchmarks(unittest.TestCase):
+	"""TestBenchmarks verifies the statistics and baseline comparison of the benchmark suite."""
+
+	def test_percentile(self) -> None:
+		"""Test nearest-rank percentiles"""
+		samples = [float(value) for value in range(1, 101)]
+		self.assertEqual(percentile(samples, 0.50), 50.0)
+		self.assertEqual(percentile(samples, 0.95), 95.0)
+		self.assertEqual(percentile(samples, 0.99), 99.0)
+		self.assertEqual(percentile([], 0.5), 0.0)
+
+	def test_run_scenario(self) -> None:
+		"""Test that every request is made once and statuses are tallied"""
+		seen = []
+		result = run_scenario("example", lambda session, worker, iteration: seen.append(iteration) or (500 if iteration == 0 else 200), [None, None], 10)
+
+		self.assertEqual(sorted(seen), list(range(10)))
+		self.assertEqual(result["requests"], 10)
+		self.assertEqual(result["statuses"], { "200": 9, "500": 1 })
+		self.assertEqual(result["errors"], 1)
+
+	def test_compare(self) -> None:
+		"""Test that throughput, latency and error regressions are reported"""
+		def results(rps: float, p95: float, errors: int = 0) -> dict:
+			return { "results": { "testclient": { "login": { "requests_per_second": rps, "latency_ms": { "p95": p95 }, "errors": errors } } } }
+
+		self.assertEqual(compare(results(95, 10), results(100, 10)), [])
+		self.assertEqual(len(compare(results(70, 10), results(100, 10))), 1)
+		self.assertEqual(len(compare(results(100, 13), results(100, 10))), 1)
+		self.assertEqual(len(compare(results(100, 10, 1), results(100, 10))), 1)
+		self.assertEqual(compare(results(10, 100), { "results": {} }), [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import mongomock
+
+from unittest.mock import patch
+from server import create_application
+from server.cache import LRUCache, cache_key, get_cache
+
+class TestCache(unittest.TestCase):
+	"""TestCache verifies the analysis cache tiers."""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client })
+
+	def test_key_ignores_whitespace(self) -> None:
+		"""Test that whitespace-only changes map to the same key"""
+		first = cache_key("def f():\n\treturn 1\n", "model", "1")
+		second = cache_key("\r\ndef f():   \r\n\treturn 1", "model", "1")
+		self.assertEqual(first, second)
+		self.assertNotEqual(first, cache_key("def f():\n\treturn 1\n", "other-model", "1"))
+		self.assertNotEqual(first, cache_key("def f():\n\treturn 1\n", "model", "2"))
+
+	def test_lru_eviction_and_ttl(self) -> None:
+		"""Test LRU size bound and expiry"""
+		cache = LRUCache(max_size=2)
+		cache.set("a", 1)
+		cache.set("b", 2)
+		cache.get("a")
+		cache.set("c", 3)
+		self.assertEqual(cache.get("a"), 1)
+		self.assertIsNone(cache.get("b"))
+
+		with patch("server.cache.time.monotonic", side_effect=[0, 100]):
+			expiring = LRUCache(max_size=2, ttl_seconds=10)
+			expiring.set("a", 1)
+			self.assertIsNone(expiring.get("a"))
+
+	def test_store_tier(self) -> None:
+		"""Test that entries survive in the MongoDB tier"""
+		with self.application.app_context():
+			cache = get_cache()
+			cache.set("key", "analysis")
+			cache.memory.clear()
+
+			self.assertEqual(cache.get("key"), "analysis")
+			self.assertIsNone(cache.get("missing"))
+			self.assertEqual(cache.stats()["store_hits"], 1)
+			self.assertEqual(cache.stats()["misses"], 1)
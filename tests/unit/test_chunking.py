@@ -0,0 +1,33 @@
+import unittest
+
+from server.chunking import estimate_tokens, split_code
+
+class TestChunking(unittest.TestCase):
+	"""TestChunking verifies how large submissions are split."""
+
+	def test_split_python_definitions(self) -> None:
+		"""Test that chunks follow top-level definitions and cover every line"""
+		functions = [f"# helper {index}\ndef function_{index}():\n\treturn {index}\n" for index in range(6)]
+		code = "import os\n\n" + "\n".join(functions)
+
+		chunks = split_code(code, token_budget=estimate_tokens(functions[0]) * 2)
+
+		self.assertGreater(len(chunks), 1)
+		self.assertEqual(chunks[0].start_line, 1)
+		self.assertEqual(chunks[-1].end_line, len(code.splitlines()))
+		for previous, current in zip(chunks, chunks[1:]):
+			self.assertEqual(previous.end_line + 1, current.start_line)
+
+		names = [name for chunk in chunks for name in chunk.names]
+		self.assertEqual(names, [f"function_{index}" for index in range(6)])
+		self.assertTrue(all(chunk.text.count("def ") <= 2 for chunk in chunks))
+
+	def test_split_unparsable_text(self) -> None:
+		"""Test the line-based fallback for code that does not parse"""
+		code = "\n".join(f"let value{index} = {index};" for index in range(40))
+
+		chunks = split_code(code, token_budget=20)
+
+		self.assertGreater(len(chunks), 1)
+		self.assertEqual("\n".join(chunk.text for chunk in chunks), code)
+		self.assertTrue(all(chunk.names == [] for chunk in chunks))
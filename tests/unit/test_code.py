@@ -1,9 +1,15 @@
+import json
+import time
+import threading
 import unittest
 import mongomock
 
+from bson import ObjectId
 from unittest.mock import patch
 from werkzeug.security import generate_password_hash
 from server import create_application
+from server.analysis import Analysis
+from server.model import FakeBackend
 
 class TestCodeSubmit(unittest.TestCase):
 	"""TestCodeSubmit verifies the application's code handling behaviour"""
@@ -12,7 +18,7 @@ class TestCodeSubmit(unittest.TestCase):
 		"""Setup before each testcase"""
 		self.client = mongomock.MongoClient()
 		self.database = self.client["FlaskApplication#01"]
-		self.application = create_application({ "TESTING": True }).test_client()
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_BACKEND": "fake" }).test_client()
 
 		self.database.users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
 
@@ -20,19 +26,13 @@ class TestCodeSubmit(unittest.TestCase):
 		"""Tear down after each testcase"""
 		self.client.database.users.delete_many({})
 
-	@patch("server.routes_auth.connect_database")
-	def test_user_login_fail(self, mock_connect_database) -> None:
+	def test_user_login_fail(self) -> None:
 		"""Test if unauthorized code submission fails"""
-		mock_connect_database.return_value = self.database
-
 		response = self.application.get("/code/submit")
 		self.assertEqual(response.status_code, 401)
 
-	@patch("server.routes_auth.connect_database")
-	def test_code_submit_successful(self, mock_connect_database) -> None:
+	def test_code_submit_successful(self) -> None:
 		"""Test if code submission is successful"""
-		mock_connect_database.return_value = self.database
-
 		self.test_code = """print('Hello World')"""
 
 		with self.application as client:
@@ -40,13 +40,10 @@ class TestCodeSubmit(unittest.TestCase):
 
 			response = client.get("/code/submit", json={ "code": self.test_code })
 			self.assertEqual(response.status_code, 200)
-			self.assertIsNotNone(response.get_json()["message"])
+			self.assertEqual(response.get_json()["message"], "Analysis of 3 line(s) by gemini-2.5-flash-lite.")
 
-	@patch("server.routes_auth.connect_database")
-	def test_empty_code(self, mock_connect_database) -> None:
+	def test_empty_code(self) -> None:
 		"""Test if empty code fails"""
-		mock_connect_database.return_value = self.database
-
 		with self.application as client:
 			client.post("/login", json={"username": "predefined", "password": "password"})
 
@@ -54,14 +51,322 @@ class TestCodeSubmit(unittest.TestCase):
 			self.assertEqual(response.status_code, 400)
 			self.assertEqual(response.get_json()["error"], "Code provided is empty")
 
-	@patch("server.routes_auth.connect_database")
-	def test_all_codes(self, mock_connect_database) -> None:
+	def test_all_codes(self) -> None:
 		"""Test if all codes are fetched"""
-		mock_connect_database.return_value = self.database
-
 		with self.application as client:
 			client.post("/login", json={"username": "predefined", "password": "password"})
 
 			response = client.get("/code/all")
 			self.assertEqual(response.status_code, 200)
 			self.assertIsInstance(response.get_json()["codes"], list)
+
+	def test_all_codes_paginated(self) -> None:
+		"""Test if the history is paged, projected and exported"""
+		with self.application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			user = self.database.users.find_one({ "username": "predefined" })["_id"]
+
+			self.database.codes.insert_many([{ "code": f"c{index}", "response": f"r{index}", "user": str(user) } for index in range(5)])
+			self.database.codes.insert_one({ "code": "other", "response": "other", "user": "someone-else" })
+
+			first = client.get("/code/all?limit=2").get_json()
+			self.assertEqual([code["code"] for code in first["codes"]], ["c4", "c3"])
+
+			second = client.get(f"/code/all?limit=2&cursor={first['next_cursor']}").get_json()
+			self.assertEqual([code["code"] for code in second["codes"]], ["c2", "c1"])
+
+			last = client.get(f"/code/all?limit=2&cursor={second['next_cursor']}").get_json()
+			self.assertEqual([code["code"] for code in last["codes"]], ["c0"])
+			self.assertIsNone(last["next_cursor"])
+
+			projected = client.get("/code/all?fields=response").get_json()["codes"]
+			self.assertEqual(set(projected[0].keys()), {"_id", "response"})
+
+			for fields in ("", "bogus"):
+				projected = client.get("/code/all", query_string={ "fields": fields }).get_json()["codes"]
+				self.assertEqual(set(projected[0].keys()), {"_id"})
+
+			export = client.get("/code/all?format=ndjson")
+			self.assertEqual(len(export.get_data(as_text=True).splitlines()), 5)
+
+			self.assertEqual(client.get("/code/all?cursor=invalid").status_code, 400)
+
+	@patch("server.analysis.generate_analysis")
+	def test_code_submit_cached(self, mock_generate_analysis) -> None:
+		"""Test if resubmitted code is answered from the cache"""
+		mock_generate_analysis.return_value = "analysis"
+
+		with self.application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			first = client.get("/code/submit", json={ "code": "x = 1\n" })
+			second = client.get("/code/submit", json={ "code": "x = 1   \r\n" })
+			bypass = client.get("/code/submit?cache=0", json={ "code": "x = 1" })
+
+			self.assertFalse(first.get_json()["cached"])
+			self.assertTrue(second.get_json()["cached"])
+			self.assertFalse(bypass.get_json()["cached"])
+			self.assertEqual(mock_generate_analysis.call_count, 2)
+			self.assertEqual(self.database.codes.count_documents({}), 3)
+
+			stats = client.get("/code/cache").get_json()["cache"]
+			self.assertEqual(stats["hits"], 1)
+
+	@patch("server.routes_code.stream_analysis")
+	def test_code_submit_stream(self, mock_stream_analysis) -> None:
+		"""Test if the analysis is streamed and then stored"""
+		mock_stream_analysis.side_effect = lambda code: (text for text in ["first ", "second"])
+
+		with self.application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit/stream?format=ndjson", json={ "code": "y = 2" })
+			events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+			self.assertEqual([event["type"] for event in events], ["chunk", "chunk", "done"])
+			stored = self.database.codes.find_one({ "_id": ObjectId(events[-1]["message_id"]) })
+			self.assertEqual(stored["response"], "first second")
+			self.assertEqual(stored["route"]["path"], "model")
+			self.assertEqual(stored["route"]["attempts"][0]["outcome"], "ok")
+
+			response = client.get("/code/submit/stream", json={ "code": "y = 2" })
+			self.assertEqual(response.mimetype, "text/event-stream")
+			self.assertIn("event: done", response.get_data(as_text=True))
+			self.assertEqual(mock_stream_analysis.call_count, 1)
+
+	@patch("server.routes_code.stream_analysis")
+	def test_code_submit_stream_disconnect(self, mock_stream_analysis) -> None:
+		"""Test if a client disconnect closes the upstream stream"""
+		closed = []
+
+		def upstream(code):
+			try:
+				yield "first"
+				yield "second"
+			finally:
+				closed.append(True)
+
+		mock_stream_analysis.side_effect = upstream
+
+		with self.application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit/stream", json={ "code": "z = 3" }, buffered=False)
+			next(iter(response.response))
+			response.close()
+
+			self.assertEqual(closed, [True])
+			self.assertEqual(self.database.codes.count_documents({}), 0)
+
+	@patch("server.analysis.generate_analysis")
+	def test_code_submit_async(self, mock_generate_analysis) -> None:
+		"""Test if an async submission can be polled until it finishes"""
+		mock_generate_analysis.return_value = "analysis"
+
+		with self.application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit?async=1", json={ "code": "w = 4" })
+			self.assertEqual(response.status_code, 202)
+			job_id = response.get_json()["job_id"]
+
+			response = client.get(f"/code/jobs/{job_id}/wait?timeout=5")
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(response.get_json()["status"], "done")
+			self.assertEqual(response.get_json()["message"], "analysis")
+
+			response = client.get(f"/code/jobs/{job_id}")
+			stored = self.database.codes.find_one({ "_id": ObjectId(response.get_json()["message_id"]) })
+			self.assertEqual(stored["route"]["path"], "model")
+
+			self.assertEqual(client.get("/code/jobs/unknown").status_code, 404)
+
+	@patch("server.jobs.analyze_code")
+	def test_jobs_cancelled_at_shutdown(self, mock_analyze_code) -> None:
+		"""Test if jobs still queued when the process exits are marked failed"""
+		release = threading.Event()
+		mock_analyze_code.side_effect = lambda code, **keywords: release.wait(5) and Analysis("analysis")
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "JOBS_WORKERS": 1 })
+		jobs = application.extensions["job_queue"]
+
+		with application.app_context():
+			running = jobs.submit("a = 1", "user")
+			queued = jobs.submit("b = 2", "user")
+			while self.database.jobs.find_one({ "_id": ObjectId(running) })["status"] != "running":
+				time.sleep(0.01)
+
+			jobs.shutdown()
+			job = jobs.get(queued, "user")
+			self.assertEqual((job["status"], job["error"]), ("failed", "Server shut down before the job ran"))
+			self.assertEqual(jobs.wait(queued, "user", 1)["status"], "failed")
+
+			release.set()
+			self.assertEqual(jobs.wait(running, "user", 5)["status"], "done")
+
+	def test_code_submit_async_queue_full(self) -> None:
+		"""Test if submissions are refused once the queue is full"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "JOBS_MAX_DEPTH": 0 }).test_client()
+
+		with application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit?async=1", json={ "code": "w = 4" })
+			self.assertEqual(response.status_code, 503)
+
+	@patch("server.analysis.generate_analysis")
+	def test_code_submit_batch(self, mock_generate_analysis) -> None:
+		"""Test if a batch is analyzed with per-item results"""
+		mock_generate_analysis.side_effect = lambda code, *args: None if code == "fails" else f"analysis of {code}"
+
+		with self.application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit/batch", json={ "codes": ["a = 1", "", "fails", "b = 2"] })
+			self.assertEqual(response.status_code, 200)
+
+			results = response.get_json()["results"]
+			self.assertEqual(results[0]["message"], "analysis of a = 1")
+			self.assertEqual(results[1]["error"], "Code provided is empty")
+			self.assertEqual(results[2]["error"], "Model did not respond with any content")
+			self.assertEqual(results[3]["message"], "analysis of b = 2")
+			self.assertEqual(self.database.codes.count_documents({}), 2)
+			stored = self.database.codes.find_one({ "_id": ObjectId(results[3]["message_id"]) })
+			self.assertEqual(stored["route"]["path"], "model")
+			self.assertIn("deadline_ms", stored["route"])
+
+			response = client.get("/code/submit/batch", json={ "codes": [] })
+			self.assertEqual(response.status_code, 400)
+
+			# The default burst of 10 caps the batch size below BATCH_MAX_ITEMS
+			response = client.get("/code/submit/batch", json={ "codes": ["c = 3"] * 11 })
+			self.assertEqual(response.status_code, 413)
+			self.assertEqual(response.get_json()["error"], "At most 10 codes can be submitted at once")
+
+		# Raised together, the burst lets BATCH_MAX_ITEMS take over
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_BACKEND": "fake", "RATE_LIMIT_USER_BURST": 100, "BATCH_MAX_ITEMS": 40 })
+		with application.test_client() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			self.assertEqual(client.get("/code/submit/batch", json={ "codes": ["c = 3"] * 41 }).status_code, 400)
+			response = client.get("/code/submit/batch", json={ "codes": [f"c = {index}" for index in range(30)] })
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(len(response.get_json()["results"]), 30)
+
+	def test_code_submit_chunked(self) -> None:
+		"""Test if a large submission is analyzed in chunks"""
+		application = create_application({
+			"TESTING": True,
+			"MONGO_CLIENT": self.client,
+			"MODEL_BACKEND": "fake",
+			"CHUNK_THRESHOLD_TOKENS": 10,
+			"CHUNK_TOKEN_BUDGET": 10
+		}).test_client()
+		code = "def first():\n\treturn 1\n\ndef second():\n\treturn 2\n"
+
+		with application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit", json={ "code": code })
+			self.assertEqual(response.status_code, 200)
+
+			chunks = response.get_json()["chunks"]
+			self.assertEqual([chunk["names"] for chunk in chunks], [["first"], ["second"]])
+			self.assertEqual((chunks[1]["start_line"], chunks[1]["end_line"]), (3, 5))
+			self.assertIn("### Lines 3-5 (second)", response.get_json()["message"])
+
+			response = client.get("/code/submit", json={ "code": "x = 1" })
+			self.assertNotIn("chunks", response.get_json())
+
+	def test_code_submit_static(self) -> None:
+		"""Test the static report, the static-only flag and local answers"""
+		application = create_application({
+			"TESTING": True,
+			"MONGO_CLIENT": self.client,
+			"MODEL_CLIENT": FakeBackend(),
+			"STATIC_ANSWER_TRIVIAL": True
+		})
+		backend = application.extensions["model_backend"]
+
+		with application.test_client() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit?static_only=1", json={ "code": "import os" })
+			self.assertEqual(response.get_json(), { "static": response.get_json()["static"] })
+			self.assertEqual(response.get_json()["static"]["unused_imports"][0]["name"], "os")
+
+			response = client.get("/code/submit", json={ "code": "print('Hello World')" })
+			self.assertTrue(response.get_json()["local"])
+			self.assertTrue(response.get_json()["static"]["trivial"])
+			self.assertIsNotNone(response.get_json()["message_id"])
+			self.assertEqual(backend.calls, 0)
+
+			response = client.get("/code/submit", json={ "code": "def f():\n\treturn 1" })
+			self.assertNotIn("local", response.get_json())
+			self.assertEqual(backend.calls, 1)
+
+	def test_code_submit_incremental(self) -> None:
+		"""Test if only changed units are re-analyzed against a previous submission"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_CLIENT": FakeBackend() })
+		backend = application.extensions["model_backend"]
+		original = "import os\n\ndef first():\n\treturn 1\n\ndef second():\n\treturn 2\n"
+		edited = "import os\n\n\ndef first():\n\treturn 1\n\ndef second():\n\treturn 3\n\ndef third():\n\treturn 4\n"
+
+		with application.test_client() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response = client.get("/code/submit?incremental=1", json={ "code": original })
+			self.assertEqual(response.get_json()["incremental"]["analyzed"], ["<module 1>", "first", "second"])
+			self.assertEqual(backend.calls, 3)
+			previous_id = ObjectId(response.get_json()["message_id"])
+			self.database.codes.update_one({ "_id": previous_id, "units.key": "first" }, { "$set": { "units.$.analysis": "Returns a constant at line 4 (lines 3-4); see line 7." } })
+
+			response = client.get("/code/submit", json={ "code": edited, "previous_id": str(previous_id) })
+			self.assertEqual(response.status_code, 200)
+
+			incremental = response.get_json()["incremental"]
+			self.assertEqual(incremental["reused"], ["<module 1>", "first"])
+			self.assertEqual(incremental["analyzed"], ["second", "third"])
+			self.assertEqual(backend.calls, 5)
+
+			stored = self.database.codes.find_one({ "_id": ObjectId(response.get_json()["message_id"]) })
+			self.assertEqual([unit["key"] for unit in stored["units"]], ["<module 1>", "first", "second", "third"])
+			self.assertEqual(stored["units"][1]["analysis"], "Returns a constant at line 5 (lines 4-5); see line 7.")
+
+			response = client.get("/code/submit", json={ "code": edited, "previous_id": str(ObjectId()) })
+			self.assertEqual(response.status_code, 404)
+
+	def test_code_submit_coalesced(self) -> None:
+		"""Test if identical concurrent submissions share one model call but get their own records"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_CLIENT": FakeBackend(latency=0.3) })
+		backend = application.extensions["model_backend"]
+		clients = [application.test_client() for _ in range(3)]
+		for client in clients:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+		responses = []
+		threads = [threading.Thread(target=lambda client=client: responses.append(client.get("/code/submit", json={ "code": "v = 5" }))) for client in clients]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join(5)
+
+		self.assertEqual(backend.calls, 1)
+		self.assertEqual(len({ response.get_json()["message_id"] for response in responses }), 3)
+		self.assertEqual(sum(1 for response in responses if response.get_json().get("coalesced")), 2)
+
+	def test_code_submit_rate_limited(self) -> None:
+		"""Test if submissions over the per-user limit are refused with Retry-After"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_BACKEND": "fake", "RATE_LIMIT_USER_BURST": 2 }).test_client()
+
+		with application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			self.assertEqual(client.get("/code/submit", json={ "code": "x = 1" }).status_code, 200)
+			self.assertEqual(client.get("/code/submit?static_only=1", json={ "code": "x = 2" }).status_code, 200)
+			self.assertEqual(client.get("/code/submit", json={ "code": "x = 3" }).status_code, 200)
+
+			response = client.get("/code/submit", json={ "code": "x = 4" })
+			self.assertEqual(response.status_code, 429)
+			self.assertIn("Retry-After", response.headers)
+
+			self.assertEqual(client.get("/code/all").status_code, 200)
+			self.assertEqual(client.get("/code/limits").get_json()["limits"]["limited_user"], 1)
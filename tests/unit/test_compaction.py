@@ -0,0 +1,136 @@
+import unittest
+import mongomock
+
+from werkzeug.security import generate_password_hash
+from server import create_application
+from server.compaction import compact
+from server.model import FakeBackend
+
+SOURCE = '''"""Helpers for the billing service.
+
+Every function here is pure and has no side effects on the database. Amounts are
+always integers expressed in cents, rates are expressed in basis points and every
+result is rounded down, as required by the accounting team for the yearly audit.
+"""
+import math
+
+# Rates are expressed in basis points
+RATE = 125
+
+
+def total(amounts):
+	"""Sum every amount.
+
+	Amounts are integers expressed in cents.
+	"""
+	# Accumulate in a local variable
+	result = 0
+	for amount in amounts:
+		result += amount  # TODO: guard against overflow in the legacy exporter path of the nightly job
+	return result
+
+TEMPLATE = """
+# not a comment   
+"""
+
+def fees(amounts):
+	result = 0
+	for amount in amounts:
+		result += amount * RATE // 10000
+	return result
+
+def refunds(amounts):
+	result = 0
+	for amount in amounts:
+		result += amount * RATE // 10000
+	return result
+'''
+
+class RecordingBackend(FakeBackend):
+	def __init__(self) -> None:
+		super().__init__()
+		self.prompts = []
+
+	def generate(self, model, prompt, timeout=None):
+		self.prompts.append(prompt)
+		return super().generate(model, prompt, timeout)
+
+class TestCompaction(unittest.TestCase):
+	"""TestCompaction verifies prompt compaction and its line references"""
+
+	def test_steps(self) -> None:
+		"""Test that comments, docstrings, blank lines and repeats are compacted"""
+		compaction = compact(SOURCE)
+		self.assertEqual(compaction.applied, ("comments", "docstrings", "whitespace", "dedupe"))
+		self.assertLess(compaction.tokens, compaction.original_tokens)
+
+		self.assertNotIn("Rates are expressed", compaction.text)
+		self.assertNotIn("Amounts are integers", compaction.text)
+		self.assertIn('\t"""Sum every amount."""', compaction.text)
+		self.assertIn("# TODO: guard against overflow", compaction.text)
+		self.assertNotIn("legacy exporter path", compaction.text)
+		self.assertIn("@@ lines 35-38 repeat lines 29-32 @@", compaction.text)
+
+		# String literals are left alone, trailing whitespace included
+		self.assertIn('TEMPLATE = """\n# not a comment   \n"""', compaction.text)
+
+	def test_dedupe_leaves_strings_alone(self) -> None:
+		"""Test that lines inside a triple-quoted string are never replaced by a repeat"""
+		block = "\ta = compute(1)\n\tb = compute(2)\n\tc = compute(3)\n\td = compute(4)\n"
+		code = f"def f():\n{block}\treturn a\n\nUSAGE = \"\"\"\n{block}{block}\"\"\"\n"
+		compaction = compact(code, steps=("dedupe",))
+		self.assertNotIn("repeat", compaction.text)
+		self.assertEqual(compaction.applied, ())
+
+		repeated = compact(f"def f():\n{block}\treturn a\n\ndef g():\n{block}\treturn a\n", steps=("dedupe",))
+		self.assertIn("@@ lines 9-13 repeat lines 2-6 @@", repeated.text)
+
+	def test_line_references(self) -> None:
+		"""Test that markers and the line map point at the original lines"""
+		compaction = compact(SOURCE)
+		source = SOURCE.splitlines()
+		expected = 1
+
+		for index, line in enumerate(compaction.text.splitlines(), 1):
+			number = compaction.original_line(index)
+			if line.startswith("@@ lines"):
+				expected = int(line.split()[2].split("-")[1]) + 1
+			elif line.startswith("@@ "):
+				expected = int(line.split()[1])
+			else:
+				self.assertEqual(number, expected)
+				self.assertTrue(source[number - 1].startswith(line.split("#")[0].rstrip().rstrip('"')), (number, line))
+				expected += 1
+
+	def test_offset_and_other_languages(self) -> None:
+		"""Test chunk offsets and that code other than Python keeps its comments"""
+		compaction = compact("int x = 1;   \n\n// a comment\nint y = 2;", first_line=40)
+		self.assertEqual(compaction.applied, ("whitespace",))
+		self.assertEqual(compaction.text, "int x = 1;\n@@ 42 @@\n// a comment\nint y = 2;")
+		self.assertEqual(compaction.line_map, (40, None, 42, 43))
+
+		unchanged = compact("x = 1")
+		self.assertEqual((unchanged.text, unchanged.applied), ("x = 1", ()))
+
+	def test_submission_reports_savings(self) -> None:
+		"""Test that the compacted prompt is sent and its savings reported"""
+		for enabled in (True, False):
+			backend = RecordingBackend()
+			client = mongomock.MongoClient()
+			client["FlaskApplication#01"].users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
+			application = create_application({ "TESTING": True, "MONGO_CLIENT": client, "MODEL_CLIENT": backend, "PROMPT_COMPACTION": enabled })
+
+			with application.test_client() as test_client:
+				test_client.post("/login", json={"username": "predefined", "password": "password"})
+				payload = test_client.get("/code/submit", json={ "code": SOURCE }).get_json()
+
+			if enabled:
+				self.assertIn("@@ lines 35-38 repeat lines 29-32 @@", backend.prompts[0])
+				self.assertGreater(payload["compaction"]["saved_tokens"], 0)
+				self.assertEqual(payload["compaction"]["original_tokens"] - payload["compaction"]["prompt_tokens"], payload["compaction"]["saved_tokens"])
+			else:
+				self.assertEqual(backend.prompts[0], f"Analyze:\n\n{SOURCE}")
+				self.assertNotIn("compaction", payload)
+
+if __name__ == "__main__":
+	unittest.main()
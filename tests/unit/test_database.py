@@ -1,7 +1,11 @@
 import unittest
+import mongomock
 
 from typing import Any
-from server.database import connect_database
+from unittest.mock import patch
+from server import create_application
+from server.database import connect_database, get_database, MongoPool
+from server.indexes import verify_indexes
 
 class DatabaseTestCase(unittest.TestCase):
 	def setUp(self) -> None:
@@ -28,3 +32,63 @@ class DatabaseTestCase(unittest.TestCase):
 		self.assertIsNotNone(response)
 		if response:
 			self.assertEqual(response.get("message"), "unittest check")
+
+class MongoPoolTestCase(unittest.TestCase):
+	"""MongoPoolTestCase verifies the shared per-process connection pool."""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MONGO_DATABASE": "PoolTest" })
+
+	def test_pool_is_shared(self) -> None:
+		"""Test that every request sees the same client"""
+		with self.application.app_context():
+			first = get_database()
+			second = get_database()
+
+		self.assertIs(first.client, second.client)
+		self.assertIs(first.client, self.client)
+		self.assertEqual(first.name, "PoolTest")
+
+	def test_pool_recreated_after_fork(self) -> None:
+		"""Test that a changed process id builds a fresh client"""
+		pool = MongoPool({ "MONGO_URI": "mongodb://localhost:27017" })
+		parent = pool.client
+
+		with patch("server.database.os.getpid", return_value=-1):
+			child = pool.client
+
+		self.assertIsNot(parent, child)
+		child.close()
+		parent.close()
+
+class IndexesTestCase(unittest.TestCase):
+	"""IndexesTestCase verifies index declaration and bootstrap."""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MONGO_DATABASE": "IndexTest" })
+
+	def test_create_indexes_command(self) -> None:
+		"""Test that the CLI command creates and verifies every index"""
+		runner = self.application.test_cli_runner()
+
+		result = runner.invoke(args=["create-indexes", "--verify"])
+		self.assertEqual(result.exit_code, 1)
+		self.assertIn("users: missing index", result.output)
+
+		result = runner.invoke(args=["create-indexes"])
+		self.assertEqual(result.exit_code, 0)
+		self.assertIn("All indexes are in place", result.output)
+
+		with self.application.app_context():
+			self.assertEqual(verify_indexes(get_database(), self.application.config), [])
+
+	def test_ensure_indexes_on_startup(self) -> None:
+		"""Test that indexes are created by the factory when enabled"""
+		create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MONGO_DATABASE": "Startup", "MONGO_ENSURE_INDEXES": True })
+
+		information = self.client["Startup"].users.index_information()
+		self.assertTrue(any(index.get("unique") for index in information.values()))
@@ -1,5 +1,8 @@
+import os
+import tempfile
 import unittest
 
+from unittest.mock import patch
 from server import create_application
 
 class TestFactory(unittest.TestCase):
@@ -31,3 +34,15 @@ class TestFactory(unittest.TestCase):
 			response = self.application.get("/initial")
 			self.assertEqual(response.status_code, 200)
 			self.assertEqual(response.get_json(), {"message": "hello world"})
+
+	def test_configuration_from_files_and_environment(self) -> None:
+		"""Test that without a test configuration the settings file and FLASK_ variables are loaded"""
+		with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as settings:
+			settings.write("CODES_PAGE_SIZE = 5\nMODEL_TIMEOUT = 30\n")
+		try:
+			with patch.dict(os.environ, { "SERVER_SETTINGS": settings.name, "FLASK_CODES_PAGE_SIZE": "7" }):
+				application = create_application()
+			self.assertEqual(application.config["CODES_PAGE_SIZE"], 7)
+			self.assertEqual(application.config["MODEL_TIMEOUT"], 30)
+		finally:
+			os.unlink(settings.name)
@@ -0,0 +1,50 @@
+import unittest
+import mongomock
+
+from unittest.mock import patch
+from server import create_application
+from server.health import warmup
+from server.__main__ import parse_arguments
+
+class TestHealth(unittest.TestCase):
+	"""TestHealth verifies warmup, the readiness route and the serve options."""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": mongomock.MongoClient(), "MODEL_BACKEND": "fake" })
+
+	def test_ready_after_warmup(self) -> None:
+		"""Test that /ready answers 503 until warmup ran, then 200"""
+		client = self.application.test_client()
+		self.assertEqual(client.get("/ready").status_code, 503)
+		self.assertEqual(client.get("/initial").status_code, 200)
+
+		checks = warmup(self.application)
+		self.assertTrue(checks["mongo"])
+		self.assertTrue(checks["model"])
+		self.assertTrue(checks["synthetic_request"])
+
+		response = client.get("/ready")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()["status"], "ready")
+
+	def test_not_ready_when_mongo_is_down(self) -> None:
+		"""Test that /ready answers 503 once MongoDB stops answering"""
+		warmup(self.application)
+		self.application.extensions["readiness"].ping_interval = 0
+
+		with patch.object(self.application.extensions["mongo_pool"].client.admin, "command", side_effect=Exception("down")):
+			response = self.application.test_client().get("/ready")
+		self.assertEqual(response.status_code, 503)
+		self.assertEqual(response.get_json()["status"], "unavailable")
+
+	def test_serve_options(self) -> None:
+		"""Test that serve options come from the environment unless given on the command line"""
+		with patch.dict("os.environ", { "SERVE_THREADS": "16", "SERVE_WORKERS": "4" }):
+			options = parse_arguments(["--workers", "2"])
+		self.assertEqual(options.threads, 16)
+		self.assertEqual(options.workers, 2)
+		self.assertEqual(options.port, 8080)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,114 @@
+import logging
+import datetime
+import unittest
+import mongomock
+
+from flask.logging import default_handler
+from pymongo import monitoring
+from werkzeug.security import generate_password_hash
+from server import create_application
+from server.metrics import TRACE_LOG_HANDLER, Metrics, MongoCommandListener, MongoPoolListener, stage
+
+class TestMetrics(unittest.TestCase):
+	"""TestMetrics verifies the instrumentation registry and the /metrics endpoint."""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.client["FlaskApplication#01"].users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
+
+	def test_histogram_rendering(self) -> None:
+		"""Test that histograms render cumulative buckets, sum and count"""
+		metrics = Metrics(buckets=(0.1, 1.0))
+		metrics.observe("stage_duration_seconds", 0.05, stage="model")
+		metrics.observe("stage_duration_seconds", 0.5, stage="model")
+		metrics.observe("stage_duration_seconds", 5, stage="model")
+		metrics.inc("http_requests_total", endpoint="/code/submit", method="GET", status=200)
+
+		text = metrics.render()
+		self.assertIn("# TYPE stage_duration_seconds histogram", text)
+		self.assertIn('stage_duration_seconds_bucket{stage="model",le="0.1"} 1', text)
+		self.assertIn('stage_duration_seconds_bucket{stage="model",le="1"} 2', text)
+		self.assertIn('stage_duration_seconds_bucket{stage="model",le="+Inf"} 3', text)
+		self.assertIn('stage_duration_seconds_sum{stage="model"} 5.55', text)
+		self.assertIn('stage_duration_seconds_count{stage="model"} 3', text)
+		self.assertIn('http_requests_total{endpoint="/code/submit",method="GET",status="200"} 1', text)
+
+	def test_disabled_records_nothing(self) -> None:
+		"""Test that a disabled registry ignores everything and serves no endpoint"""
+		metrics = Metrics(enabled=False)
+		metrics.inc("http_requests_total")
+		with metrics.time("stage_duration_seconds", stage="model"):
+			pass
+		self.assertEqual(metrics.render(), "\n")
+		self.assertEqual(metrics.mongo_listeners(), [])
+
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "METRICS_ENABLED": False })
+		self.assertEqual(application.test_client().get("/metrics").status_code, 404)
+
+	def test_mongo_listeners(self) -> None:
+		"""Test that command timings and pool usage are recorded"""
+		metrics = Metrics()
+		commands = MongoCommandListener(metrics)
+		pool = MongoPoolListener(metrics)
+
+		commands.succeeded(monitoring.CommandSucceededEvent(datetime.timedelta(microseconds=2500), {"ok": 1}, "find", 1, ("localhost", 27017), None))
+		pool.connection_created(monitoring.ConnectionCreatedEvent(("localhost", 27017), 1))
+		pool.connection_checked_out(monitoring.ConnectionCheckedOutEvent(("localhost", 27017), 1, 0.002))
+
+		self.assertEqual(metrics.histogram("mongo_command_duration_seconds", command="find").count, 1)
+		self.assertEqual(metrics.value("mongo_connections_open"), 1)
+		self.assertEqual(metrics.value("mongo_connections_checked_out"), 1)
+
+		pool.connection_checked_in(monitoring.ConnectionCheckedInEvent(("localhost", 27017), 1))
+		self.assertEqual(metrics.value("mongo_connections_checked_out"), 0)
+
+	def test_endpoint_reports_routes_and_stages(self) -> None:
+		"""Test that requests, stages and model calls show up on /metrics"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_BACKEND": "fake" })
+
+		with application.test_client() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			self.assertEqual(client.get("/code/submit", json={ "code": "x = 1" }).status_code, 200)
+
+			response = client.get("/metrics")
+			self.assertEqual(response.status_code, 200)
+			self.assertTrue(response.content_type.startswith("text/plain"))
+
+			text = response.get_data(as_text=True)
+			self.assertIn('http_requests_total{endpoint="/code/submit",method="GET",status="200"} 1', text)
+			self.assertIn('http_request_duration_seconds_count{endpoint="/login",method="POST"} 1', text)
+			for name in ("password_verify", "static_analysis", "cache_lookup", "model", "database_write"):
+				self.assertIn(f'stage_duration_seconds_count{{stage="{name}"}} 1', text)
+			self.assertIn('model_request_duration_seconds_count{model="gemini-2.5-flash-lite",outcome="ok"} 1', text)
+			self.assertIn('model_prompt_bytes_total{model="gemini-2.5-flash-lite"} 15', text)
+			self.assertIn('component_stat{component="cache",name="misses"} 1', text)
+
+	def test_trace_ids(self) -> None:
+		"""Test that trace IDs are taken from the request or generated, and echoed"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "METRICS_TRACE_IDS": True })
+
+		with application.test_client() as client:
+			self.assertEqual(client.get("/initial", headers={ "X-Request-ID": "abc" }).headers["X-Request-ID"], "abc")
+			self.assertEqual(len(client.get("/initial").headers["X-Request-ID"]), 32)
+
+		# Logs carry the trace ID through a handler of the application's own
+		handlers = [handler for handler in application.logger.handlers if handler.get_name() == TRACE_LOG_HANDLER]
+		self.assertEqual(len(handlers), 1)
+		self.assertNotIn(default_handler, application.logger.handlers)
+		self.assertNotIn("trace_id", default_handler.formatter._fmt if default_handler.formatter else "")
+		with application.test_request_context():
+			record = logging.LogRecord("server", logging.INFO, __file__, 1, "hello", None, None)
+			self.assertTrue(handlers[0].filter(record))
+			self.assertIn("[-] in", handlers[0].format(record))
+
+		create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "METRICS_TRACE_IDS": True })
+		self.assertEqual(len([handler for handler in application.logger.handlers if handler.get_name() == TRACE_LOG_HANDLER]), 1)
+
+	def test_stage_outside_application(self) -> None:
+		"""Test that stage() is a no-op without an application context"""
+		with stage("model"):
+			pass
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import mongomock
+
+from unittest.mock import patch
+from server import create_application
+from server.model import FakeBackend, GeminiBackend, get_model
+
+class TestModel(unittest.TestCase):
+	"""TestModel verifies the shared model client layer."""
+
+	def test_gemini_client_is_reused(self) -> None:
+		"""Test that the google-genai client is built once per process with retries and timeouts"""
+		backend = GeminiBackend({ "MODEL_API_KEY": "key", "MODEL_TIMEOUT": 5, "MODEL_RETRY_ATTEMPTS": 4 })
+
+		with patch("google.genai.Client") as mock_client:
+			first = backend.client
+			second = backend.client
+
+		self.assertIs(first, second)
+		mock_client.assert_called_once()
+		http_options = mock_client.call_args.kwargs["http_options"]
+		self.assertEqual(http_options.timeout, 5000)
+		self.assertEqual(http_options.retry_options.attempts, 4)
+		self.assertIn(503, http_options.retry_options.http_status_codes)
+
+		# A call with its own deadline makes a single attempt within it
+		config = backend._config(1.5)
+		self.assertEqual(config.http_options.timeout, 1500)
+		self.assertEqual(config.http_options.retry_options.attempts, 1)
+
+	def test_fake_backend(self) -> None:
+		"""Test the fake backend answer, stream and injected latency"""
+		backend = FakeBackend("{model}: {lines}", latency=0.05)
+
+		self.assertEqual(backend.generate("model", "a\nb"), "model: 2")
+		self.assertEqual("".join(backend.generate_stream("model", "a")), "model: 1")
+		with self.assertRaises(TimeoutError):
+			backend.generate("model", "a", timeout=0.01)
+
+	def test_backend_from_configuration(self) -> None:
+		"""Test that the factory installs the configured backend"""
+		backend = FakeBackend()
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": mongomock.MongoClient(), "MODEL_CLIENT": backend })
+
+		with application.app_context():
+			self.assertIs(get_model(), backend)
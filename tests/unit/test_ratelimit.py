@@ -0,0 +1,185 @@
+import time
+import asyncio
+import unittest
+import threading
+import mongomock
+
+from unittest.mock import patch
+from server import create_application
+from server.ratelimit import CostTooHigh, RateLimited, RateLimiter, TokenBucket, get_limiter, retry_after_header
+
+class TestRateLimiter(unittest.TestCase):
+	"""TestRateLimiter verifies admission control of model calls."""
+
+	def test_token_bucket_refills(self) -> None:
+		"""Test that a bucket refuses once empty and reports when it refills"""
+		bucket = TokenBucket(rate=10, capacity=2)
+		self.assertTrue(bucket.take()[0])
+		self.assertTrue(bucket.take()[0])
+
+		allowed, retry_after = bucket.take()
+		self.assertFalse(allowed)
+		self.assertGreater(retry_after, 0)
+		self.assertLessEqual(retry_after, 0.1)
+
+		time.sleep(0.15)
+		self.assertTrue(bucket.take()[0])
+
+	def test_user_limit_is_per_user(self) -> None:
+		"""Test that one user's burst does not limit another"""
+		limiter = RateLimiter({ "RATE_LIMIT_USER_PER_MINUTE": 1, "RATE_LIMIT_USER_BURST": 2 })
+		limiter.check("first")
+		limiter.check("first")
+
+		with self.assertRaises(RateLimited) as context:
+			limiter.check("first")
+		self.assertEqual(context.exception.scope, "user")
+		self.assertEqual(retry_after_header(context.exception), { "Retry-After": "60" })
+
+		limiter.check("second")
+		self.assertEqual(limiter.stats()["limited_user"], 1)
+		self.assertEqual(limiter.stats()["allowed"], 3)
+
+	def test_busy_user_bucket_does_not_expire(self) -> None:
+		"""Test that a user who keeps sending requests past the bucket TTL keeps their spent bucket"""
+		clock = [1000.0]
+		with patch("time.monotonic", lambda: clock[0]):
+			limiter = RateLimiter({ "RATE_LIMIT_USER_PER_MINUTE": 30, "RATE_LIMIT_USER_BURST": 10 })
+			allowed = 0
+			for _ in range(240):
+				try:
+					limiter.check("first")
+					allowed += 1
+				except RateLimited:
+					pass
+				clock[0] += 0.5
+
+		# The burst plus 30 per minute over two minutes, give or take the last refill
+		self.assertLessEqual(allowed, 71)
+
+	def test_global_limit_refunds_user(self) -> None:
+		"""Test that a global refusal does not spend the user's tokens"""
+		limiter = RateLimiter({ "RATE_LIMIT_USER_BURST": 2, "RATE_LIMIT_GLOBAL_PER_MINUTE": 1, "RATE_LIMIT_GLOBAL_BURST": 1 })
+		limiter.check("first")
+
+		with self.assertRaises(RateLimited) as context:
+			limiter.check("second")
+		self.assertEqual(context.exception.scope, "global")
+
+		limiter._global.tokens = 1
+		limiter.check("second")
+		limiter._global.tokens = 1
+		limiter.check("second")
+
+	def test_batch_cost(self) -> None:
+		"""Test that a batch is charged in full and one over the burst is refused outright"""
+		limiter = RateLimiter({ "RATE_LIMIT_USER_PER_MINUTE": 1, "RATE_LIMIT_USER_BURST": 4 })
+		limiter.check("first", 3)
+		with self.assertRaises(RateLimited):
+			limiter.check("first", 2)
+		with self.assertRaises(CostTooHigh) as context:
+			limiter.check("second", 5)
+		self.assertEqual(context.exception.limit, 4)
+
+	def test_model_slot_bounds_concurrency(self) -> None:
+		"""Test that model calls over the concurrency limit are refused after waiting"""
+		limiter = RateLimiter({ "RATE_LIMIT_MODEL_CONCURRENCY": 1, "RATE_LIMIT_MODEL_WAIT": 0.05 })
+		entered = threading.Event()
+		release = threading.Event()
+
+		def hold() -> None:
+			with limiter.model_slot():
+				entered.set()
+				release.wait(5)
+
+		thread = threading.Thread(target=hold)
+		thread.start()
+		entered.wait(5)
+		self.assertEqual(limiter.stats()["model_calls_in_flight"], 1)
+
+		with self.assertRaises(RateLimited):
+			with limiter.model_slot():
+				pass
+
+		release.set()
+		thread.join(5)
+		with limiter.model_slot():
+			pass
+		self.assertEqual(limiter.stats()["limited_concurrency"], 1)
+
+	def test_model_slot_wait_is_capped_by_the_deadline(self) -> None:
+		"""Test that a caller with little time left waits only that long, and times out"""
+		limiter = RateLimiter({ "RATE_LIMIT_MODEL_CONCURRENCY": 1, "RATE_LIMIT_MODEL_WAIT": 5 })
+		with limiter.model_slot():
+			started = time.monotonic()
+			with self.assertRaises(TimeoutError):
+				with limiter.model_slot(0.05):
+					pass
+			self.assertLess(time.monotonic() - started, 1)
+		self.assertEqual(limiter.stats()["limited_concurrency"], 0)
+
+	def test_cancelled_async_waiter_frees_its_slot(self) -> None:
+		"""Test that a slot taken for a cancelled coroutine is released again"""
+		limiter = RateLimiter({ "RATE_LIMIT_MODEL_CONCURRENCY": 1, "RATE_LIMIT_MODEL_WAIT": 5 })
+
+		async def scenario() -> None:
+			release = asyncio.Event()
+
+			async def hold() -> None:
+				async with limiter.model_slot_async():
+					await release.wait()
+
+			async def call() -> None:
+				async with limiter.model_slot_async():
+					pass
+
+			holder = asyncio.create_task(hold())
+			await asyncio.sleep(0.01)
+			with self.assertRaises(asyncio.TimeoutError):
+				await asyncio.wait_for(call(), 0.05)
+
+			release.set()
+			await holder
+			await asyncio.sleep(0.1)
+			await asyncio.wait_for(call(), 1)
+
+		asyncio.run(scenario())
+		self.assertTrue(limiter._slots.acquire(blocking=False))
+
+	def test_disabled(self) -> None:
+		"""Test that a disabled limiter admits everything"""
+		limiter = RateLimiter({ "RATE_LIMIT_ENABLED": False, "RATE_LIMIT_USER_BURST": 1 })
+		for _ in range(5):
+			limiter.check("first")
+
+	def test_shared_windows(self) -> None:
+		"""Test that the shared per-minute windows are counted in MongoDB"""
+		client = mongomock.MongoClient()
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": client, "RATE_LIMIT_SHARED": True, "RATE_LIMIT_USER_PER_MINUTE": 2 })
+
+		with application.app_context():
+			limiter = get_limiter()
+			limiter.check("first")
+			limiter.check("first")
+
+			with self.assertRaises(RateLimited) as context:
+				limiter.check("first")
+			self.assertEqual(context.exception.scope, "user")
+			self.assertEqual(client["FlaskApplication#01"].rate_limits.count_documents({}), 2)
+
+	def test_shared_global_limit_refunds_user(self) -> None:
+		"""Test that a shared global refusal gives the user's window its count back"""
+		client = mongomock.MongoClient()
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": client, "RATE_LIMIT_SHARED": True, "RATE_LIMIT_GLOBAL_PER_MINUTE": 2 })
+
+		with application.app_context():
+			limiter = get_limiter()
+			limiter.check("first", 2)
+			with self.assertRaises(RateLimited) as context:
+				limiter.check("second", 2)
+			self.assertEqual(context.exception.scope, "global")
+			window = client["FlaskApplication#01"].rate_limits.find_one({ "_id": { "$regex": "^user:second:" } })
+			self.assertEqual(window["count"], 0)
+
+if __name__ == "__main__":
+	unittest.main()
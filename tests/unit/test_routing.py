@@ -0,0 +1,159 @@
+import time
+import unittest
+import threading
+import mongomock
+
+from bson import ObjectId
+from werkzeug.security import generate_password_hash
+from server import create_application
+from server.model import FakeBackend
+from server.routing import Deadline, ModelRoute, ModelRouter
+
+ROUTES = [
+	{ "model": "large", "max_input_tokens": 1000, "latency": 0.5, "latency_per_1k_tokens": 0.0 },
+	{ "model": "small", "latency": 0.05, "latency_per_1k_tokens": 0.0 },
+]
+
+class StalledBackend(FakeBackend):
+	"""Answers like FakeBackend, except that the stalled models never answer in time."""
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.stalled: set[str] = set()
+		self.timeouts: list[float] = []
+
+	def generate(self, model, prompt, timeout=None):
+		if model in self.stalled:
+			self.timeouts.append(timeout)
+			time.sleep(timeout)
+			raise TimeoutError(f"{model} timed out")
+		return super().generate(model, prompt, timeout)
+
+class TestRouting(unittest.TestCase):
+	"""TestRouting verifies model routing within the deadline of a submission"""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.database = self.client["FlaskApplication#01"]
+		self.database.users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
+		self.backend = StalledBackend()
+
+	def application(self, **configuration):
+		return create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_CLIENT": self.backend, "MODEL_ROUTES": ROUTES, "MODEL_DEADLINE": 1.0, **configuration }).test_client()
+
+	def submit(self, client, code: str, deadline_ms=None):
+		headers = { "X-Request-Deadline-Ms": str(deadline_ms) } if deadline_ms is not None else {}
+		response = client.get("/code/submit", json={ "code": code }, headers=headers)
+		document = self.database.codes.find_one({ "_id": ObjectId(response.get_json()["message_id"]) }) if response.status_code == 200 else None
+		return response, document
+
+	def test_model_by_size_and_budget(self) -> None:
+		"""Test that the most capable model that fits the input and the budget is used"""
+		with self.application() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response, document = self.submit(client, "x = 1")
+			self.assertTrue(response.get_json()["message"].endswith("by large."))
+			self.assertNotIn("route", response.get_json())
+			self.assertEqual(document["route"]["path"], "model")
+			self.assertEqual(document["route"]["models"], ["large"])
+			self.assertEqual(document["route"]["deadline_ms"], 1000)
+
+			response, document = self.submit(client, "x = 2", deadline_ms=500)
+			self.assertTrue(response.get_json()["message"].endswith("by small."))
+			self.assertEqual(document["route"]["attempts"][0]["model"], "small")
+
+			response, document = self.submit(client, "\n".join(f"x{index} = {index}" for index in range(1000)))
+			self.assertEqual(document["route"]["models"], ["small"])
+
+			response, document = self.submit(client, "x = 1")
+			self.assertEqual(document["route"]["path"], "cache")
+
+	def test_fallback_to_faster_model(self) -> None:
+		"""Test that a stalled call is cancelled in time for the faster model to answer"""
+		self.backend.stalled.add("large")
+		with self.application(MODEL_ROUTES=[{ **ROUTES[0], "latency": 0.1 }, ROUTES[1]]) as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+
+			response, document = self.submit(client, "x = 1")
+			self.assertEqual(response.status_code, 200)
+			self.assertTrue(response.get_json()["message"].endswith("by small."))
+			self.assertEqual(response.get_json()["route"], "fallback_model")
+			self.assertEqual([attempt["outcome"] for attempt in document["route"]["attempts"]], ["timeout", "ok"])
+			self.assertLess(self.backend.timeouts[0], 0.75)
+
+	def test_fallback_published_to_other_processes(self) -> None:
+		"""Test that a fallback model's analysis is published where other processes poll for it"""
+		self.backend.stalled.add("large")
+		with self.application(MODEL_ROUTES=[{ **ROUTES[0], "latency": 0.1 }, ROUTES[1]], SINGLEFLIGHT_SHARED=True) as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			response, _ = self.submit(client, "x = 1")
+			self.assertEqual(response.get_json()["route"], "fallback_model")
+
+			lease = self.database.analysis_leases.find_one({})
+			self.assertEqual(lease["result"], response.get_json()["message"])
+
+	def test_cached_and_static_fallbacks(self) -> None:
+		"""Test that a submission no model answers in time falls back to the cache, then to its static report"""
+		with self.application() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			self.submit(client, "import os\nx = 1", deadline_ms=500)
+
+			self.backend.stalled.update(["large", "small"])
+			response, document = self.submit(client, "import os\nx = 1")
+			self.assertEqual(response.get_json()["route"], "fallback_cache")
+			self.assertTrue(response.get_json()["message"].endswith("by small."))
+			self.assertEqual(document["route"]["attempts"][0]["outcome"], "timeout")
+
+			response, document = self.submit(client, "import sys\nx = 1", deadline_ms=300)
+			self.assertEqual(response.get_json()["route"], "fallback_static")
+			self.assertIn("sys is imported at line 1 but never used", response.get_json()["message"])
+			self.assertEqual(document["route"]["path"], "fallback_static")
+
+		with self.application(MODEL_FALLBACK_STATIC=False) as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			response, _ = self.submit(client, "import json\nx = 1", deadline_ms=300)
+			self.assertEqual(response.status_code, 504)
+
+	def test_coalesced_follower_keeps_its_deadline(self) -> None:
+		"""Test that a submission waiting on an identical one falls back by its own deadline"""
+		self.backend.stalled.add("large")
+		application = self.application(MODEL_ROUTES=ROUTES[:1], MODEL_DEADLINE=3.0, MODEL_DEADLINE_RESERVE=0.1)
+
+		def leader() -> None:
+			with application.application.test_client() as client:
+				client.post("/login", json={"username": "predefined", "password": "password"})
+				self.submit(client, "import os\nx = 1")
+
+		thread = threading.Thread(target=leader)
+		thread.start()
+		while not self.backend.timeouts:
+			time.sleep(0.01)
+
+		with application as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			started = time.monotonic()
+			response, document = self.submit(client, "import os\nx = 1", deadline_ms=500)
+			self.assertLess(time.monotonic() - started, 1)
+			self.assertEqual(response.get_json()["route"], "fallback_static")
+			self.assertTrue(response.get_json()["coalesced"])
+		thread.join(5)
+
+	def test_router_estimates(self) -> None:
+		"""Test deadline parsing and that estimates follow observed latencies"""
+		router = ModelRouter({ "MODEL_ROUTES": ROUTES, "MODEL_DEADLINE": 10, "MODEL_MAX_DEADLINE": 20 })
+		self.assertEqual(router.deadline("5000").seconds, 5)
+		self.assertEqual(router.deadline("99999").seconds, 20)
+		self.assertEqual(router.deadline("soon").seconds, 10)
+
+		self.assertEqual([route.model for route in router.plan(2000, Deadline(10))], ["small"])
+		self.assertEqual([route.model for route in router.plan(10, Deadline(10))], ["large", "small"])
+		for _ in range(20):
+			router.observe(router.routes[0], 10, 20.0)
+		self.assertEqual([route.model for route in router.plan(10, Deadline(10))], ["small"])
+		self.assertEqual(router.plan(10, Deadline(0)), [router.routes[1]])
+		self.assertIsInstance(router.routes[0], ModelRoute)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+import mongomock
+
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from werkzeug.security import generate_password_hash
+from server import create_application
+from server.indexes import index_keys
+from server.search import MemorySearch, highlight, parse_query
+
+class TestSearch(unittest.TestCase):
+	"""TestSearch verifies /code/search with the in-process index"""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.client = mongomock.MongoClient()
+		self.database = self.client["FlaskApplication#01"]
+		self.application = create_application({ "TESTING": True, "MONGO_CLIENT": self.client, "MODEL_BACKEND": "fake", "CODES_SEARCH_BACKEND": "memory" }).test_client()
+
+		user = self.database.users.insert_one({ "username": "predefined", "password": generate_password_hash("password") }).inserted_id
+		self.user = str(user)
+		self.database.codes.insert_many([
+			{ "user": self.user, "code": "cursor.execute('SELECT * FROM users WHERE id = ' + user_id)", "response": "The query is built by concatenation and is open to SQL injection. Use parameters." },
+			{ "user": self.user, "code": "def add(a, b):\n\treturn a + b", "response": "Simple and correct." },
+			{ "user": self.user, "code": "os.system('ls ' + path)", "response": "Shell commands built from input can be injected." },
+			{ "user": "someone-else", "code": "query = 'SELECT 1'", "response": "Possible SQL injection." },
+		])
+
+	def login(self, client) -> None:
+		client.post("/login", json={"username": "predefined", "password": "password"})
+
+	def test_ranked_and_scoped(self) -> None:
+		"""Test that results are the user's own matches, most relevant first"""
+		with self.application as client:
+			self.login(client)
+			response = client.get("/code/search?q=SQL injection")
+			self.assertEqual(response.status_code, 200)
+
+			codes = response.get_json()["codes"]
+			self.assertEqual(len(codes), 2)
+			self.assertIn("SQL injection", codes[0]["response"])
+			self.assertIn("injected", codes[1]["response"])
+			self.assertGreater(codes[0]["score"], codes[1]["score"])
+
+	def test_phrases_and_negations(self) -> None:
+		"""Test that phrases are required and negated terms exclude records"""
+		with self.application as client:
+			self.login(client)
+			codes = client.get('/code/search?q="sql injection"').get_json()["codes"]
+			self.assertEqual(len(codes), 1)
+
+			codes = client.get("/code/search?q=injection -shell").get_json()["codes"]
+			self.assertEqual(len(codes), 1)
+			self.assertIn("SQL", codes[0]["response"])
+
+	def test_highlights_and_projection(self) -> None:
+		"""Test that snippets point at the matches and fields can be left out"""
+		with self.application as client:
+			self.login(client)
+			result = client.get("/code/search?q=concatenation&fields=").get_json()["codes"][0]
+			self.assertEqual(set(result), { "_id", "score", "highlights" })
+
+			snippet = result["highlights"][0]
+			self.assertEqual(snippet["field"], "response")
+			start, end = snippet["matches"][0]
+			self.assertEqual(snippet["snippet"][start:end], "concatenation")
+
+			result = client.get("/code/search?q=concatenation&highlight=0").get_json()["codes"][0]
+			self.assertEqual(set(result), { "_id", "score", "code", "response" })
+
+	def test_pagination_and_new_records(self) -> None:
+		"""Test that pages follow each other and new submissions become searchable"""
+		with self.application as client:
+			self.login(client)
+			first = client.get("/code/search?q=injection&limit=1").get_json()
+			self.assertEqual(len(first["codes"]), 1)
+			second = client.get(f"/code/search?q=injection&limit=1&cursor={first['next_cursor']}").get_json()
+			self.assertEqual(len(second["codes"]), 1)
+			self.assertIsNone(second["next_cursor"])
+			self.assertNotEqual(first["codes"][0]["_id"], second["codes"][0]["_id"])
+
+			client.get("/code/submit", json={ "code": "print('Hello World')" })
+			self.assertEqual(len(client.get("/code/search?q=analysis").get_json()["codes"]), 1)
+
+	def test_records_stored_out_of_order(self) -> None:
+		"""Test that records stored after newer ones are still indexed, within the window or not"""
+		with self.application as client:
+			self.login(client)
+			self.assertEqual(len(client.get("/code/search?q=overflow").get_json()["codes"]), 0)
+
+			now = datetime.now(timezone.utc)
+			self.database.codes.insert_one({ "_id": ObjectId.from_datetime(now - timedelta(seconds=5)), "user": self.user, "code": "buffer[i] = x", "response": "Possible overflow." })
+			self.assertEqual(len(client.get("/code/search?q=overflow").get_json()["codes"]), 1)
+
+			self.database.codes.insert_one({ "_id": ObjectId.from_datetime(now - timedelta(hours=1)), "user": self.user, "code": "eval(data)", "response": "Spilled and stored late." })
+			self.assertEqual(len(client.get("/code/search?q=spilled").get_json()["codes"]), 1)
+
+	def test_memory_bound(self) -> None:
+		"""Test that the least recently searched users are dropped once the index is full"""
+		with self.application.application.app_context():
+			search = MemorySearch({ "CODES_SEARCH_MEMORY_MAX_DOCUMENTS": 2 })
+			self.assertEqual(len(search.search(self.user, "injection", 0, 10, {})), 2)
+			self.assertEqual(len(search.search("someone-else", "injection", 0, 10, {})), 1)
+			self.assertEqual(list(search._indexes), ["someone-else"])
+			self.assertEqual(len(search.search(self.user, "injection", 0, 10, {})), 2)
+			self.assertEqual(list(search._indexes), [self.user])
+
+	def test_invalid_requests(self) -> None:
+		"""Test that empty queries and malformed cursors are refused"""
+		with self.application as client:
+			self.assertEqual(client.get("/code/search?q=sql").status_code, 401)
+			self.login(client)
+			self.assertEqual(client.get("/code/search?q=").status_code, 400)
+			self.assertEqual(client.get("/code/search?q=sql&cursor=abc").status_code, 400)
+			self.assertEqual(client.get(f"/code/search?q={'x' * 300}").status_code, 400)
+
+	def test_query_helpers(self) -> None:
+		"""Test query parsing, highlighting and text index key normalization"""
+		query = parse_query('injected -shell "sql injection" the')
+		self.assertEqual(query.terms, { "inject", "sql" })
+		self.assertEqual(query.negated, { "shell" })
+		self.assertEqual(query.phrases, [ "sql injection" ])
+
+		highlights = highlight({ "code": "x" * 500 + " injection " + "y" * 500 }, "injection", 40)
+		self.assertEqual(len(highlights[0]["snippet"]), 40)
+		start, end = highlights[0]["matches"][0]
+		self.assertEqual(highlights[0]["snippet"][start:end], "injection")
+
+		info = { "key": [("user", 1), ("_fts", "text"), ("_ftsx", 1)], "weights": { "response": 3, "code": 1 } }
+		self.assertEqual(index_keys(info), [("user", 1), ("code", "text"), ("response", "text")])
+
+if __name__ == "__main__":
+	unittest.main()
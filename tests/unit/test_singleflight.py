@@ -0,0 +1,109 @@
+import time
+import unittest
+import threading
+import mongomock
+
+from server import create_application
+from server.singleflight import FlightTimeout, MongoLease, SingleFlight
+
+class TestSingleFlight(unittest.TestCase):
+	"""TestSingleFlight verifies coalescing of identical concurrent calls."""
+
+	def test_concurrent_calls_share_one_result(self) -> None:
+		"""Test that waiters share the leader's result"""
+		flights = SingleFlight()
+		calls = []
+		started = threading.Event()
+		release = threading.Event()
+
+		def function() -> str:
+			calls.append(True)
+			started.set()
+			release.wait(5)
+			return "result"
+
+		results = []
+		leader = threading.Thread(target=lambda: results.append(flights.do("key", function)))
+		leader.start()
+		started.wait(5)
+
+		followers = [threading.Thread(target=lambda: results.append(flights.do("key", function))) for _ in range(3)]
+		for follower in followers:
+			follower.start()
+		while flights.stats()["followers"] < 3:
+			time.sleep(0.01)
+		release.set()
+		for thread in [leader, *followers]:
+			thread.join(5)
+
+		self.assertEqual(len(calls), 1)
+		self.assertEqual(sorted(results), [("result", False)] + [("result", True)] * 3)
+
+	def test_follower_timeout(self) -> None:
+		"""Test that a follower gives up once its timeout runs out"""
+		flights = SingleFlight()
+		started = threading.Event()
+		release = threading.Event()
+
+		def function() -> str:
+			started.set()
+			release.wait(5)
+			return "result"
+
+		leader = threading.Thread(target=lambda: flights.do("key", function))
+		leader.start()
+		started.wait(5)
+
+		began = time.monotonic()
+		with self.assertRaises(FlightTimeout):
+			flights.do("key", function, timeout=0.05)
+		self.assertLess(time.monotonic() - began, 1)
+		self.assertEqual(flights.stats()["follower_timeouts"], 1)
+
+		release.set()
+		leader.join(5)
+
+	def test_errors_reach_followers(self) -> None:
+		"""Test that a failing leader fails its followers too"""
+		flights = SingleFlight()
+
+		def function() -> str:
+			raise RuntimeError("failed")
+
+		with self.assertRaises(RuntimeError):
+			flights.do("key", function)
+		self.assertEqual(flights.stats()["in_flight"], 0)
+
+	def test_lease_across_processes(self) -> None:
+		"""Test that a lease held elsewhere makes the caller wait for the shared result"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": mongomock.MongoClient() })
+
+		with application.app_context():
+			lease = MongoLease(timeout=5)
+			other_process = lease.acquire("key")
+			self.assertIsNotNone(other_process)
+			self.assertIsNone(lease.acquire("key"))
+
+			flights = SingleFlight(lease, poll_interval=0.01)
+			lookups = iter([None, None, "remote"])
+			result = flights.do("key", lambda: "local", lambda: next(lookups))
+			self.assertEqual(result, ("remote", True))
+
+			lease.release("key", other_process)
+			self.assertEqual(flights.do("key", lambda: "local", lambda: None), ("local", False))
+
+	def test_result_published_with_the_lease(self) -> None:
+		"""Test that a lease holder's result reaches other processes without any cache"""
+		application = create_application({ "TESTING": True, "MONGO_CLIENT": mongomock.MongoClient() })
+
+		with application.app_context():
+			lease = MongoLease(timeout=5)
+			other_process = lease.acquire("key")
+			lease.release("key", other_process, "remote", 1.0)
+
+			flights = SingleFlight(lease, poll_interval=0.01)
+			self.assertEqual(flights.do("key", lambda: "local", None, None, str.upper, str.upper), ("REMOTE", True))
+
+			self.assertEqual(flights.do("other", lambda: "local", None, None, str.upper, str.lower), ("local", False))
+			self.assertEqual(lease.published("other"), "LOCAL")
+			self.assertIsNone(lease.acquire("other"))
@@ -0,0 +1,48 @@
+import unittest
+
+from server.static_analysis import analyze_static, local_answer
+
+class TestStaticAnalysis(unittest.TestCase):
+	"""TestStaticAnalysis verifies the local pre-analysis report."""
+
+	def test_report(self) -> None:
+		"""Test complexity, long functions and unused imports"""
+		code = "\n".join([
+			"import os",
+			"import sys",
+			"from typing import List",
+			"",
+			"def branchy(values: List[int]) -> int:",
+			"\ttotal = 0",
+			"\tfor value in values:",
+			"\t\tif value > 0 and value < 10:",
+			"\t\t\ttotal += value",
+			"\treturn total if total else sys.maxsize",
+		])
+
+		report = analyze_static(code, { "STATIC_LONG_FUNCTION_LINES": 5, "STATIC_COMPLEXITY_THRESHOLD": 4 })
+
+		self.assertIsNone(report["syntax_error"])
+		self.assertEqual(report["functions"][0]["complexity"], 5)
+		self.assertEqual(report["long_functions"], ["branchy"])
+		self.assertEqual(report["complex_functions"], ["branchy"])
+		self.assertEqual(report["unused_imports"], [{ "name": "os", "line": 1 }])
+		self.assertFalse(report["trivial"])
+		self.assertIsNone(local_answer(report, { "STATIC_ANSWER_TRIVIAL": True, "STATIC_ANSWER_UNPARSABLE": True }))
+
+	def test_policy(self) -> None:
+		"""Test that trivial and unparsable code is answered locally only when enabled"""
+		trivial = analyze_static("print('Hello World')", {})
+		broken = analyze_static("def broken(:\n\tpass", {})
+
+		self.assertTrue(trivial["trivial"])
+		self.assertEqual(broken["syntax_error"]["line"], 1)
+		self.assertIsNone(local_answer(trivial, {}))
+		self.assertIsNotNone(local_answer(trivial, { "STATIC_ANSWER_TRIVIAL": True }))
+		self.assertIn("line 1", local_answer(broken, { "STATIC_ANSWER_UNPARSABLE": True }))
+
+	def test_unsupported_language(self) -> None:
+		"""Test that other languages are reported as unsupported"""
+		report = analyze_static("let x = 1;", {}, "javascript")
+		self.assertFalse(report["supported"])
+		self.assertIsNone(local_answer(report, { "STATIC_ANSWER_UNPARSABLE": True }))
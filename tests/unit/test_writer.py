@@ -0,0 +1,138 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+import mongomock
+
+from unittest.mock import patch
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+from werkzeug.security import generate_password_hash
+from server import create_application
+from server.writer import WriteBufferFull, get_writer
+
+class TestWriter(unittest.TestCase):
+	"""TestWriter verifies direct and write-behind storage of code records"""
+
+	def setUp(self) -> None:
+		"""Setup before each testcase"""
+		self.directory = tempfile.TemporaryDirectory()
+		self.spill_path = os.path.join(self.directory.name, "spill.jsonl")
+		self.client = mongomock.MongoClient()
+		self.database = self.client["FlaskApplication#01"]
+		self.database.users.insert_one({ "username": "predefined", "password": generate_password_hash("password") })
+
+	def tearDown(self) -> None:
+		"""Tear down after each testcase"""
+		self.directory.cleanup()
+
+	def create(self, **configuration) -> None:
+		self.application = create_application({
+			"TESTING": True,
+			"MONGO_CLIENT": self.client,
+			"MODEL_BACKEND": "fake",
+			"CODES_WRITE_SPILL_PATH": self.spill_path,
+			**configuration
+		})
+		self.writer = get_writer(self.application)
+		self.addCleanup(self.writer.close)
+
+	def submit(self, count: int) -> list:
+		with self.application.app_context():
+			return [self.writer.submit({ "code": f"x = {index}", "response": "ok", "user": "user" }) for index in range(count)]
+
+	def wait_for(self, count: int) -> None:
+		deadline = time.monotonic() + 5
+		while self.database.codes.count_documents({}) < count and time.monotonic() < deadline:
+			time.sleep(0.01)
+
+	def test_direct_write_with_write_concern(self) -> None:
+		"""Test that submissions are stored at once with the configured write concern"""
+		self.create(CODES_WRITE_CONCERN=1, CODES_WRITE_JOURNAL=False)
+		with self.application.app_context():
+			self.assertEqual(self.writer.collection().write_concern.document, { "w": 1, "j": False })
+
+		with self.application.test_client() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			response = client.get("/code/submit", json={ "code": "print('Hello World')" })
+
+		self.assertEqual(response.status_code, 200)
+		self.assertIsNotNone(self.database.codes.find_one({ "_id": ObjectId(response.get_json()["message_id"]) }))
+
+	def test_write_behind_keeps_message_id(self) -> None:
+		"""Test that a buffered submission is stored under the id it was answered with"""
+		self.create(CODES_WRITE_BEHIND=True, CODES_WRITE_FLUSH_INTERVAL=60)
+
+		with self.application.test_client() as client:
+			client.post("/login", json={"username": "predefined", "password": "password"})
+			response = client.get("/code/submit", json={ "code": "def f(a):\n\treturn a\n" }, query_string={ "incremental": 1 })
+			message_id = response.get_json()["message_id"]
+			self.assertEqual(self.database.codes.count_documents({}), 0)
+
+			# Still buffered, but usable as the base of an incremental analysis
+			response = client.get("/code/submit", json={ "code": "def f(a):\n\treturn a\n", "previous_id": message_id })
+			self.assertEqual(response.status_code, 200)
+
+		self.writer.close()
+		self.assertEqual(self.database.codes.count_documents({}), 2)
+		self.assertIsNotNone(self.database.codes.find_one({ "_id": ObjectId(message_id) }))
+		self.assertEqual(self.writer.stats()["buffered"], 0)
+
+	def test_flush_by_size_and_time(self) -> None:
+		"""Test that the buffer is flushed once a batch is full or the interval elapsed"""
+		self.create(CODES_WRITE_BEHIND=True, CODES_WRITE_BATCH_SIZE=3, CODES_WRITE_FLUSH_INTERVAL=60)
+		self.submit(3)
+		self.wait_for(3)
+		self.assertEqual(self.database.codes.count_documents({}), 3)
+
+		self.create(CODES_WRITE_BEHIND=True, CODES_WRITE_BATCH_SIZE=100, CODES_WRITE_FLUSH_INTERVAL=0.05)
+		self.submit(2)
+		self.wait_for(5)
+		self.assertEqual(self.database.codes.count_documents({}), 5)
+
+	def test_backpressure(self) -> None:
+		"""Test that submissions are refused while the buffer stays full"""
+		self.create(CODES_WRITE_BEHIND=True, CODES_WRITE_BATCH_SIZE=1, CODES_WRITE_BUFFER_SIZE=2, CODES_WRITE_BUFFER_TIMEOUT=0.1)
+		release = threading.Event()
+		insert_many = self.database.codes.insert_many
+
+		def slow_insert_many(*arguments, **keywords):
+			release.wait(5)
+			return insert_many(*arguments, **keywords)
+
+		with patch.object(mongomock.Collection, "insert_many", side_effect=slow_insert_many):
+			self.submit(2)
+			with self.assertRaises(WriteBufferFull):
+				self.submit(1)
+
+			with self.application.test_client() as client:
+				client.post("/login", json={"username": "predefined", "password": "password"})
+				response = client.get("/code/submit", json={ "code": "print('Hello World')" })
+			self.assertEqual(response.status_code, 503)
+			self.assertEqual(response.headers["Retry-After"], "1")
+
+			release.set()
+			self.writer.close()
+
+		self.assertEqual(self.database.codes.count_documents({}), 2)
+		self.assertEqual(self.writer.stats()["rejected"], 2)
+
+	def test_failed_flush_is_spilled_and_replayed(self) -> None:
+		"""Test that records failing every retry are spilled to disk and can be replayed"""
+		self.create(CODES_WRITE_BEHIND=True, CODES_WRITE_RETRIES=2, CODES_WRITE_RETRY_BACKOFF=0)
+
+		with patch.object(mongomock.Collection, "insert_many", side_effect=AutoReconnect("down")) as insert_many:
+			identifiers = self.submit(2)
+			self.writer.close()
+		self.assertEqual(insert_many.call_count, 3)
+		self.assertEqual(self.database.codes.count_documents({}), 0)
+		self.assertEqual(self.writer.stats()["spilled"], 2)
+
+		result = self.application.test_cli_runner().invoke(args=["replay-spilled-writes"])
+		self.assertIn("Stored 2 spilled record(s)", result.output)
+		self.assertEqual(sorted(document["_id"] for document in self.database.codes.find()), sorted(identifiers))
+		self.assertFalse(os.path.exists(self.spill_path))
+
+if __name__ == "__main__":
+	unittest.main()